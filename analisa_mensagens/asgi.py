@@ -13,4 +13,11 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'analisa_mensagens.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Importado depois de configurar o Django, pois usa os models
+from mensagens.change_feed import ChangeFeedApp  # noqa: E402
+
+# O feed de alterações mantém uma conexão aberta por cliente, então é
+# servido diretamente pela aplicação ASGI
+application = ChangeFeedApp(django_application, path='/mensagens/changes/')
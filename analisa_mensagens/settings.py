@@ -10,7 +10,9 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
+from urllib.parse import quote
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -38,9 +40,11 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'mensagens.compression.CompressionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'mensagens.db_router.ReadYourWritesMiddleware',
 ]
 
 ROOT_URLCONF = 'analisa_mensagens.urls'
@@ -72,6 +76,33 @@ DATABASES = {
     }
 }
 
+# Read replicas
+
+# A variável de ambiente MENSAGENS_READ_REPLICAS lista as réplicas de leitura
+# como arquivos SQLite separados por vírgula, abertos somente para leitura
+# para que um arquivo que não existe não seja criado vazio. Réplicas de outros
+# bancos, como instâncias locais de Postgres, podem ser adicionadas em
+# DATABASES e listadas em DATABASE_READ_REPLICAS.
+
+DATABASE_READ_REPLICAS = []
+
+for replicaIndex, replicaName in enumerate(filter(None, os.environ.get(
+        'MENSAGENS_READ_REPLICAS', '').split(','))):
+    replicaAlias = 'replica{}'.format(replicaIndex + 1)
+    DATABASES[replicaAlias] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'file:{}?mode=ro'.format(quote(replicaName.strip())),
+        'OPTIONS': {'uri': True},
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_READ_REPLICAS.append(replicaAlias)
+
+DATABASE_ROUTERS = ['mensagens.db_router.ReadReplicaRouter']
+
+# Segundos em que as leituras de um cliente vão para o banco de dados
+# principal depois de uma escrita
+READ_YOUR_WRITES_SECONDS = 5
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -100,3 +131,128 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Background jobs
+
+# Léxicos disponíveis para as tarefas de reprocessamento de sentimento
+LEXICOS = {
+    'v1': 'mensagens/assets/pt_word_sentiment_polarity.json',
+    'v2': 'mensagens/assets/pt_word_sentiment_index.json',
+}
+
+JOBS_EXPORT_DIR = BASE_DIR / 'exports'
+
+JOBS_CHUNK_SIZE = 500
+
+# Segundos sem progresso até que outro worker possa retomar uma tarefa
+JOBS_LEASE_SECONDS = 300
+
+# Ingestion buffer
+
+# Quantas mensagens a fila de ingestão aceita antes de responder 503
+INGESTION_QUEUE_SIZE = 10000
+
+# Quantas mensagens são gravadas por transação
+INGESTION_BATCH_SIZE = 500
+
+# Segundos que uma mensagem espera na fila, no máximo, antes de ser gravada
+INGESTION_FLUSH_INTERVAL = 0.2
+
+# Segundos que um request espera por espaço na fila cheia
+INGESTION_ENQUEUE_TIMEOUT = 1.0
+
+# Se True, os requests de ingestão só respondem depois de gravar as mensagens
+INGESTION_SYNCHRONOUS = False
+
+# Se True, mensagens com a mesma data e o mesmo texto de uma mensagem já
+# gravada não são gravadas de novo, e recebem a id da mensagem existente
+IDEMPOTENT_INSERT = False
+
+# Lexicon overlays
+
+# Diretório dos léxicos de cada cliente, aplicados sobre o léxico base
+LEXICON_OVERLAY_DIR = BASE_DIR / 'mensagens' / 'assets' / 'overlays'
+
+# Quantos léxicos de clientes compilados ficam em memória
+LEXICON_OVERLAY_CACHE_SIZE = 32
+
+# Delta sync
+
+# Segundos de margem da marca d'água da sincronização incremental, para
+# incluir as escritas de transações que ainda não tinham terminado
+DELTA_SYNC_SAFETY_SECONDS = 5
+
+# Dias em que as mensagens removidas continuam na tabela para que a
+# sincronização incremental informe a remoção. Depois disso o comando
+# archive_mensagens as apaga, e os clientes com uma marca d'água mais antiga
+# precisam sincronizar de novo desde o início
+DELTA_SYNC_RETENTION_DAYS = 30
+
+# Sentiment terms
+
+# Quantos termos de cada sentimento /mensagens/sentiment/terms/ retorna, no
+# máximo
+SENTIMENT_TERMS_MAX_LIMIT = 100
+
+# Change feed
+
+# Segundos entre as leituras do registro de alterações pelo feed
+CHANGE_FEED_POLL_INTERVAL = 0.5
+
+# Quantas alterações são lidas do registro por consulta
+CHANGE_FEED_BATCH_SIZE = 500
+
+# Quantos eventos um cliente do feed pode ter pendentes antes de ser
+# desconectado
+CHANGE_FEED_QUEUE_SIZE = 1000
+
+# Segundos que o feed espera por uma seq pulada do registro, que pode ser de
+# uma transação concorrente que ainda não terminou
+CHANGE_FEED_GAP_SECONDS = 5
+
+# Segundos sem alterações até que o feed envie um comentário para manter a
+# conexão aberta
+CHANGE_FEED_HEARTBEAT_SECONDS = 15
+
+# Milissegundos que o cliente espera antes de se reconectar ao feed
+CHANGE_FEED_RETRY_MILLISECONDS = 1000
+
+# Dias que as alterações ficam no registro. Depois disso o archive_mensagens
+# as apaga, e os clientes com um Last-Event-ID mais antigo precisam
+# sincronizar de novo desde o início
+CHANGE_FEED_RETENTION_DAYS = 7
+
+# Response compression
+
+# Tamanho mínimo, em bytes, de uma resposta comprimida
+COMPRESSION_MIN_SIZE = 500
+
+# Nível de compressão padrão de cada algoritmo. br e zstd só são usados se
+# os pacotes brotli e zstandard estiverem instalados
+COMPRESSION_LEVELS = {'gzip': 6, 'br': 5, 'zstd': 3}
+
+# Configurações de compressão de cada endpoint, pelo nome da URL. "min_size"
+# e "levels" substituem as configurações padrão, e "cache" guarda as
+# respostas já comprimidas em cache até a próxima alteração das mensagens
+COMPRESSION_ENDPOINTS = {
+    'mensagens:list': {
+        'levels': {'gzip': 9, 'br': 6, 'zstd': 6},
+        'cache': True,
+    },
+    'mensagens:sentimentCount': {
+        'cache': True,
+    },
+    # Respostas em streaming, comprimidas enquanto são geradas
+    'mensagens:sentiment': {
+        'levels': {'gzip': 4, 'br': 3, 'zstd': 3},
+    },
+}
+
+# Segundos que uma resposta fica no cache de respostas comprimidas, mesmo
+# sem alterações nas mensagens
+COMPRESSION_CACHE_SECONDS = 300
+
+# Archive
+
+# Diretório dos arquivos mensais criados pelo comando archive_mensagens
+ARCHIVE_DIR = BASE_DIR / 'archive'
@@ -0,0 +1,320 @@
+import gzip
+import io
+import json
+import os
+import sqlite3
+import uuid
+from datetime import date
+
+from django.conf import settings
+from django.db import transaction
+
+from . import compression
+from .db_router import pinToPrimary
+from .message_processor import MessageProcessor
+from .models import AgregadoArquivado, Mensagem
+
+ARCHIVE_FORMATS = ("ndjson", "sqlite")
+
+
+def archiveMessages(before, formato="ndjson", batchSize=1000):
+    """Move as mensagens anteriores a uma data para arquivos mensais
+
+    As mensagens são movidas em lotes. Cada lote é primeiro gravado nos
+    arquivos, e depois removido da tabela e somado aos agregados do mês em
+    uma única transação, junto com a marca do agregado até onde o arquivo
+    foi confirmado. Caso o processo seja interrompido entre as duas etapas,
+    as mensagens do lote continuam na tabela, a leitura dos arquivos ignora
+    as cópias depois da marca, e a próxima execução as descarta antes de
+    arquivar as mensagens de novo.
+
+    Args:
+        before: as mensagens com data anterior a essa são arquivadas
+        formato: "ndjson" para arquivos NDJSON comprimidos com gzip ou
+        "sqlite" para bancos de dados SQLite
+        batchSize: quantas mensagens são movidas por lote
+    Returns:
+        quantas mensagens foram arquivadas
+    Raises:
+        ValueError: o formato não existe, ou algum mês já foi arquivado em
+        outro formato
+    """
+    if formato not in ARCHIVE_FORMATS:
+        raise ValueError(
+            "Formato de arquivo desconhecido: {}".format(formato))
+    # Cada lote precisa ver as remoções do lote anterior, que talvez ainda
+    # não tenham chegado às réplicas
+    with pinToPrimary():
+        return _archiveBatches(before, formato, batchSize)
+
+
+def _archiveBatches(before, formato, batchSize):
+    messageProcessor = MessageProcessor()
+    os.makedirs(settings.ARCHIVE_DIR, exist_ok=True)
+    archived = 0
+    while True:
+        batch = list(Mensagem.objects.filter(data__lt=before).order_by(
+            "data", "id")[:batchSize])
+        if not batch:
+            return archived
+        _scoreStaleMessages(batch, messageProcessor)
+        months = {}
+        for message in batch:
+            months.setdefault(_monthOf(message.data), []).append(message)
+        aggregates = {
+            month: _archiveMonth(month, messages, formato, messageProcessor)
+            for month, messages in months.items()}
+        with transaction.atomic():
+            for month, messages in months.items():
+                _updateAggregate(aggregates[month], messages)
+            Mensagem.objects.filter(
+                id__in=[message.id for message in batch]).delete()
+        compression.invalidateCachedResponses()
+        archived += len(batch)
+
+
+def iterArchivedMessages(start=None, end=None):
+    """Itera sobre as mensagens arquivadas em um intervalo de datas
+
+    Só os arquivos dos meses que cruzam o intervalo são lidos.
+
+    Args:
+        start: a primeira data do intervalo, ou None
+        end: a última data do intervalo, ou None
+    Returns:
+        um iterador de Mensagens que não estão no banco de dados
+    """
+    for aggregate in _archivedMonths(start, end):
+        seen = set()
+        for message in _readArchive(aggregate, start, end):
+            if message.id not in seen:
+                seen.add(message.id)
+                yield message
+
+
+def countArchivedSentiment(messageProcessor, start=None, end=None):
+    """Conta as mensagens arquivadas positivas, negativas e neutras
+
+    Os agregados pré-calculados são usados para os meses inteiramente
+    dentro do intervalo, desde que tenham sido calculados com o mesmo léxico
+    e modo do messageProcessor. Nos outros meses as mensagens são lidas dos
+    arquivos e avaliadas de novo.
+
+    Args:
+        messageProcessor: o MessageProcessor que avalia as mensagens
+        start: a primeira data do intervalo, ou None
+        end: a última data do intervalo, ou None
+    Returns:
+        um dicionário com as chaves "mensagensPositivas",
+        "mensagensNegativas" e "mensagensNeutras"
+    """
+    counts = {
+        "mensagensPositivas": 0,
+        "mensagensNegativas": 0,
+        "mensagensNeutras": 0,
+    }
+    for aggregate in _archivedMonths(start, end):
+        usable = (
+            aggregate.versaoLexico == messageProcessor.lexiconVersion and
+            messageProcessor.sentimentMode == "simples" and
+            not messageProcessor.overlayPolarities and
+            (start is None or start <= aggregate.mes) and
+            (end is None or _lastDayOf(aggregate.mes) <= end))
+        if usable:
+            counts["mensagensPositivas"] += aggregate.positivas
+            counts["mensagensNegativas"] += aggregate.negativas
+            counts["mensagensNeutras"] += aggregate.neutras
+            continue
+        messages = iterArchivedMessages(
+            max(start or aggregate.mes, aggregate.mes),
+            min(end or _lastDayOf(aggregate.mes), _lastDayOf(aggregate.mes)))
+        monthCounts = json.loads(
+            messageProcessor.countSentiment(list(messages)))
+        for key in counts:
+            counts[key] += monthCounts[key]
+    return counts
+
+
+def _monthOf(day):
+    return date(day.year, day.month, 1)
+
+
+def _lastDayOf(month):
+    if month.month == 12:
+        return date(month.year, 12, 31)
+    return date.fromordinal(
+        date(month.year, month.month + 1, 1).toordinal() - 1)
+
+
+def _archivedMonths(start, end):
+    aggregates = AgregadoArquivado.objects.order_by("mes")
+    if end is not None:
+        aggregates = aggregates.filter(mes__lte=end)
+    if start is not None:
+        aggregates = aggregates.filter(mes__gte=_monthOf(start))
+    return aggregates
+
+
+def _scoreStaleMessages(messages, messageProcessor):
+    """Calcula o valorSentimento das mensagens que ainda não foram avaliadas
+    com o léxico atual"""
+    stale = [
+        message for message in messages
+        if message.valorSentimento is None or
+        message.versaoLexico != messageProcessor.lexiconVersion]
+    scores = messageProcessor.analyseSentimentBatch(
+        [message.texto for message in stale])
+    for message, score in zip(stale, scores):
+        message.valorSentimento = score
+        message.versaoLexico = messageProcessor.lexiconVersion
+
+
+def _archiveMonth(month, messages, formato, messageProcessor):
+    aggregate, created = AgregadoArquivado.objects.get_or_create(
+        mes=month, defaults={
+            "formato": formato,
+            "arquivo": os.path.join(
+                str(settings.ARCHIVE_DIR), "mensagens-{}.{}".format(
+                    month.strftime("%Y-%m"),
+                    "ndjson.gz" if formato == "ndjson" else "sqlite3")),
+            "versaoLexico": messageProcessor.lexiconVersion,
+            "confirmadoAte": 0,
+        })
+    if aggregate.versaoLexico != messageProcessor.lexiconVersion:
+        aggregate.versaoLexico = ""
+    if aggregate.formato != formato:
+        raise ValueError(
+            "O mês {} já foi arquivado no formato {}".format(
+                month.strftime("%Y-%m"), aggregate.formato))
+    if aggregate.formato == "ndjson":
+        aggregate.confirmadoAte = _appendNDJSON(
+            aggregate.arquivo, messages, aggregate.confirmadoAte)
+    else:
+        aggregate.confirmadoAte = _appendSQLite(
+            aggregate.arquivo, messages, aggregate.confirmadoAte)
+    return aggregate
+
+
+def _updateAggregate(aggregate, messages):
+    for message in messages:
+        if message.valorSentimento > 0:
+            aggregate.positivas += 1
+        elif message.valorSentimento < 0:
+            aggregate.negativas += 1
+        else:
+            aggregate.neutras += 1
+    aggregate.total += len(messages)
+    aggregate.save()
+
+
+def _toArchiveRow(message):
+    return {
+        "id": message.id.int,
+        "data": message.data.strftime("%Y-%m-%d"),
+        "status": message.status,
+        "texto": message.texto,
+        "valorSentimento": message.valorSentimento,
+        "versaoLexico": message.versaoLexico,
+    }
+
+
+def _fromArchiveRow(row):
+    return Mensagem(
+        id=uuid.UUID(int=int(row["id"])),
+        data=date.fromisoformat(row["data"]),
+        status=row["status"],
+        texto=row["texto"],
+        valorSentimento=row["valorSentimento"],
+        versaoLexico=row["versaoLexico"])
+
+
+def _appendNDJSON(path, messages, committed):
+    """Grava um lote no fim de um arquivo NDJSON, depois de descartar o que
+    vem depois de committed bytes, e retorna o novo tamanho do arquivo"""
+    # Cada lote é um novo membro gzip no fim do arquivo. O gzip lê todos os
+    # membros como um único fluxo
+    lines = "".join(
+        json.dumps(_toArchiveRow(message)) + "\n" for message in messages)
+    if committed is not None and os.path.exists(path) and \
+            os.path.getsize(path) > committed:
+        os.truncate(path, committed)
+    with gzip.open(path, "ab") as output:
+        output.write(lines.encode("utf-8"))
+    with open(path, "rb") as output:
+        os.fsync(output.fileno())
+    return os.path.getsize(path)
+
+
+def _appendSQLite(path, messages, committed):
+    """Grava um lote em um arquivo SQLite, depois de descartar as linhas com
+    rowid maior que committed, e retorna a maior rowid do arquivo"""
+    connection = sqlite3.connect(path)
+    try:
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS mensagem ("
+                "id TEXT PRIMARY KEY, data TEXT, status TEXT, texto TEXT, "
+                "valorSentimento INTEGER, versaoLexico TEXT)")
+            if committed is not None:
+                connection.execute(
+                    "DELETE FROM mensagem WHERE rowid > ?", (committed,))
+            connection.executemany(
+                "INSERT OR REPLACE INTO mensagem VALUES "
+                "(:id, :data, :status, :texto, :valorSentimento, "
+                ":versaoLexico)",
+                [dict(_toArchiveRow(message), id=str(message.id.int))
+                 for message in messages])
+        return connection.execute(
+            "SELECT max(rowid) FROM mensagem").fetchone()[0]
+    finally:
+        connection.close()
+
+
+class _CommittedPart(io.RawIOBase):
+    """Lê só os primeiros size bytes de um arquivo"""
+
+    def __init__(self, raw, size):
+        self._raw = raw
+        self._remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        view = memoryview(buffer)[:max(self._remaining, 0)]
+        count = self._raw.readinto(view)
+        self._remaining -= count
+        return count
+
+
+def _readArchive(aggregate, start, end):
+    """Lê as mensagens de um mês arquivado, ignorando o que foi gravado
+    depois de aggregate.confirmadoAte"""
+    if aggregate.formato == "ndjson":
+        with open(aggregate.arquivo, "rb") as raw:
+            if aggregate.confirmadoAte is not None:
+                raw = io.BufferedReader(
+                    _CommittedPart(raw, aggregate.confirmadoAte))
+            with gzip.open(raw, "rt", encoding="utf-8") as source:
+                for line in source:
+                    message = _fromArchiveRow(json.loads(line))
+                    if _inRange(message.data, start, end):
+                        yield message
+        return
+    connection = sqlite3.connect(aggregate.arquivo)
+    connection.row_factory = sqlite3.Row
+    committed = aggregate.confirmadoAte
+    try:
+        rows = connection.execute(
+            "SELECT * FROM mensagem WHERE data >= ? AND data <= ? "
+            "AND rowid <= ? ORDER BY data, id",
+            ((start or date.min).isoformat(), (end or date.max).isoformat(),
+             committed if committed is not None else 2 ** 63 - 1))
+        for row in rows:
+            yield _fromArchiveRow(row)
+    finally:
+        connection.close()
+
+
+def _inRange(day, start, end):
+    return (start is None or start <= day) and (end is None or day <= end)
@@ -0,0 +1,324 @@
+import asyncio
+import json
+import time
+import weakref
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .db_router import pinToPrimary
+from .models import Alteracao
+
+
+def fetchChanges(after, limit, missing=()):
+    """Lê do registro as alterações posteriores a uma seq
+
+    Args:
+        after: a última seq já conhecida
+        limit: quantas alterações posteriores a after são lidas, no máximo
+        missing: seqs anteriores a after que também são lidas, caso já
+        existam
+    Returns:
+        uma lista de tuplas (seq, evento), com o evento já formatado para
+        Server-Sent Events
+    """
+    # O registro é lido no banco de dados principal para que as réplicas
+    # atrasadas não façam a seq pular alterações
+    with pinToPrimary():
+        changes = list(
+            Alteracao.objects.filter(seq__gt=after).order_by("seq")[:limit])
+        if missing:
+            changes = list(Alteracao.objects.filter(
+                seq__in=list(missing)).order_by("seq")) + changes
+    return [(change.seq, formatEvent(change)) for change in changes]
+
+
+def latestSeq():
+    """Retorna a seq da última alteração do registro, ou 0"""
+    with pinToPrimary():
+        change = Alteracao.objects.order_by("-seq").first()
+    return change.seq if change is not None else 0
+
+
+def oldestSeq():
+    """Retorna a seq da alteração mais antiga ainda no registro, ou 0"""
+    with pinToPrimary():
+        change = Alteracao.objects.order_by("seq").first()
+    return change.seq if change is not None else 0
+
+
+def formatEvent(change):
+    """Formata uma Alteracao como um evento de Server-Sent Events"""
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(
+        change.seq, change.tipo, change.toJSON()).encode("utf-8")
+
+
+class _Subscriber():
+    """Um cliente conectado ao feed de alterações"""
+
+    def __init__(self, queueSize, liveFrom, gapFloor):
+        self.queue = asyncio.Queue(queueSize)
+        self.liveFrom = liveFrom
+        self.gapFloor = gapFloor
+
+
+class ChangeFeedHub():
+    '''Distribui as novas alterações do registro para os clientes conectados
+
+    Uma única tarefa por processo lê o registro a cada pollInterval segundos
+    e coloca os eventos, formatados uma única vez, na fila de cada cliente.
+    Assim um cliente parado custa apenas uma fila vazia, e o banco de dados
+    é consultado da mesma forma com um ou milhares de clientes. A leitura
+    só acontece enquanto houver clientes conectados.
+
+    Um cliente que não consome os eventos a tempo e enche a sua fila é
+    desconectado. Ele pode se reconectar com o header Last-Event-ID e
+    retomar a leitura do registro.
+
+    Transações concorrentes podem gravar uma seq menor depois que uma seq
+    maior já foi lida. Por isso as seqs puladas são guardadas como lacunas
+    e procuradas de novo a cada leitura, até gapTimeout segundos depois,
+    quando a transação é considerada desfeita. Cada evento é distribuído
+    uma única vez.
+
+    Attributes:
+        pollInterval: quantos segundos se passam entre as leituras do
+        registro
+        batchSize: quantas alterações são lidas por consulta
+        queueSize: quantos eventos cada cliente pode ter pendentes
+        gapTimeout: por quantos segundos uma seq pulada é esperada
+    '''
+
+    def __init__(self, pollInterval, batchSize, queueSize, gapTimeout=5):
+        self.pollInterval = pollInterval
+        self.batchSize = batchSize
+        self.queueSize = queueSize
+        self.gapTimeout = gapTimeout
+        self.lastSeq = 0
+        self._gaps = {}
+        self._subscribers = set()
+        self._task = None
+        self._lock = asyncio.Lock()
+
+    async def subscribe(self):
+        """Conecta um novo cliente
+
+        Returns:
+            o _Subscriber do cliente. Os eventos com seq maior que
+            subscriber.liveFrom, e os das lacunas maiores que
+            subscriber.gapFloor, são colocados na sua fila. None na fila
+            indica que o cliente foi desconectado
+        """
+        async with self._lock:
+            if self._task is None:
+                self.lastSeq = await sync_to_async(latestSeq)()
+                self._gaps = {}
+                self._task = asyncio.ensure_future(self._poll())
+            subscriber = _Subscriber(
+                self.queueSize, self.lastSeq,
+                min(self._gaps, default=self.lastSeq + 1) - 1)
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """Desconecta um cliente"""
+        self._subscribers.discard(subscriber)
+
+    async def _poll(self):
+        try:
+            while self._subscribers:
+                changes = await sync_to_async(fetchChanges)(
+                    self.lastSeq, self.batchSize, list(self._gaps))
+                newChanges = self._receive(changes, time.monotonic())
+                if newChanges < self.batchSize:
+                    await asyncio.sleep(self.pollInterval)
+        finally:
+            self._task = None
+
+    def _receive(self, changes, now):
+        """Distribui as alterações lidas que ainda não foram distribuídas,
+        e atualiza as lacunas
+
+        Returns:
+            quantas alterações posteriores a lastSeq foram lidas
+        """
+        newChanges = 0
+        for seq, event in changes:
+            if seq > self.lastSeq:
+                newChanges += 1
+                for missing in range(
+                        max(self.lastSeq + 1, seq - self.batchSize), seq):
+                    self._gaps[missing] = now
+                self.lastSeq = seq
+            elif self._gaps.pop(seq, None) is None:
+                continue
+            self._broadcast(seq, event)
+        for seq, since in list(self._gaps.items()):
+            if now - since > self.gapTimeout:
+                del self._gaps[seq]
+        return newChanges
+
+    def _broadcast(self, seq, event):
+        for subscriber in list(self._subscribers):
+            try:
+                subscriber.queue.put_nowait((seq, event))
+            except asyncio.QueueFull:
+                # Libera um lugar na fila para avisar o cliente de que foi
+                # desconectado
+                self._subscribers.discard(subscriber)
+                subscriber.queue.get_nowait()
+                subscriber.queue.put_nowait(None)
+
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+def getChangeFeedHub():
+    """Retorna o ChangeFeedHub do event loop atual, criado com as
+    configurações CHANGE_FEED_* do settings"""
+    loop = asyncio.get_event_loop()
+    hub = _hubs.get(loop)
+    if hub is None:
+        hub = _hubs[loop] = ChangeFeedHub(
+            pollInterval=settings.CHANGE_FEED_POLL_INTERVAL,
+            batchSize=settings.CHANGE_FEED_BATCH_SIZE,
+            queueSize=settings.CHANGE_FEED_QUEUE_SIZE,
+            gapTimeout=settings.CHANGE_FEED_GAP_SECONDS)
+    return hub
+
+
+class ChangeFeedApp():
+    '''Aplicação ASGI que serve o feed de alterações como Server-Sent Events
+
+    Os requests para path são atendidos diretamente, sem passar pelo
+    Django, pois uma conexão aberta por cliente não pode ocupar uma thread
+    ou uma conexão com o banco de dados. Os outros requests são repassados
+    para a aplicação do Django.
+
+    Com o header Last-Event-ID, ou com o parâmetro "ultimoEvento" da query,
+    as alterações posteriores a essa seq são enviadas antes das novas. Sem
+    ele, só as alterações feitas depois da conexão são enviadas. Uma
+    alteração de uma transação que terminou depois de outras pode chegar
+    depois de seqs maiores, mas nunca é enviada duas vezes na mesma conexão.
+    Um Last-Event-ID anterior à alteração mais antiga do registro, cujas
+    alterações seguintes já foram apagadas, é respondido com 410, e o
+    cliente precisa sincronizar de novo com "since=0".
+
+    Attributes:
+        application: a aplicação ASGI que atende os outros requests
+        path: o path do feed
+    '''
+
+    def __init__(self, application, path):
+        self.application = application
+        self.path = path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            return await self.application(scope, receive, send)
+        if scope["method"] != "GET":
+            return await self._sendError(
+                send, 405, "Método não permitido")
+        headers = dict(scope["headers"])
+        lastEventID = headers.get(b"last-event-id", b"").decode("latin-1")
+        if not lastEventID:
+            query = parse_qs(scope["query_string"].decode("latin-1"))
+            lastEventID = query.get("ultimoEvento", [""])[0]
+        try:
+            lastSeq = int(lastEventID) if lastEventID else None
+        except ValueError:
+            return await self._sendError(
+                send, 400, "Last-Event-ID inválido: {}".format(lastEventID))
+        if lastSeq is not None and \
+                lastSeq < await sync_to_async(oldestSeq)() - 1:
+            return await self._sendError(
+                send, 410, "O Last-Event-ID é anterior ao início do registro "
+                "de alterações. Sincronize de novo com since=0")
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream; charset=utf-8"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+            ],
+        })
+        disconnected = asyncio.ensure_future(self._waitDisconnect(receive))
+        streaming = asyncio.ensure_future(self._stream(send, lastSeq))
+        try:
+            await asyncio.wait(
+                {disconnected, streaming},
+                return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            disconnected.cancel()
+            streaming.cancel()
+        if streaming.done() and not streaming.cancelled() and \
+                streaming.exception() is not None:
+            raise streaming.exception()
+
+    async def _stream(self, send, lastSeq):
+        hub = getChangeFeedHub()
+        subscriber = await hub.subscribe()
+        heartbeat = settings.CHANGE_FEED_HEARTBEAT_SECONDS
+        try:
+            await self._send(send, "retry: {}\n\n".format(
+                settings.CHANGE_FEED_RETRY_MILLISECONDS).encode("utf-8"))
+            if lastSeq is None:
+                lastSeq = subscriber.liveFrom
+            # As alterações das lacunas do hub que já forem lidas aqui não
+            # são enviadas de novo quando o hub as distribuir
+            caughtUp = set()
+            while lastSeq < subscriber.liveFrom:
+                changes = await sync_to_async(fetchChanges)(
+                    lastSeq, hub.batchSize)
+                changes = [
+                    change for change in changes
+                    if change[0] <= subscriber.liveFrom]
+                if not changes:
+                    break
+                for seq, event in changes:
+                    await self._send(send, event)
+                    lastSeq = seq
+                    if seq > subscriber.gapFloor:
+                        caughtUp.add(seq)
+            while True:
+                try:
+                    item = await asyncio.wait_for(
+                        subscriber.queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    await self._send(send, b": heartbeat\n\n")
+                    continue
+                if item is None:
+                    break
+                seq, event = item
+                if seq in caughtUp:
+                    caughtUp.discard(seq)
+                else:
+                    await self._send(send, event)
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            hub.unsubscribe(subscriber)
+
+    async def _send(self, send, body):
+        await send({
+            "type": "http.response.body", "body": body, "more_body": True})
+
+    async def _waitDisconnect(self, receive):
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+
+    async def _sendError(self, send, code, message):
+        await send({
+            "type": "http.response.start",
+            "status": code,
+            "headers": [(b"content-type", b"application/json")],
+        })
+        await send({
+            "type": "http.response.body",
+            "body": json.dumps(
+                {"error": {"code": code, "message": message}}
+            ).encode("utf-8"),
+        })
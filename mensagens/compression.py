@@ -0,0 +1,284 @@
+import hashlib
+import zlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.http import HttpResponse
+from django.urls import Resolver404, resolve
+from django.utils.cache import patch_vary_headers
+
+from .change_feed import latestSeq
+from .db_router import isPinnedRequest, trackReads
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Tipos de conteúdo que são comprimidos. Os outros, como parquet, já são
+# comprimidos pelo próprio formato
+COMPRESSIBLE_TYPES = (
+    "application/json",
+    "application/x-ndjson",
+    "application/vnd.apache.arrow.stream",
+    "text/",
+)
+
+
+class _GzipCompressor():
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data) + self._compressor.flush(
+            zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _BrotliCompressor():
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class _ZstdCompressor():
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data) + self._compressor.flush(
+            zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+# Algoritmos na ordem de preferência do servidor, usada quando o cliente
+# aceita mais de um com a mesma prioridade
+_COMPRESSORS = {
+    "zstd": _ZstdCompressor if zstandard is not None else None,
+    "br": _BrotliCompressor if brotli is not None else None,
+    "gzip": _GzipCompressor,
+}
+
+
+def availableEncodings():
+    """Retorna os algoritmos de compressão disponíveis, na ordem de
+    preferência do servidor. zstd e br dependem dos pacotes zstandard e
+    brotli"""
+    return [
+        encoding for encoding, compressor in _COMPRESSORS.items()
+        if compressor is not None]
+
+
+def negotiateEncoding(acceptEncoding):
+    """Escolhe o algoritmo de compressão a partir do header Accept-Encoding
+
+    Args:
+        acceptEncoding: o valor do header, ou None
+    Returns:
+        o algoritmo com a maior prioridade aceita pelo cliente, ou None caso
+        o cliente não aceite nenhum algoritmo disponível
+    """
+    accepted = {}
+    for part in (acceptEncoding or "").split(","):
+        name, _, parameters = part.partition(";")
+        quality = 1.0
+        for parameter in parameters.split(";"):
+            key, _, value = parameter.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.strip().lower()] = quality
+    best = None
+    for encoding in availableEncodings():
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (encoding, quality)
+    return best[0] if best is not None else None
+
+
+def compressor(encoding, level):
+    """Cria um compressor incremental
+
+    Args:
+        encoding: um dos algoritmos de availableEncodings()
+        level: o nível de compressão
+    Returns:
+        um objeto com os métodos compress(dados), que retorna os dados
+        comprimidos até o momento, e finish(), que retorna o fim do fluxo
+    """
+    return _COMPRESSORS[encoding](level)
+
+
+def compressBytes(data, encoding, level):
+    """Comprime um conteúdo inteiro com um algoritmo e nível"""
+    stream = compressor(encoding, level)
+    return stream.compress(data) + stream.finish()
+
+
+# Contador das alterações feitas sem passar pelo registro de alterações
+VERSION_KEY = "compressao:versao"
+
+
+def dataVersion():
+    """Retorna a versão dos dados servidos pela API
+
+    Muda a cada mensagem criada, alterada ou removida, então as respostas em
+    cache com outra versão estão desatualizadas. É a seq da última entrada
+    do registro de alterações, lida pela chave primária, junto com o
+    contador de invalidateCachedResponses.
+    """
+    return "{}.{}".format(latestSeq(), cache.get(VERSION_KEY, 0))
+
+
+def invalidateCachedResponses():
+    """Muda a versão dos dados depois de uma alteração nas mensagens que não
+    é registrada no registro de alterações, como o reprocessamento de
+    sentimento ou o arquivamento"""
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 1, None)
+
+
+class CompressionMiddleware():
+    '''Comprime as respostas com o algoritmo negociado pelo Accept-Encoding
+
+    Suporta gzip e, caso os pacotes brotli e zstandard estejam instalados,
+    br e zstd. As respostas em streaming são comprimidas bloco a bloco, sem
+    esperar o fim da resposta.
+
+    settings.COMPRESSION_ENDPOINTS configura cada endpoint pelo nome da
+    URL: "min_size" é o tamanho mínimo, em bytes, de uma resposta
+    comprimida, "levels" é o nível de compressão de cada algoritmo e
+    "cache" guarda em cache as respostas já comprimidas. O cache é
+    indexado pela versão dos dados, então uma resposta só é calculada e
+    comprimida de novo depois de uma alteração nas mensagens. A versão é a
+    do banco de dados principal, então só as respostas lidas nele são
+    guardadas, e os clientes fixados no banco de dados principal depois de
+    uma escrita não usam o cache.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        viewName, options = self._endpointOptions(request)
+        encoding = negotiateEncoding(request.headers.get("Accept-Encoding"))
+        if not options["cache"] or request.method != "GET" or \
+                "since" in request.GET or isPinnedRequest(request):
+            return self._compress(
+                request, self.get_response(request), encoding, options)
+        # A versão é lida antes da resposta, então uma escrita feita durante
+        # o cálculo da resposta só pode deixá-la mais nova que a versão. Uma
+        # resposta lida em uma réplica pode ser mais antiga que a versão e
+        # não é guardada
+        cacheKey = self._cacheKey(request, viewName, encoding)
+        cached = cache.get(cacheKey)
+        if cached is not None:
+            return self._cachedResponse(cached)
+        with trackReads() as aliases:
+            response = self._compress(
+                request, self.get_response(request), encoding, options)
+        if response.status_code == 200 and not response.streaming and \
+                not response.cookies and aliases <= {DEFAULT_DB_ALIAS}:
+            cache.set(cacheKey, {
+                "headers": list(response.headers.items()),
+                "body": response.content,
+            }, settings.COMPRESSION_CACHE_SECONDS)
+        return response
+
+    def _endpointOptions(self, request):
+        try:
+            viewName = resolve(request.path_info).view_name
+        except Resolver404:
+            viewName = None
+        options = {
+            "min_size": settings.COMPRESSION_MIN_SIZE,
+            "levels": settings.COMPRESSION_LEVELS,
+            "cache": False,
+        }
+        endpoint = settings.COMPRESSION_ENDPOINTS.get(viewName, {})
+        options.update(endpoint)
+        options["levels"] = dict(
+            settings.COMPRESSION_LEVELS, **endpoint.get("levels", {}))
+        return viewName, options
+
+    def _cacheKey(self, request, viewName, encoding):
+        variant = "\n".join([
+            request.get_full_path(),
+            request.headers.get("Accept", ""),
+            request.headers.get("X-Lexico", ""),
+        ])
+        return "compressao:{}:{}:{}:{}".format(
+            viewName, encoding or "identity", dataVersion(),
+            hashlib.sha256(variant.encode("utf-8")).hexdigest())
+
+    def _cachedResponse(self, cached):
+        response = HttpResponse(cached["body"])
+        for header, value in cached["headers"]:
+            response.headers[header] = value
+        return response
+
+    def _compress(self, request, response, encoding, options):
+        contentType = response.headers.get("Content-Type", "")
+        if response.has_header("Content-Encoding") or \
+                not contentType.startswith(COMPRESSIBLE_TYPES):
+            return response
+        patch_vary_headers(response, ("Accept-Encoding",))
+        if encoding is None:
+            return response
+        level = options["levels"][encoding]
+        if response.streaming:
+            if getattr(response, "is_async", False):
+                response.streaming_content = self._compressAsyncStream(
+                    response.streaming_content, encoding, level)
+            else:
+                response.streaming_content = self._compressStream(
+                    response.streaming_content, encoding, level)
+            del response.headers["Content-Length"]
+        else:
+            if len(response.content) < options["min_size"]:
+                return response
+            compressed = compressBytes(response.content, encoding, level)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers["Content-Length"] = str(len(compressed))
+        etag = response.headers.get("ETag")
+        if etag and etag.startswith('"'):
+            response.headers["ETag"] = "W/" + etag
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+    def _compressStream(self, content, encoding, level):
+        stream = compressor(encoding, level)
+        for chunk in content:
+            compressed = stream.compress(chunk)
+            if compressed:
+                yield compressed
+        yield stream.finish()
+
+    async def _compressAsyncStream(self, content, encoding, level):
+        stream = compressor(encoding, level)
+        async for chunk in content:
+            compressed = stream.compress(chunk)
+            if compressed:
+                yield compressed
+        yield stream.finish()
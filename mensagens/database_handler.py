@@ -1,27 +1,148 @@
-from .models import Mensagem
+import json
+from datetime import datetime, timedelta, timezone as dtTimezone
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import archive
+from . import term_index
+from .db_router import pinToPrimary
+from .message_processor import MessageProcessor
+from .models import Alteracao, Mensagem
 
 
 def insertMessage(newMessage):
     """Adiciona uma nova mensagem ao banco de dados
 
+    A mensagem é gravada com a sua avaliação de sentimento, e a inserção é
+    registrada no registro de alterações. Com settings.IDEMPOTENT_INSERT, uma
+    mensagem com a mesma data e o mesmo texto de uma mensagem já gravada não
+    é validada nem gravada de novo.
+
     Args:
         newMessage: A mensagem a ser adicionada serializada no formato de
         string JSON
+    Returns:
+        a id da mensagem adicionada, ou da mensagem já gravada com o mesmo
+        conteúdo
     Raises:
         Exception: Um erro ocorreu ao deserializar o JSON ou ao se comunicar
         com o banco de dados
     """
     try:
-        message = Mensagem.fromJSON(newMessage)
+        data = json.loads(newMessage)
     except Exception as error:
         raise Exception(
             "Falha ao criar mensagem. Verifique o formato do input: {}"
             .format(error))
+    if settings.IDEMPOTENT_INSERT:
+        contentHash = Mensagem.contentHashFromDict(data)
+        existing = findMessagesByContent([contentHash])
+        if contentHash in existing:
+            return existing[contentHash]
     try:
-        message.save()
+        message = Mensagem.fromDict(data)
+    except Exception as error:
+        raise Exception(
+            "Falha ao criar mensagem. Verifique o formato do input: {}"
+            .format(error))
+    _scoreMessages([message])
+    try:
+        with transaction.atomic():
+            message.save()
+            Alteracao.fromMessage(Alteracao.CRIADA, message).save()
+            term_index.indexMessages([message])
     except Exception as error:
         raise Exception(
             "Erro ao adicionar mensagem no banco de dados: {}".format(error))
+    return message.id
+
+
+def findMessagesByContent(contentHashes):
+    """Procura as mensagens gravadas com alguns hashes de conteúdo em uma
+    única consulta
+
+    Args:
+        contentHashes: os hashes de conteúdo procurados. Valores None são
+        ignorados
+    Returns:
+        um dicionário com a id de uma mensagem gravada para cada hash
+        encontrado
+    Raises:
+        Exception: caso houver uma falha ao acessar o banco de dados
+    """
+    contentHashes = {
+        contentHash for contentHash in contentHashes
+        if contentHash is not None}
+    if not contentHashes:
+        return {}
+    try:
+        # As leituras precisam ver as inserções recentes, que talvez ainda
+        # não tenham chegado às réplicas
+        with pinToPrimary():
+            rows = Mensagem.objects.filter(
+                hashConteudo__in=contentHashes).values_list(
+                    "hashConteudo", "id")
+            return dict(rows)
+    except Exception as error:
+        raise Exception("Erro ao acessar o banco de dados: {}".format(error))
+
+
+def insertMessages(messages):
+    """Adiciona várias mensagens ao banco de dados em uma única transação
+
+    A avaliação de sentimento das mensagens é calculada em lote e gravada
+    junto com elas, assim como as entradas do registro de alterações. Com
+    settings.IDEMPOTENT_INSERT, as mensagens repetidas no lote ou já gravadas
+    não são avaliadas nem gravadas, e recebem a id da mensagem com o mesmo
+    conteúdo.
+
+    Args:
+        messages: uma lista de Mensagens já validadas
+    Returns:
+        a lista com as ids das mensagens
+    Raises:
+        Exception: Um erro ocorreu ao se comunicar com o banco de dados.
+        Nenhuma das mensagens é adicionada
+    """
+    for message in messages:
+        message.hashConteudo = Mensagem.contentHash(
+            message.data, message.texto)
+    newMessages = messages
+    if settings.IDEMPOTENT_INSERT:
+        known = findMessagesByContent(
+            [message.hashConteudo for message in messages])
+        newMessages = []
+        for message in messages:
+            if message.hashConteudo in known:
+                message.id = known[message.hashConteudo]
+            else:
+                known[message.hashConteudo] = message.id
+                newMessages.append(message)
+    _scoreMessages(newMessages)
+    try:
+        with transaction.atomic():
+            Mensagem.objects.bulk_create(newMessages)
+            Alteracao.objects.bulk_create([
+                Alteracao.fromMessage(Alteracao.CRIADA, message)
+                for message in newMessages])
+            term_index.indexMessages(newMessages)
+    except Exception as error:
+        raise Exception(
+            "Erro ao adicionar mensagens no banco de dados: {}".format(error))
+    return [message.id for message in messages]
+
+
+def _scoreMessages(messages):
+    """Calcula e guarda nas mensagens a avaliação de sentimento com o léxico
+    atual"""
+    messageProcessor = MessageProcessor()
+    scores = messageProcessor.analyseSentimentBatch(
+        [message.texto for message in messages])
+    for message, score in zip(messages, scores):
+        message.valorSentimento = score
+        message.versaoLexico = messageProcessor.lexiconVersion
 
 
 def fetchMessage(messageID):
@@ -44,19 +165,35 @@ def fetchMessage(messageID):
     return message.toJSON()
 
 
-def listMessages(jsonFormat=True):
+def _filterByDate(messages, start, end):
+    if start is not None:
+        messages = messages.filter(data__gte=start)
+    if end is not None:
+        messages = messages.filter(data__lte=end)
+    return messages
+
+
+def listMessages(jsonFormat=True, start=None, end=None,
+                 includeArchived=True):
     """Retorna uma lista com todas as mensagens no banco de dados
     Args:
         jsonFormat: Se True, retorna as mensagens em formato JSON
         se False, retorna as mensagens como um objeto Mensage.
         default = True
+        start: se fornecida, só retorna mensagens a partir dessa data
+        end: se fornecida, só retorna mensagens até essa data
+        includeArchived: Se True, também retorna as mensagens arquivadas
+        no intervalo. default = True
     Returns:
         Uma lista com as mensagens
     Raises:
         Exception: caso houver uma falha ao acessar o banco de dados
     """
     try:
-        messages = list(Mensagem.objects.all())
+        messages = list(
+            _filterByDate(Mensagem.objects.all(), start, end))
+        if includeArchived:
+            messages += list(archive.iterArchivedMessages(start, end))
         if jsonFormat:
             messages = list(map(lambda m: m.toJSON(), messages))
             messages = ", ".join(messages)
@@ -66,9 +203,130 @@ def listMessages(jsonFormat=True):
     return messages
 
 
+def iterMessages(loadText=True, chunkSize=1000, start=None, end=None,
+                 includeArchived=True):
+    """Itera sobre todas as mensagens no banco de dados sem carregá-las
+    todas na memória
+
+    Args:
+        loadText: Se False, o texto das mensagens só é lido do banco de
+        dados caso seja acessado. default = True
+        chunkSize: quantas mensagens são lidas do banco de dados por vez
+        start: se fornecida, só retorna mensagens a partir dessa data
+        end: se fornecida, só retorna mensagens até essa data
+        includeArchived: Se True, também retorna as mensagens arquivadas
+        no intervalo. default = True
+    Returns:
+        Um iterador de Mensagens
+    Raises:
+        Exception: caso houver uma falha ao acessar o banco de dados
+    """
+    messages = _filterByDate(Mensagem.objects.all(), start, end)
+    if not loadText:
+        messages = messages.defer("texto")
+    try:
+        for message in messages.iterator(chunk_size=chunkSize):
+            yield message
+        if includeArchived:
+            yield from archive.iterArchivedMessages(start, end)
+    except Exception as error:
+        raise Exception("Erro ao acessar o banco de dados: {}".format(error))
+
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dtTimezone.utc)
+
+
+class WatermarkExpired(Exception):
+    """A marca d'água é anterior ao horizonte de retenção das mensagens
+    removidas, então a sincronização precisa recomeçar do início"""
+
+
+def syncHorizon():
+    """Retorna a data e hora a partir da qual as mensagens removidas ainda
+    estão na tabela, de acordo com settings.DELTA_SYNC_RETENTION_DAYS"""
+    return timezone.now() - timedelta(
+        days=settings.DELTA_SYNC_RETENTION_DAYS)
+
+
+def parseWatermark(watermark):
+    """Converte a marca d'água de uma sincronização incremental em uma data
+
+    Args:
+        watermark: a marca d'água, em microssegundos desde 1970. "0" pede
+        todas as mensagens
+    Returns:
+        a data e hora da marca d'água
+    Raises:
+        ValueError: a marca d'água não é válida
+    """
+    try:
+        microseconds = int(watermark)
+        if microseconds < 0:
+            raise ValueError("negativa")
+        return _EPOCH + timedelta(microseconds=microseconds)
+    except (ValueError, OverflowError) as error:
+        raise ValueError(
+            "Marca d'água inválida: {} ({})".format(watermark, error))
+
+
+def listChanges(since, start=None, end=None):
+    """Retorna as mensagens alteradas ou removidas depois de uma marca
+    d'água
+
+    A nova marca d'água fica settings.DELTA_SYNC_SAFETY_SECONDS antes do
+    momento da consulta, para não perder escritas de transações que ainda
+    não terminaram. Por isso algumas mensagens podem ser retornadas de novo
+    na sincronização seguinte. A sincronização completa, com a marca d'água
+    de "0", também retorna as mensagens arquivadas.
+
+    Args:
+        since: a data e hora da marca d'água anterior, como retornada por
+        parseWatermark
+        start: se fornecida, só retorna mensagens a partir dessa data
+        end: se fornecida, só retorna mensagens até essa data
+    Returns:
+        uma tupla com a lista de Mensagens alteradas, a lista com as ids das
+        mensagens removidas e a nova marca d'água
+    Raises:
+        WatermarkExpired: a marca d'água é anterior a syncHorizon(), então
+        algumas remoções podem já ter sido apagadas
+        Exception: caso houver uma falha ao acessar o banco de dados
+    """
+    if _EPOCH < since < syncHorizon():
+        raise WatermarkExpired(
+            "A marca d'água é anterior ao horizonte de retenção de {} dias. "
+            "Sincronize de novo com since=0".format(
+                settings.DELTA_SYNC_RETENTION_DAYS))
+    safeUntil = timezone.now() - timedelta(
+        seconds=settings.DELTA_SYNC_SAFETY_SECONDS)
+    watermark = max(since, safeUntil)
+    try:
+        # As réplicas podem estar atrasadas em relação à marca d'água
+        with pinToPrimary():
+            changed = _filterByDate(
+                Mensagem.todas.filter(atualizadoEm__gt=since), start, end)
+            messages = []
+            removedIDs = []
+            for message in changed.order_by("atualizadoEm", "id"):
+                if message.removidoEm is None:
+                    messages.append(message)
+                else:
+                    removedIDs.append(message.id)
+        if since == _EPOCH:
+            messages += archive.iterArchivedMessages(start, end)
+    except Exception as error:
+        raise Exception("Erro ao acessar o banco de dados: {}".format(error))
+    return messages, removedIDs, str(
+        (watermark - _EPOCH) // timedelta(microseconds=1))
+
+
 def deleteMessage(messageID):
     """Deleta uma mensagem específica do banco de dados
 
+    A mensagem é marcada como removida, mas continua na tabela para que a
+    sincronização incremental informe a remoção. A remoção é registrada no
+    registro de alterações.
+
     Args:
         messageID: a id única da mensagem a ser deletada
     Returns:
@@ -79,9 +337,18 @@ def deleteMessage(messageID):
     """
 
     try:
-        message = Mensagem.objects.get(pk=messageID)
+        now = timezone.now()
+        with transaction.atomic(), pinToPrimary():
+            # A remoção é um update condicional, então só um de dois
+            # requests concorrentes a registra e atualiza o índice de termos
+            removed = Mensagem.objects.filter(pk=messageID).update(
+                removidoEm=now, atualizadoEm=now)
+            if not removed:
+                raise Mensagem.DoesNotExist()
+            message = Mensagem.todas.get(pk=messageID)
+            Alteracao.fromMessage(Alteracao.REMOVIDA, message).save()
+            term_index.unindexMessages([message])
         jsonEncodedMessage = message.toJSON()
-        message.delete()
     except Mensagem.DoesNotExist:
         raise Exception("Messagem com id {} não existe".format(messageID))
     except Exception as error:
@@ -89,9 +356,80 @@ def deleteMessage(messageID):
     return jsonEncodedMessage
 
 
+def purgeRemovedMessages(batchSize=1000):
+    """Apaga da tabela as mensagens removidas antes de syncHorizon()
+
+    As mensagens removidas continuam na tabela para a sincronização
+    incremental, e são apagadas de vez depois do horizonte de retenção.
+
+    Args:
+        batchSize: quantas mensagens são apagadas por transação
+    Returns:
+        quantas mensagens foram apagadas
+    Raises:
+        Exception: caso houver uma falha ao acessar o banco de dados
+    """
+    horizon = syncHorizon()
+    purged = 0
+    try:
+        with pinToPrimary():
+            while True:
+                batch = list(Mensagem.todas.filter(
+                    removidoEm__lt=horizon).values_list(
+                        "id", flat=True)[:batchSize])
+                if not batch:
+                    return purged
+                Mensagem.todas.filter(id__in=batch).delete()
+                purged += len(batch)
+    except Exception as error:
+        raise Exception("Erro ao acessar o banco de dados: {}".format(error))
+
+
+def purgeOldChanges(batchSize=1000):
+    """Apaga do registro de alterações as entradas feitas há mais de
+    settings.CHANGE_FEED_RETENTION_DAYS dias
+
+    As entradas são apagadas em ordem de seq, então o registro continua
+    sendo uma sequência sem buracos a partir da entrada mais antiga. A
+    entrada mais recente nunca é apagada, para que a seq do registro não
+    volte atrás.
+
+    Args:
+        batchSize: quantas entradas são apagadas por transação
+    Returns:
+        quantas entradas foram apagadas
+    Raises:
+        Exception: caso houver uma falha ao acessar o banco de dados
+    """
+    horizon = timezone.now() - timedelta(
+        days=settings.CHANGE_FEED_RETENTION_DAYS)
+    purged = 0
+    try:
+        with pinToPrimary():
+            newest = Alteracao.objects.order_by("-seq").values_list(
+                "seq", flat=True)
+            cutoff = newest.filter(criadoEm__lt=horizon).first()
+            if cutoff is None:
+                return purged
+            cutoff = min(cutoff, newest.first() - 1)
+            while True:
+                batch = list(Alteracao.objects.filter(
+                    seq__lte=cutoff).order_by("seq").values_list(
+                        "seq", flat=True)[:batchSize])
+                if not batch:
+                    return purged
+                Alteracao.objects.filter(seq__in=batch).delete()
+                purged += len(batch)
+    except Exception as error:
+        raise Exception("Erro ao acessar o banco de dados: {}".format(error))
+
+
 def updateMessage(messageID, jsonData):
     """Atualiza uma mensagem específica no banco de dados
 
+    A avaliação de sentimento é calculada de novo, e a atualização é
+    registrada no registro de alterações.
+
     Args:
         messageID: a id única da mensagem a ser atualizada
         jsonData: a mensagem com os dados atualizados serializados em formato
@@ -103,12 +441,23 @@ def updateMessage(messageID, jsonData):
         houver uma falha ao acessar o banco de dados
     """
     try:
-        message = Mensagem.objects.get(pk=messageID)
         updatedMessage = Mensagem.fromJSON(jsonData)
-        message.status = updatedMessage.status
-        message.texto = updatedMessage.texto
-        message.data = updatedMessage.data
-        message.save()
+        _scoreMessages([updatedMessage])
+        # A mensagem é lida e travada dentro da transação, para que o estado
+        # anterior subtraído do índice de termos seja o que foi substituído
+        with transaction.atomic(), pinToPrimary():
+            message = Mensagem.objects.select_for_update().get(pk=messageID)
+            previous = Mensagem(
+                data=message.data, status=message.status,
+                texto=message.texto)
+            message.status = updatedMessage.status
+            message.texto = updatedMessage.texto
+            message.data = updatedMessage.data
+            message.valorSentimento = updatedMessage.valorSentimento
+            message.versaoLexico = updatedMessage.versaoLexico
+            message.save()
+            Alteracao.fromMessage(Alteracao.ATUALIZADA, message).save()
+            term_index.reindexMessage(previous, message)
     except Mensagem.DoesNotExist:
         raise Exception("Messagem com id {} não existe".format(messageID))
     except ValueError as error:
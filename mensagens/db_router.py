@@ -0,0 +1,169 @@
+import contextvars
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PIN_COOKIE = "mensagens_primario"
+
+_pinnedToPrimary = contextvars.ContextVar("pinnedToPrimary", default=False)
+_readAliases = contextvars.ContextVar("readAliases", default=None)
+
+
+@contextmanager
+def pinToPrimary():
+    """Envia todas as leituras feitas dentro do bloco para o banco de dados
+    principal
+
+    Usado quando as leituras precisam ver escritas recentes, que talvez
+    ainda não tenham chegado às réplicas.
+    """
+    token = _pinnedToPrimary.set(True)
+    try:
+        yield
+    finally:
+        _pinnedToPrimary.reset(token)
+
+
+@contextmanager
+def trackReads():
+    """Registra os bancos de dados usados pelas leituras feitas dentro do
+    bloco
+
+    Returns:
+        o conjunto com os aliases dos bancos de dados lidos, preenchido
+        enquanto o bloco executa
+    """
+    aliases = set()
+    token = _readAliases.set(aliases)
+    try:
+        yield aliases
+    finally:
+        _readAliases.reset(token)
+
+
+def isPinnedRequest(request):
+    """Verifica se o cookie do request ainda fixa as leituras do cliente no
+    banco de dados principal"""
+    pinnedUntil = request.COOKIES.get(PIN_COOKIE)
+    try:
+        return pinnedUntil is not None and float(pinnedUntil) > time.time()
+    except ValueError:
+        return False
+
+
+class ReadReplicaRouter():
+    '''Roteador de banco de dados com réplicas de leitura
+
+    As escritas vão sempre para o banco de dados principal. As leituras são
+    distribuídas em round-robin entre as réplicas de
+    settings.DATABASE_READ_REPLICAS que estiverem saudáveis, exceto dentro de
+    pinToPrimary. Sem réplicas saudáveis, as leituras vão para o banco de
+    dados principal.
+
+    Uma réplica é saudável quando responde a healthCheckQuery, que lê a
+    tabela de mensagens. Só abrir a conexão não basta, pois o SQLite cria um
+    banco de dados vazio quando o arquivo não existe.
+
+    Attributes:
+        healthCheckInterval: por quantos segundos o resultado da verificação
+        de saúde de uma réplica é reaproveitado
+        healthCheckQuery: a consulta feita para verificar uma réplica
+    '''
+    healthCheckInterval = 5
+    healthCheckQuery = "SELECT 1 FROM mensagens_mensagem LIMIT 1"
+
+    def __init__(self):
+        self._counter = itertools.count()
+        self._health = {}
+        self._lock = threading.Lock()
+
+    def db_for_read(self, model, **hints):
+        alias = self._chooseReplica()
+        aliases = _readAliases.get()
+        if aliases is not None:
+            aliases.add(alias)
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return True
+
+    def _chooseReplica(self):
+        if _pinnedToPrimary.get():
+            return DEFAULT_DB_ALIAS
+        replicas = settings.DATABASE_READ_REPLICAS
+        for _ in range(len(replicas)):
+            replica = replicas[next(self._counter) % len(replicas)]
+            if self._isHealthy(replica):
+                return replica
+        return DEFAULT_DB_ALIAS
+
+    def _isHealthy(self, alias):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._health.get(alias)
+            if cached is not None and now - cached[1] < \
+                    self.healthCheckInterval:
+                return cached[0]
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute(self.healthCheckQuery)
+                cursor.fetchall()
+            healthy = True
+        except Exception:
+            healthy = False
+        with self._lock:
+            self._health[alias] = (healthy, now)
+        return healthy
+
+
+class ReadYourWritesMiddleware():
+    '''Garante que um cliente lê as próprias escritas
+
+    Depois de um request de escrita bem sucedido, o cliente recebe um cookie
+    que fixa as suas leituras no banco de dados principal por
+    settings.READ_YOUR_WRITES_SECONDS segundos, tempo suficiente para que as
+    réplicas recebam a escrita.
+    '''
+    safeMethods = ("GET", "HEAD", "OPTIONS")
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if isPinnedRequest(request) or \
+                request.method not in self.safeMethods:
+            with pinToPrimary():
+                response = self.get_response(request)
+            if response.streaming:
+                response.streaming_content = self._pinnedStream(
+                    response.streaming_content)
+        else:
+            response = self.get_response(request)
+        if request.method not in self.safeMethods and \
+                response.status_code < 400:
+            window = settings.READ_YOUR_WRITES_SECONDS
+            response.set_cookie(
+                PIN_COOKIE, str(time.time() + window), max_age=window,
+                httponly=True, samesite="Lax")
+        return response
+
+    def _pinnedStream(self, content):
+        """Mantém as leituras de uma resposta em streaming no banco de dados
+        principal enquanto ela é gerada"""
+        iterator = iter(content)
+        while True:
+            with pinToPrimary():
+                chunk = next(iterator, None)
+            if chunk is None:
+                return
+            yield chunk
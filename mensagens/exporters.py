@@ -0,0 +1,272 @@
+import csv
+import io
+import json
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+EXPORT_FIELDS = [
+    "id", "status", "data", "texto", "valorSentimento", "sentimento"]
+
+# Colunas com texto livre, que só são exportadas se pedidas explicitamente
+TEXT_FIELDS = ["texto"]
+
+DEFAULT_EXPORT_FIELDS = [
+    field for field in EXPORT_FIELDS if field not in TEXT_FIELDS]
+
+CONTENT_TYPES = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+ACCEPTED_MEDIA_TYPES = {
+    "application/json": "json",
+    "application/x-ndjson": "ndjson",
+    "application/ndjson": "ndjson",
+    "text/csv": "csv",
+    "application/vnd.apache.arrow.stream": "arrow",
+    "application/vnd.apache.parquet": "parquet",
+}
+
+ROWS_PER_CHUNK = 1000
+
+
+def availableFormats():
+    """Retorna os formatos de exportação disponíveis no ambiente atual"""
+    formats = ["json", "ndjson", "csv"]
+    if pyarrow is not None:
+        formats += ["arrow", "parquet"]
+    return formats
+
+
+def negotiateFormat(requestedFormat, accept):
+    """Escolhe o formato de exportação de um request
+
+    args:
+        requestedFormat: o valor do parâmetro "format" da query, ou None
+        accept: o header Accept do request, ou None
+    returns:
+        o nome do formato escolhido. Pelo Accept, é o formato disponível com
+        a maior prioridade (q) maior que zero, ou o primeiro listado entre
+        os de mesma prioridade. Sem nenhum, json
+    raises:
+        ValueError: o formato pedido não existe ou não está disponível
+    """
+    if requestedFormat:
+        if requestedFormat not in availableFormats():
+            raise ValueError(
+                "Formato indisponível: {}".format(requestedFormat))
+        return requestedFormat
+    best = None
+    for mediaRange in (accept or "").split(","):
+        mediaType, _, parameters = mediaRange.partition(";")
+        quality = 1.0
+        for parameter in parameters.split(";"):
+            key, _, value = parameter.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        exportFormat = ACCEPTED_MEDIA_TYPES.get(mediaType.strip().lower())
+        if exportFormat in availableFormats() and quality > 0 and \
+                (best is None or quality > best[1]):
+            best = (exportFormat, quality)
+    return best[0] if best is not None else "json"
+
+
+def parseFields(fields, exportFormat):
+    """Valida a projeção de colunas pedida pelo cliente
+
+    args:
+        fields: lista de colunas separadas por vírgula, ou None
+        exportFormat: o formato de exportação
+    returns:
+        a lista de colunas a serem exportadas. Sem projeção, o formato JSON
+        exporta todas as colunas e os demais omitem as colunas de texto
+    raises:
+        ValueError: alguma das colunas pedidas não existe
+    """
+    if not fields:
+        if exportFormat == "json":
+            return list(EXPORT_FIELDS)
+        return list(DEFAULT_EXPORT_FIELDS)
+    projection = [field.strip() for field in fields.split(",")]
+    unknownFields = [f for f in projection if f not in EXPORT_FIELDS]
+    if unknownFields:
+        raise ValueError(
+            "Colunas desconhecidas: {}".format(", ".join(unknownFields)))
+    return projection
+
+
+def toNDJSONLine(row, fields=EXPORT_FIELDS):
+    """Serializa uma mensagem avaliada como uma linha NDJSON
+
+    args:
+        row: dicionário com a mensagem e sua avaliação de sentimento
+        fields: as colunas que devem ser incluídas
+    returns:
+        uma string JSON terminada por uma quebra de linha
+    """
+    return json.dumps({field: row[field] for field in fields}) + "\n"
+
+
+def toCSVLine(row, fields=EXPORT_FIELDS):
+    """Serializa uma mensagem avaliada como uma linha CSV
+
+    args:
+        row: dicionário com a mensagem e sua avaliação de sentimento, ou
+        None para gerar o cabeçalho
+        fields: as colunas que devem ser incluídas
+    returns:
+        uma linha CSV terminada por uma quebra de linha
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if row is None:
+        writer.writerow(fields)
+    else:
+        writer.writerow([row[field] for field in fields])
+    return buffer.getvalue()
+
+
+def streamExport(rows, exportFormat, fields, fractionalScores=False):
+    """Serializa mensagens avaliadas de forma incremental
+
+    args:
+        rows: iterável de dicionários com as mensagens e suas avaliações
+        exportFormat: um dos formatos de availableFormats()
+        fields: as colunas que devem ser incluídas
+        fractionalScores: se True, valorSentimento pode ser fracionário e é
+        exportado como ponto flutuante nos formatos arrow e parquet
+    returns:
+        um gerador de blocos de bytes no formato pedido
+    """
+    streams = {
+        "json": _streamJSON,
+        "ndjson": _streamNDJSON,
+        "csv": _streamCSV,
+        "arrow": _streamArrow,
+        "parquet": _streamParquet,
+    }
+    if exportFormat in ("arrow", "parquet"):
+        return streams[exportFormat](rows, fields, fractionalScores)
+    return streams[exportFormat](rows, fields)
+
+
+def _chunked(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == ROWS_PER_CHUNK:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _streamJSON(rows, fields):
+    separator = "["
+    for chunk in _chunked(rows):
+        yield (separator + ", ".join(
+            json.dumps({field: row[field] for field in fields})
+            for row in chunk)).encode("utf-8")
+        separator = ", "
+    yield b"[]" if separator == "[" else b"]"
+
+
+def _streamNDJSON(rows, fields):
+    for chunk in _chunked(rows):
+        yield "".join(toNDJSONLine(row, fields) for row in chunk).encode(
+            "utf-8")
+
+
+def _streamCSV(rows, fields):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(fields)
+    for chunk in _chunked(rows):
+        writer.writerows([row[field] for field in fields] for row in chunk)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+class _ChunkSink(io.RawIOBase):
+    """Arquivo em memória que entrega o que foi escrito em blocos, para que
+    os escritores do pyarrow possam ser transmitidos em streaming"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def _arrowSchema(fields, fractionalScores):
+    types = {
+        "id": pyarrow.string(),
+        "status": pyarrow.string(),
+        "data": pyarrow.date32(),
+        "texto": pyarrow.string(),
+        "valorSentimento": (
+            pyarrow.float64() if fractionalScores else pyarrow.int64()),
+        "sentimento": pyarrow.string(),
+    }
+    return pyarrow.schema([(field, types[field]) for field in fields])
+
+
+def _arrowBatch(chunk, schema):
+    columns = []
+    for field in schema:
+        values = [row[field.name] for row in chunk]
+        if field.name == "id":
+            values = [str(value) for value in values]
+        if field.name == "data":
+            columns.append(pyarrow.array(values).cast(field.type))
+        else:
+            columns.append(pyarrow.array(values, type=field.type))
+    return pyarrow.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def _streamArrow(rows, fields, fractionalScores):
+    schema = _arrowSchema(fields, fractionalScores)
+    sink = _ChunkSink()
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        for chunk in _chunked(rows):
+            writer.write_batch(_arrowBatch(chunk, schema))
+            yield sink.drain()
+    yield sink.drain()
+
+
+def _streamParquet(rows, fields, fractionalScores):
+    schema = _arrowSchema(fields, fractionalScores)
+    sink = _ChunkSink()
+    with pyarrow.parquet.ParquetWriter(sink, schema) as writer:
+        for chunk in _chunked(rows):
+            writer.write_batch(_arrowBatch(chunk, schema))
+            yield sink.drain()
+    yield sink.drain()
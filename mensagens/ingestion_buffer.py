@@ -0,0 +1,269 @@
+import atexit
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import connections
+
+from . import database_handler as dbHandler
+from .db_router import pinToPrimary
+from .models import Mensagem
+
+
+class IngestionBufferFull(Exception):
+    """A fila de ingestão não tem espaço para as mensagens"""
+
+
+class DuplicateMessageID(Exception):
+    """A id de uma mensagem já pertence a uma mensagem gravada ou na fila"""
+
+
+class _Entry():
+    """Mensagens recebidas em um mesmo request"""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.ids = []
+        self.done = threading.Event()
+        self.error = None
+
+
+class IngestionBuffer():
+    '''Fila de ingestão de mensagens com group commit
+
+    As mensagens recebidas são guardadas em uma fila limitada na memória e
+    gravadas no banco de dados em lotes, com uma única transação por lote,
+    por uma thread em segundo plano. Um lote é gravado quando atinge
+    batchSize mensagens ou quando flushInterval segundos se passam. Caso a
+    gravação do lote falhe, as mensagens de cada request são gravadas
+    separadamente, e só os requests com mensagens que não puderam ser
+    gravadas recebem o erro.
+
+    Com settings.IDEMPOTENT_INSERT, uma mensagem com o mesmo conteúdo de
+    outra que ainda está na fila, ou já gravada, recebe a id já atribuída e
+    não é colocada na fila de novo.
+
+    Attributes:
+        maxSize: quantas mensagens a fila aceita antes de recusar novas
+        batchSize: quantas mensagens são gravadas por transação, no máximo
+        flushInterval: quantos segundos uma mensagem espera na fila, no
+        máximo, antes de ser gravada
+        enqueueTimeout: quantos segundos um request espera por espaço na
+        fila antes de ser recusado
+    '''
+
+    def __init__(self, maxSize, batchSize, flushInterval, enqueueTimeout,
+                 autoStart=True):
+        self.maxSize = maxSize
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.enqueueTimeout = enqueueTimeout
+        self.autoStart = autoStart
+        self._entries = deque()
+        self._pending = 0
+        self._inFlight = {}
+        self._queuedIDs = set()
+        self._condition = threading.Condition()
+        self._flushLock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+
+    def submit(self, messages, synchronous=False, checkIDs=False):
+        """Adiciona mensagens validadas à fila
+
+        Args:
+            messages: uma lista de Mensagens
+            synchronous: se True, só retorna depois que as mensagens forem
+            gravadas no banco de dados
+            checkIDs: se True, recusa as mensagens caso alguma id já
+            pertença a uma mensagem gravada ou na fila. Usado quando as ids
+            foram enviadas pelo cliente
+        Returns:
+            a lista com as ids atribuídas às mensagens. Com
+            settings.IDEMPOTENT_INSERT, as mensagens repetidas de outras que
+            ainda estão na fila, ou já gravadas, recebem a id delas
+        Raises:
+            IngestionBufferFull: a fila continuou cheia por mais de
+            enqueueTimeout segundos
+            DuplicateMessageID: alguma id já pertence a outra mensagem
+            Exception: no modo síncrono, a gravação das mensagens falhou
+        """
+        if len(messages) > self.maxSize:
+            raise IngestionBufferFull(
+                "O request tem mais mensagens do que a fila de ingestão "
+                "comporta")
+        deduplicate = settings.IDEMPOTENT_INSERT
+        for message in messages:
+            message.hashConteudo = Mensagem.contentHash(
+                message.data, message.texto)
+        with self._condition:
+            hasSpace = self._condition.wait_for(
+                lambda: self._pending + len(messages) <= self.maxSize,
+                timeout=self.enqueueTimeout)
+            if not hasSpace:
+                raise IngestionBufferFull(
+                    "A fila de ingestão está cheia. Tente novamente mais "
+                    "tarde")
+            if checkIDs:
+                self._checkIDs(messages)
+            # As mensagens só deixam _inFlight depois de gravadas, então
+            # cada hash está em _inFlight ou já é encontrado pela consulta
+            known = dbHandler.findMessagesByContent([
+                message.hashConteudo for message in messages
+                if message.hashConteudo not in self._inFlight]) \
+                if deduplicate else {}
+            entry = _Entry([])
+            waitFor = [entry]
+            for message in messages:
+                inFlight = self._inFlight.get(message.hashConteudo) \
+                    if deduplicate else None
+                if inFlight is not None:
+                    message.id = inFlight[0]
+                    waitFor.append(inFlight[1])
+                    continue
+                if message.hashConteudo in known:
+                    message.id = known[message.hashConteudo]
+                    continue
+                entry.messages.append(message)
+                entry.ids.append(message.id)
+                if deduplicate:
+                    self._inFlight[message.hashConteudo] = (
+                        message.id, entry)
+            if entry.messages:
+                self._queuedIDs.update(entry.ids)
+                self._entries.append(entry)
+                self._pending += len(entry.messages)
+                self._condition.notify_all()
+            else:
+                entry.done.set()
+        if synchronous:
+            for waited in waitFor:
+                while not waited.done.is_set():
+                    self.flush()
+                if waited.error is not None:
+                    raise Exception(
+                        "Erro ao gravar mensagens: {}".format(waited.error))
+        elif self.autoStart:
+            self.start()
+        return [message.id for message in messages]
+
+    def flush(self):
+        """Grava no banco de dados o próximo lote de mensagens da fila
+
+        Returns:
+            quantas mensagens foram retiradas da fila
+        """
+        with self._flushLock:
+            entries = []
+            count = 0
+            with self._condition:
+                while self._entries and count < self.batchSize:
+                    entry = self._entries.popleft()
+                    entries.append(entry)
+                    count += len(entry.messages)
+                self._pending -= count
+                self._condition.notify_all()
+            if not entries:
+                return 0
+            try:
+                dbHandler.insertMessages(
+                    [message for entry in entries
+                     for message in entry.messages])
+            except Exception as error:
+                # Uma mensagem inválida desfaz o lote inteiro, então cada
+                # request é gravado na sua própria transação para que só os
+                # que falham recebam o erro
+                logging.error(error)
+                for entry in entries:
+                    try:
+                        dbHandler.insertMessages(entry.messages)
+                    except Exception as entryError:
+                        logging.error(entryError)
+                        entry.error = entryError
+            # As mensagens já gravadas passam a ser encontradas no banco de
+            # dados
+            with self._condition:
+                for entry in entries:
+                    self._queuedIDs.difference_update(entry.ids)
+                    for message in entry.messages:
+                        inFlight = self._inFlight.get(message.hashConteudo)
+                        if inFlight is not None and inFlight[1] is entry:
+                            del self._inFlight[message.hashConteudo]
+            for entry in entries:
+                entry.done.set()
+            return count
+
+    def _checkIDs(self, messages):
+        """Verifica, com a fila travada, que nenhuma id já pertence a uma
+        mensagem na fila ou gravada, inclusive as removidas"""
+        ids = [message.id for message in messages]
+        duplicates = self._queuedIDs.intersection(ids)
+        if len(set(ids)) < len(ids):
+            duplicates.update(
+                messageID for messageID in ids if ids.count(messageID) > 1)
+        if not duplicates:
+            # As mensagens só deixam a fila depois de gravadas, então a
+            # consulta vê as que saíram da fila desde a verificação acima
+            with pinToPrimary():
+                duplicates.update(Mensagem.todas.filter(
+                    id__in=ids).values_list("id", flat=True))
+        if duplicates:
+            raise DuplicateMessageID(
+                "Já existem mensagens com as ids {}".format(", ".join(
+                    str(messageID.int) for messageID in sorted(duplicates))))
+
+    def start(self):
+        """Inicia a thread que grava os lotes, caso ainda não tenha sido
+        iniciada"""
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._thread = threading.Thread(
+                target=self._run, name="ingestion-buffer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Para a thread de gravação e grava as mensagens restantes"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            thread.join()
+        while self.flush():
+            pass
+
+    def _run(self):
+        try:
+            while not self._stopped:
+                with self._condition:
+                    self._condition.wait_for(
+                        lambda: (self._pending >= self.batchSize or
+                                 self._stopped),
+                        timeout=self.flushInterval)
+                while self.flush() >= self.batchSize:
+                    pass
+        finally:
+            connections.close_all()
+
+
+_ingestionBuffer = None
+_ingestionBufferLock = threading.Lock()
+
+
+def getIngestionBuffer():
+    """Retorna a fila de ingestão do processo, criada com as configurações
+    INGESTION_* do settings"""
+    global _ingestionBuffer
+    with _ingestionBufferLock:
+        if _ingestionBuffer is None:
+            _ingestionBuffer = IngestionBuffer(
+                maxSize=settings.INGESTION_QUEUE_SIZE,
+                batchSize=settings.INGESTION_BATCH_SIZE,
+                flushInterval=settings.INGESTION_FLUSH_INTERVAL,
+                enqueueTimeout=settings.INGESTION_ENQUEUE_TIMEOUT)
+            atexit.register(_ingestionBuffer.stop)
+        return _ingestionBuffer
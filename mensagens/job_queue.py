@@ -0,0 +1,252 @@
+import json
+import os
+import uuid
+from datetime import timedelta
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, Sum
+from django.utils import timezone
+
+from . import archive
+from . import compression
+from .exporters import toCSVLine, toNDJSONLine
+from .message_processor import MessageProcessor
+from .models import AgregadoArquivado, Mensagem, Tarefa
+
+EXPORT_FORMATS = {"ndjson": toNDJSONLine, "csv": toCSVLine}
+
+# Prefixo do cursor de uma exportação que já chegou às mensagens arquivadas,
+# seguido de quantas mensagens arquivadas já foram exportadas
+ARCHIVED_CURSOR = "arquivadas:"
+
+
+def enqueueJob(tipo, parametros=None):
+    """Adiciona uma nova tarefa à fila do worker
+
+    Args:
+        tipo: o tipo da tarefa, "rescore" ou "export"
+        parametros: dicionário com os parâmetros da tarefa. Tarefas "rescore"
+        aceitam "versaoLexico", uma das versões em settings.LEXICOS. Tarefas
+        "export" aceitam "formato", "ndjson" ou "csv"
+    Returns:
+        a Tarefa criada
+    Raises:
+        ValueError: o tipo ou os parâmetros da tarefa não são válidos
+    """
+    parametros = parametros or {}
+    if not isinstance(parametros, dict):
+        raise ValueError("Os parâmetros da tarefa devem ser um objeto JSON")
+    if tipo == "rescore":
+        versaoLexico = parametros.get(
+            "versaoLexico", MessageProcessor.lexiconVersion)
+        if versaoLexico not in settings.LEXICOS:
+            raise ValueError(
+                "Versão do léxico desconhecida: {}".format(versaoLexico))
+        parametros["versaoLexico"] = versaoLexico
+    elif tipo == "export":
+        formato = parametros.get("formato", "ndjson")
+        if formato not in EXPORT_FORMATS:
+            raise ValueError(
+                "Formato de exportação desconhecido: {}".format(formato))
+        parametros["formato"] = formato
+    else:
+        raise ValueError("Tipo de tarefa desconhecido: {}".format(tipo))
+    return Tarefa.objects.create(tipo=tipo, parametros=json.dumps(parametros))
+
+
+def fetchJob(jobID):
+    """Pega uma tarefa específica no banco de dados
+
+    Args:
+        jobID: a id única da tarefa
+    Returns:
+        A tarefa serializada em formato de string JSON
+    Raises:
+        Tarefa.DoesNotExist: uma tarefa com a jobID fornecida não existe
+    """
+    return Tarefa.objects.get(pk=jobID).toJSON()
+
+
+def claimNextJob():
+    """Reserva a próxima tarefa disponível para o worker atual
+
+    Uma tarefa está disponível se estiver pendente, ou se o worker que a
+    executava parou de renovar a reserva dela.
+
+    Returns:
+        a Tarefa reservada, ou None caso a fila esteja vazia
+    """
+    now = timezone.now()
+    available = (
+        Q(status=Tarefa.PENDENTE) |
+        Q(status=Tarefa.EXECUTANDO, bloqueadoAte__lt=now))
+    candidates = Tarefa.objects.filter(available).order_by("id")
+    for jobID in candidates.values_list("id", flat=True)[:10]:
+        claimed = Tarefa.objects.filter(available, pk=jobID).update(
+            status=Tarefa.EXECUTANDO, bloqueadoAte=_leaseDeadline())
+        if claimed:
+            return Tarefa.objects.get(pk=jobID)
+    return None
+
+
+def runJob(job):
+    """Executa uma tarefa reservada, retomando do último ponto confirmado
+
+    Args:
+        job: a Tarefa reservada por claimNextJob
+    Raises:
+        Exception: a tarefa falhou. O erro fica gravado na tarefa
+    """
+    handlers = {"rescore": _rescoreMessages, "export": _exportSentiment}
+    try:
+        handlers[job.tipo](job, json.loads(job.parametros))
+    except Exception as error:
+        job.status = Tarefa.FALHOU
+        job.erro = str(error)
+        job.bloqueadoAte = None
+        job.save()
+        raise Exception(
+            "A tarefa {} falhou: {}".format(job.id, error))
+
+
+def _leaseDeadline():
+    return timezone.now() + timedelta(seconds=settings.JOBS_LEASE_SECONDS)
+
+
+def _messageChunks(job):
+    """Itera sobre as mensagens ainda não processadas pela tarefa, em blocos
+    ordenados pela id"""
+    while True:
+        chunk = Mensagem.objects.order_by("id")
+        if job.cursor:
+            chunk = chunk.filter(id__gt=uuid.UUID(job.cursor))
+        chunk = list(chunk[:settings.JOBS_CHUNK_SIZE])
+        if not chunk:
+            return
+        yield chunk
+
+
+def _exportChunks(job):
+    """Itera sobre as mensagens ainda não exportadas pela tarefa, primeiro
+    as da tabela, em blocos ordenados pela id, e depois as arquivadas, na
+    ordem dos arquivos mensais
+
+    Returns:
+        um gerador de tuplas com o bloco e o cursor gravado depois dele
+    """
+    if not job.cursor.startswith(ARCHIVED_CURSOR):
+        for chunk in _messageChunks(job):
+            yield chunk, chunk[-1].id.hex
+        exported = 0
+    else:
+        exported = int(job.cursor[len(ARCHIVED_CURSOR):])
+    archived = islice(archive.iterArchivedMessages(), exported, None)
+    while True:
+        chunk = list(islice(archived, settings.JOBS_CHUNK_SIZE))
+        if not chunk:
+            return
+        exported += len(chunk)
+        yield chunk, ARCHIVED_CURSOR + str(exported)
+
+
+def _checkpoint(job, chunk, cursor=None):
+    """Grava o progresso da tarefa depois de um bloco processado e renova a
+    reserva do worker. Por padrão o cursor é a id da última mensagem do
+    bloco"""
+    job.progresso += len(chunk)
+    job.cursor = cursor if cursor is not None else chunk[-1].id.hex
+    job.bloqueadoAte = _leaseDeadline()
+    job.save(update_fields=[
+        "progresso", "cursor", "bytesEscritos", "bloqueadoAte",
+        "atualizadoEm"])
+
+
+def _finish(job, resultado):
+    job.status = Tarefa.CONCLUIDO
+    job.resultado = resultado
+    job.bloqueadoAte = None
+    job.save()
+
+
+def _countTotal(job, includeArchived=False):
+    if not job.cursor:
+        job.total = Mensagem.objects.count()
+        if includeArchived:
+            job.total += AgregadoArquivado.objects.aggregate(
+                total=Sum("total"))["total"] or 0
+        job.save(update_fields=["total", "atualizadoEm"])
+
+
+def _rescoreMessages(job, parametros):
+    """Recalcula e grava a avaliação de sentimento de todas as mensagens com
+    a versão do léxico pedida
+
+    O atualizadoEm só muda nas mensagens cujo valor servido pelos endpoints
+    mudou, isto é, as avaliadas de novo com a versão atual do léxico e com
+    um resultado diferente, para que a sincronização incremental não traga
+    de novo mensagens iguais.
+    """
+    versaoLexico = parametros["versaoLexico"]
+    processor = MessageProcessor(
+        wordPolarityFile=settings.LEXICOS[versaoLexico],
+        lexiconVersion=versaoLexico)
+    _countTotal(job)
+    for chunk in _messageChunks(job):
+        scores = processor.analyseSentimentBatch(
+            [message.texto for message in chunk])
+        # bulk_update não atualiza os campos auto_now, então atualizadoEm é
+        # preenchido aqui para que a sincronização incremental veja a nova
+        # avaliação
+        now = timezone.now()
+        for message, score in zip(chunk, scores):
+            if versaoLexico == message.versaoLexico == \
+                    MessageProcessor.lexiconVersion and \
+                    score != message.valorSentimento:
+                message.atualizadoEm = now
+            message.valorSentimento = score
+            message.versaoLexico = versaoLexico
+        with transaction.atomic():
+            Mensagem.objects.bulk_update(
+                chunk, ["valorSentimento", "versaoLexico", "atualizadoEm"])
+            _checkpoint(job, chunk)
+        compression.invalidateCachedResponses()
+    _finish(job, "{} mensagens reavaliadas com o léxico {}".format(
+        job.progresso, versaoLexico))
+
+
+def _exportSentiment(job, parametros):
+    """Exporta as mensagens e suas avaliações de sentimento para um arquivo
+
+    As mensagens arquivadas são exportadas depois das mensagens da tabela,
+    como no endpoint /sentiment. O arquivo é truncado para o último tamanho
+    confirmado antes de continuar, então uma tarefa interrompida nunca gera
+    linhas duplicadas.
+    """
+    formato = parametros["formato"]
+    toLine = EXPORT_FORMATS[formato]
+    os.makedirs(settings.JOBS_EXPORT_DIR, exist_ok=True)
+    path = os.path.join(
+        settings.JOBS_EXPORT_DIR,
+        "sentimento-{}.{}".format(job.id, formato))
+    if not os.path.exists(path):
+        job.cursor = ""
+        job.progresso = 0
+        job.bytesEscritos = 0
+    _countTotal(job, includeArchived=True)
+    processor = MessageProcessor()
+    with open(path, "r+b" if job.bytesEscritos else "wb") as output:
+        output.truncate(job.bytesEscritos)
+        output.seek(job.bytesEscritos)
+        if job.bytesEscritos == 0 and formato == "csv":
+            output.write(toCSVLine(None).encode("utf-8"))
+        for chunk, cursor in _exportChunks(job):
+            lines = "".join(
+                toLine(row) for row in processor.analyseMessages(chunk))
+            output.write(lines.encode("utf-8"))
+            output.flush()
+            os.fsync(output.fileno())
+            job.bytesEscritos = output.tell()
+            _checkpoint(job, chunk, cursor)
+    _finish(job, path)
@@ -0,0 +1,111 @@
+import functools
+import re
+import unicodedata
+
+REPEATED_LETTERS = re.compile(r"(.)\1{2,}")
+
+# Prioridade de cada tipo de variante. Em um conflito, a variante de menor
+# prioridade vence. Variantes de mesma prioridade com polaridades diferentes
+# são descartadas, pois são ambíguas
+EXACT = 0
+LOWERCASED = 1
+FOLDED = 2
+INFLECTED = 3
+FOLDED_INFLECTED = 4
+
+
+@functools.lru_cache(maxsize=65536)
+def foldToken(token):
+    """Normaliza uma palavra removendo acentos e letras repetidas
+
+    Usada para buscar no índice palavras que não foram encontradas na forma
+    original, como "nao" ou "otimooo". O resultado é memorizado, pois as
+    mesmas palavras se repetem muito entre as mensagens.
+
+    args:
+        token: uma palavra em letras minúsculas e sem pontuação
+    returns:
+        a palavra sem acentos e com sequências de três ou mais letras
+        iguais reduzidas a uma
+    """
+    decomposed = unicodedata.normalize("NFKD", token)
+    folded = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return REPEATED_LETTERS.sub(r"\1", folded)
+
+
+def inflections(word):
+    """Gera as formas de plural e feminino de uma palavra do léxico
+
+    Usa as regras regulares de flexão do português. As formas irregulares
+    não são geradas.
+
+    args:
+        word: uma palavra em letras minúsculas
+    returns:
+        um conjunto com as formas flexionadas
+    """
+    forms = set()
+    if word.endswith("ão"):
+        forms.add(word[:-2] + "ões")
+    elif word.endswith("o"):
+        forms.update([word + "s", word[:-1] + "a", word[:-1] + "as"])
+    elif word.endswith(("a", "e", "i", "u", "á", "é", "ê", "í", "ú")):
+        forms.add(word + "s")
+    elif word.endswith("m"):
+        forms.add(word[:-1] + "ns")
+    elif word.endswith(("r", "z")):
+        forms.add(word + "es")
+        if word.endswith("or"):
+            forms.update([word + "a", word + "as"])
+    elif word.endswith("al"):
+        forms.add(word[:-2] + "ais")
+    elif word.endswith("el"):
+        if foldToken(word) != word:
+            forms.add(word[:-2] + "eis")
+        else:
+            forms.add(word[:-2] + "éis")
+    elif word.endswith("ol"):
+        forms.add(word[:-2] + "óis")
+    elif word.endswith("ul"):
+        forms.add(word[:-2] + "uis")
+    elif word.endswith("il"):
+        if foldToken(word) != word:
+            forms.add(word[:-2] + "eis")
+        else:
+            forms.add(word[:-1] + "s")
+    return forms
+
+
+def buildIndex(wordPolarities):
+    """Expande um léxico em um índice com variantes sem acento e flexionadas
+
+    args:
+        wordPolarities: dicionário que atribui uma polaridade a cada palavra
+    returns:
+        um dicionário ordenado com todas as variantes e suas polaridades.
+        Expressões com mais de uma palavra são omitidas, pois a análise de
+        sentimento compara uma palavra por vez
+    """
+    candidates = {}
+
+    def offer(key, priority, polarity):
+        current = candidates.get(key)
+        if current is None or priority < current[0]:
+            candidates[key] = (priority, {polarity})
+        elif priority == current[0]:
+            current[1].add(polarity)
+
+    for word, polarity in wordPolarities.items():
+        if len(word.split()) != 1:
+            continue
+        lowered = word.lower()
+        offer(lowered, EXACT if word == lowered else LOWERCASED, polarity)
+        offer(foldToken(lowered), FOLDED, polarity)
+        for form in inflections(lowered):
+            offer(form, INFLECTED, polarity)
+            offer(foldToken(form), FOLDED_INFLECTED, polarity)
+
+    return {
+        key: polarities.pop()
+        for key, (priority, polarities) in sorted(candidates.items())
+        if len(polarities) == 1}
@@ -0,0 +1,142 @@
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .lexicon_index import buildIndex
+from .message_processor import MessageProcessor
+
+OVERLAY_NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+class LexiconRegistry():
+    '''Registro dos léxicos específicos de cada cliente
+
+    Um overlay é um arquivo JSON pequeno em overlayDir, com o nome do
+    cliente, que atribui novas polaridades a algumas palavras. Uma
+    polaridade null equivale a 0. O léxico base é compartilhado por todos os
+    clientes, então a memória usada por um cliente é proporcional ao tamanho
+    do seu overlay.
+
+    Os overlays compilados ficam em um cache LRU com no máximo maxSize
+    entradas, e são recompilados caso o arquivo seja modificado.
+
+    Attributes:
+        overlayDir: diretório dos arquivos de overlay
+        maxSize: quantos overlays compilados ficam em cache
+    '''
+
+    def __init__(self, overlayDir, maxSize):
+        self.overlayDir = overlayDir
+        self.maxSize = maxSize
+        self._overlays = OrderedDict()
+        self._lock = threading.Lock()
+
+    def getOverlay(self, name):
+        """Retorna as polaridades compiladas do overlay de um cliente
+
+        Args:
+            name: o nome do overlay
+        Returns:
+            um dicionário com as palavras em letras minúsculas, e as suas
+            variantes sem acento e flexionadas, e suas polaridades inteiras,
+            contendo apenas as palavras que mudam a polaridade do léxico base
+        Raises:
+            ValueError: o overlay não existe ou não é válido
+        """
+        if not OVERLAY_NAME.match(name):
+            raise ValueError("Nome de léxico inválido: {}".format(name))
+        path = os.path.join(self.overlayDir, name + ".json")
+        try:
+            modified = os.stat(path).st_mtime_ns
+        except OSError:
+            raise ValueError("Léxico desconhecido: {}".format(name))
+        with self._lock:
+            cached = self._overlays.get(name)
+            if cached is not None and cached[0] == modified:
+                self._overlays.move_to_end(name)
+                return cached[1]
+        overlay = self._compile(path)
+        with self._lock:
+            self._overlays[name] = (modified, overlay)
+            self._overlays.move_to_end(name)
+            while len(self._overlays) > self.maxSize:
+                self._overlays.popitem(last=False)
+        return overlay
+
+    def _compile(self, path):
+        try:
+            with open(path) as source:
+                entries = json.loads(source.read())
+        except Exception as error:
+            raise ValueError(
+                "Falha ao carregar o léxico {}: {}".format(path, error))
+        if not isinstance(entries, dict):
+            raise ValueError(
+                "O léxico {} deve ser um objeto JSON".format(path))
+        base = MessageProcessor().wordPolarities
+        words = {}
+        for word, polarity in entries.items():
+            polarity = polarity or 0
+            if not isinstance(polarity, int) or isinstance(polarity, bool):
+                raise ValueError(
+                    "Polaridade inválida para \"{}\" no léxico {}".format(
+                        word, path))
+            words[word.lower()] = polarity
+        # As palavras são expandidas com as suas variantes sem acento e
+        # flexionadas, como no índice do léxico base. Uma variante só
+        # substitui uma palavra do léxico base que seja variante da mesma
+        # palavra, com a mesma polaridade no léxico base, e não uma palavra
+        # diferente com a mesma grafia, como "cara" para "caro"
+        sources = {}
+        for word, polarity in words.items():
+            for variant in buildIndex({word: polarity}):
+                sources.setdefault(variant, []).append(word)
+        overlay = {}
+        for variant, polarity in buildIndex(words).items():
+            if variant not in words and variant in base and all(
+                    base.get(word) != base[variant]
+                    for word in sources[variant]):
+                continue
+            if base.get(variant, 0) != polarity:
+                overlay[variant] = polarity
+        return overlay
+
+
+_registry = None
+_registryLock = threading.Lock()
+
+
+def getRegistry():
+    """Retorna o registro de léxicos do processo, criado com as
+    configurações LEXICON_OVERLAY_* do settings"""
+    global _registry
+    with _registryLock:
+        if _registry is None:
+            _registry = LexiconRegistry(
+                settings.LEXICON_OVERLAY_DIR,
+                settings.LEXICON_OVERLAY_CACHE_SIZE)
+        return _registry
+
+
+def getMessageProcessor(overlayName=None, sentimentMode=None):
+    """Cria um MessageProcessor com o léxico de um cliente
+
+    Args:
+        overlayName: o nome do overlay do cliente, ou None para o léxico base
+        sentimentMode: o modo de análise de sentimento
+    Returns:
+        o MessageProcessor
+    Raises:
+        ValueError: o overlay ou o modo não existem
+    """
+    if not overlayName:
+        return MessageProcessor(sentimentMode=sentimentMode)
+    return MessageProcessor(
+        lexiconVersion="{}+{}".format(
+            MessageProcessor.lexiconVersion, overlayName),
+        sentimentMode=sentimentMode,
+        overlayPolarities=getRegistry().getOverlay(overlayName))
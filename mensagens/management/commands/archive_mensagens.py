@@ -0,0 +1,38 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mensagens import archive
+from mensagens import database_handler as dbHandler
+
+
+class Command(BaseCommand):
+    help = ("Move as mensagens anteriores a uma data para arquivos mensais "
+            "comprimidos, mantendo os agregados de sentimento de cada mês, "
+            "e apaga as mensagens removidas e as entradas do registro de "
+            "alterações anteriores aos seus horizontes de retenção")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--before", required=True, type=date.fromisoformat,
+            help="Arquiva as mensagens com data anterior a essa (YYYY-mm-dd)")
+        parser.add_argument(
+            "--formato", default="ndjson", choices=archive.ARCHIVE_FORMATS,
+            help="Formato dos arquivos mensais")
+        parser.add_argument(
+            "--lote", type=int, default=1000,
+            help="Quantas mensagens são movidas por transação")
+
+    def handle(self, *args, **options):
+        try:
+            archived = archive.archiveMessages(
+                options["before"], options["formato"], options["lote"])
+        except ValueError as error:
+            raise CommandError(error)
+        self.stdout.write("{} mensagens arquivadas".format(archived))
+        purged = dbHandler.purgeRemovedMessages(options["lote"])
+        self.stdout.write("{} mensagens removidas apagadas".format(purged))
+        purged = dbHandler.purgeOldChanges(options["lote"])
+        self.stdout.write(
+            "{} entradas antigas do registro de alterações apagadas".format(
+                purged))
@@ -0,0 +1,62 @@
+import csv
+import json
+import timeit
+import uuid
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from mensagens import compression
+from mensagens.message_processor import MessageProcessor
+from mensagens.models import Mensagem
+
+# Níveis comparados de cada algoritmo, do mais rápido ao mais compacto
+LEVELS = {
+    "gzip": [1, 4, 6, 9],
+    "br": [1, 3, 5, 9, 11],
+    "zstd": [1, 3, 6, 12, 19],
+}
+
+
+class Command(BaseCommand):
+    help = ("Compara o custo de CPU de cada algoritmo e nível de compressão "
+            "com os bytes economizados nas respostas da API")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--repeticoes", type=int, default=200,
+            help="Quantas vezes as mensagens iniciais são repetidas")
+
+    def handle(self, *args, **options):
+        with open("mensagens/migrations/dados_iniciais.csv",
+                  newline='') as csvFile:
+            rows = list(csv.DictReader(csvFile))
+        # Cada cópia recebe uma id nova, como nas respostas reais
+        messages = [
+            Mensagem(
+                id=uuid.uuid4(), data=date.fromisoformat(row["Data"]),
+                status=row["Status"], texto=row["Mensagem"])
+            for _ in range(options["repeticoes"]) for row in rows]
+        bodies = {
+            "/mensagens/": json.dumps(
+                [message.toDict() for message in messages]).encode("utf-8"),
+            "/mensagens/sentiment/": MessageProcessor()
+            .processMessagesSentiment(messages).encode("utf-8"),
+        }
+
+        for path, body in bodies.items():
+            self.stdout.write("{}: {} bytes".format(path, len(body)))
+            for encoding in compression.availableEncodings():
+                for level in LEVELS[encoding]:
+                    compressed = compression.compressBytes(
+                        body, encoding, level)
+                    seconds = min(timeit.repeat(
+                        lambda: compression.compressBytes(
+                            body, encoding, level),
+                        number=1, repeat=3))
+                    self.stdout.write(
+                        "  {} nível {}: {:.2f} ms, {} bytes ({:.1%} "
+                        "economizados), {:.0f} MB/s".format(
+                            encoding, level, seconds * 1e3, len(compressed),
+                            1 - len(compressed) / len(body),
+                            len(body) / seconds / 1e6))
@@ -0,0 +1,43 @@
+import csv
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mensagens.message_processor import MessageProcessor
+
+
+class Command(BaseCommand):
+    help = ("Compara o custo da análise de sentimento do modo \"regras\" "
+            "com o modo \"simples\"")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--repeticoes", type=int, default=200,
+            help="Quantas vezes as mensagens iniciais são repetidas")
+        parser.add_argument(
+            "--limite", type=float, default=1.25,
+            help="Razão máxima aceita entre o tempo do modo \"regras\" e o "
+                 "do modo \"simples\"")
+
+    def handle(self, *args, **options):
+        with open("mensagens/migrations/dados_iniciais.csv",
+                  newline='') as csvFile:
+            texts = [row["Mensagem"] for row in csv.DictReader(csvFile)]
+        texts = texts * options["repeticoes"]
+
+        timings = {}
+        for mode in MessageProcessor.sentimentModes:
+            messageProcessor = MessageProcessor(sentimentMode=mode)
+            timings[mode] = min(timeit.repeat(
+                lambda: [messageProcessor.analyseSentiment(t) for t in texts],
+                number=1, repeat=5))
+            self.stdout.write("{}: {:.2f} µs por mensagem".format(
+                mode, timings[mode] / len(texts) * 1e6))
+
+        ratio = timings["regras"] / timings["simples"]
+        self.stdout.write("Custo relativo do modo regras: {:.2f}x".format(
+            ratio))
+        if ratio > options["limite"]:
+            raise CommandError(
+                "O modo regras excedeu o limite de {:.2f}x".format(
+                    options["limite"]))
@@ -0,0 +1,29 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from mensagens.lexicon_index import buildIndex
+
+
+class Command(BaseCommand):
+    help = ("Expande o léxico em um índice com as variantes sem acento e "
+            "flexionadas de cada palavra")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--lexico",
+            default="mensagens/assets/pt_word_sentiment_polarity.json",
+            help="Arquivo JSON do léxico a ser expandido")
+        parser.add_argument(
+            "--saida",
+            default="mensagens/assets/pt_word_sentiment_index.json",
+            help="Arquivo JSON onde o índice é gravado")
+
+    def handle(self, *args, **options):
+        with open(options["lexico"]) as source:
+            wordPolarities = json.loads(source.read())
+        index = buildIndex(wordPolarities)
+        with open(options["saida"], "w") as output:
+            output.write(json.dumps(index))
+        self.stdout.write("{} palavras do léxico expandidas em {} "
+                          "variantes".format(len(wordPolarities), len(index)))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from mensagens.db_router import pinToPrimary
+from mensagens.term_index import rebuildTermIndex
+
+
+class Command(BaseCommand):
+    help = ("Recria o índice de termos usado por /mensagens/sentiment/terms/ "
+            "a partir de todas as mensagens")
+
+    def handle(self, *args, **options):
+        with pinToPrimary():
+            rows = rebuildTermIndex()
+        self.stdout.write("Índice de termos recriado com {} linhas".format(
+            rows))
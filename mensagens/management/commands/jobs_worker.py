@@ -0,0 +1,43 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from mensagens import job_queue
+from mensagens.db_router import pinToPrimary
+
+
+class Command(BaseCommand):
+    help = "Executa as tarefas em segundo plano da fila de tarefas"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once", action="store_true",
+            help="Sai assim que a fila estiver vazia")
+        parser.add_argument(
+            "--intervalo", type=float, default=2.0,
+            help="Segundos de espera quando a fila está vazia")
+
+    def handle(self, *args, **options):
+        # As tarefas gravam seu progresso e releem o que gravaram, então não
+        # podem ler de réplicas atrasadas
+        with pinToPrimary():
+            self.work(options)
+
+    def work(self, options):
+        while True:
+            job = job_queue.claimNextJob()
+            if job is None:
+                if options["once"]:
+                    return
+                time.sleep(options["intervalo"])
+                continue
+            self.stdout.write("Executando tarefa {} ({})".format(
+                job.id, job.tipo))
+            try:
+                job_queue.runJob(job)
+            except Exception as error:
+                logging.error(error)
+                continue
+            self.stdout.write("Tarefa {} concluída: {}".format(
+                job.id, job.resultado))
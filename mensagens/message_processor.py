@@ -1,5 +1,36 @@
 import json
 import string
+import threading
+from itertools import repeat
+
+from .lexicon_index import foldToken
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_lexicons = {}
+_vectorizedLexicons = {}
+_lexiconsLock = threading.Lock()
+
+
+def loadWordPolarities(wordPolarityFile):
+    """Carrega um arquivo de léxico uma única vez por processo
+
+    O dicionário retornado é compartilhado por todos os MessageProcessor que
+    usam o mesmo arquivo, e não deve ser modificado.
+
+    args:
+        wordPolarityFile: caminho do arquivo JSON do léxico
+    returns:
+        um dicionário que atribui uma polaridade a cada palavra
+    """
+    with _lexiconsLock:
+        if wordPolarityFile not in _lexicons:
+            with open(wordPolarityFile) as source:
+                _lexicons[wordPolarityFile] = json.loads(source.read())
+        return _lexicons[wordPolarityFile]
 
 
 class MessageProcessor():
@@ -11,15 +42,65 @@ class MessageProcessor():
     Attributes:
         wordPolarity: dicionário extraído do SentiLex-PT-02. Atribui uma
         polaridade a palabvras da língua portuguesa. As polaridades podem ser
-        negativo (-1), neutro (0), positivo (1)
+        negativo (-1), neutro (0), positivo (1). Por padrão é carregado do
+        índice gerado pelo comando build_lexicon_index, que inclui as
+        variantes sem acento e flexionadas de cada palavra
+        foldTokens: se True, palavras não encontradas no léxico são
+        buscadas de novo sem acentos e sem letras repetidas
+        lexiconVersion: identifica a versão do léxico carregado. É gravada
+        junto das avaliações pré-calculadas das mensagens
+        vectorizedBatchSize: a partir de quantos textos analyseSentimentBatch
+        usa o algoritmo vetorizado com NumPy, caso ele esteja instalado
+        sentimentMode: o algoritmo de análise de sentimento. "simples" soma
+        as polaridades das palavras. "regras" também inverte a polaridade
+        das palavras que seguem uma negação e multiplica a polaridade das
+        palavras que seguem um intensificador
+        negators: palavras que invertem a polaridade das próximas palavras
+        no modo "regras"
+        negationWindow: quantas palavras depois de uma negação têm a
+        polaridade invertida
+        intensifiers: palavras que multiplicam a polaridade da próxima
+        palavra no modo "regras", e o fator de multiplicação
+        clauseBreaks: pontuação que encerra o efeito de uma negação
+        overlayPolarities: polaridades que substituem as do léxico base,
+        usadas por léxicos específicos de um cliente, já expandidas com as
+        variantes de cada palavra. Ver lexicon_registry
     '''
-    wordPolarityFile = "mensagens/assets/pt_word_sentiment_polarity.json"
+    wordPolarityFile = "mensagens/assets/pt_word_sentiment_index.json"
+    lexiconVersion = "v2"
+    foldTokens = True
+    vectorizedBatchSize = 256
     wordPolarities = {}
+    punctuationTable = str.maketrans('', '', string.punctuation)
+    sentimentModes = ("simples", "regras")
+    sentimentMode = "simples"
+    negators = frozenset(["não", "nao", "nunca", "jamais"])
+    negationWindow = 3
+    intensifiers = {
+        "muito": 2,
+        "bastante": 2,
+        "extremamente": 2,
+        "super": 2,
+        "pouco": 0.5,
+        "meio": 0.5,
+    }
+    clauseBreaks = frozenset(".,;:!?")
 
-    def __init__(self):
-        with open(self.wordPolarityFile) as source:
-            polarities = source.read()
-            self.wordPolarities = json.loads(polarities)
+    def __init__(self, wordPolarityFile=None, lexiconVersion=None,
+                 sentimentMode=None, overlayPolarities=None):
+        if wordPolarityFile is not None:
+            self.wordPolarityFile = wordPolarityFile
+        if lexiconVersion is not None:
+            self.lexiconVersion = lexiconVersion
+        if sentimentMode is not None:
+            if sentimentMode not in self.sentimentModes:
+                raise ValueError(
+                    "Modo de análise de sentimento desconhecido: {}".format(
+                        sentimentMode))
+            self.sentimentMode = sentimentMode
+        self.wordPolarities = loadWordPolarities(self.wordPolarityFile)
+        self.overlayPolarities = overlayPolarities or {}
+        self._overlayArrays = None
 
     def analyseSentiment(self, text):
         '''Implementa um algoritimo básico de análise de sentimento de textos
@@ -31,19 +112,286 @@ class MessageProcessor():
             Números positivos indicam que o texto provavelmente é positivo,
             números negativos indicam que o texto provavelmente é negativo,
             0 indica que o texto provavelmente é neutro. O valor absoluto
-            a intensidade do sentimento que o texto expressa.
+            a intensidade do sentimento que o texto expressa. No modo
+            "regras" o valor pode ser fracionário.
         '''
+        if self.sentimentMode == "regras":
+            return self._analyseSentimentWithRules(text)
         words = text.split()
         textSentiment = 0
         for word in words:
-            striptedWord = word.translate(
-                str.maketrans('', '', string.punctuation)).lower()
-            wordPolarity = 0
-            if striptedWord in self.wordPolarities:
-                wordPolarity = self.wordPolarities[striptedWord]
-            textSentiment = textSentiment + wordPolarity
+            striptedWord = word.translate(self.punctuationTable).lower()
+            textSentiment = textSentiment + self._findTerm(striptedWord)[1]
+        return textSentiment
+
+    def _findTerm(self, word):
+        """Busca uma palavra no overlay e no léxico base, nessa ordem, e
+        depois a sua forma normalizada, também no overlay e no léxico base
+
+        args:
+            word: uma palavra em letras minúsculas e sem pontuação
+        returns:
+            uma tupla com a forma da palavra encontrada e a sua polaridade,
+            ou 0 caso ela não seja encontrada
+        """
+        overlay = self.overlayPolarities
+        if word in overlay:
+            return word, overlay[word]
+        if word in self.wordPolarities:
+            return word, self.wordPolarities[word]
+        if not self.foldTokens:
+            return word, 0
+        folded = foldToken(word)
+        if folded in overlay:
+            return folded, overlay[folded]
+        return folded, self.wordPolarities.get(folded, 0)
+
+    def termPolarities(self, text):
+        """Encontra as palavras de um texto que contribuem para a sua
+        avaliação de sentimento no modo "simples"
+
+        args:
+            text: Texto em língua portuguesa a ser analisado
+        returns:
+            um dicionário com a polaridade e o número de ocorrências de cada
+            termo com polaridade diferente de 0. O termo é a forma da palavra
+            encontrada no léxico
+        """
+        terms = {}
+        for word in text.split():
+            term, wordPolarity = self._findTerm(
+                word.translate(self.punctuationTable).lower())
+            if wordPolarity:
+                occurrences = terms.get(term, (wordPolarity, 0))[1]
+                terms[term] = (wordPolarity, occurrences + 1)
+        return terms
+
+    def _analyseSentimentWithRules(self, text):
+        '''Análise de sentimento do modo "regras"
+
+        Percorre as palavras uma única vez, guardando como estado quantas
+        palavras ainda estão sob efeito de uma negação e o fator de
+        intensidade acumulado para a próxima palavra. Negações e
+        intensificadores não têm polaridade própria.
+        '''
+        findTerm = self._findTerm
+        negators = self.negators
+        intensifiers = self.intensifiers
+        clauseBreaks = self.clauseBreaks
+        punctuationTable = self.punctuationTable
+        textSentiment = 0
+        negationLeft = 0
+        multiplier = 1
+        for word in text.split():
+            striptedWord = word.translate(punctuationTable).lower()
+            if striptedWord in negators:
+                negationLeft = self.negationWindow
+                multiplier = 1
+            elif striptedWord in intensifiers:
+                multiplier *= intensifiers[striptedWord]
+            else:
+                wordPolarity = findTerm(striptedWord)[1]
+                if negationLeft:
+                    wordPolarity = -wordPolarity
+                    negationLeft -= 1
+                textSentiment += wordPolarity * multiplier
+                multiplier = 1
+            if word[-1] in clauseBreaks:
+                negationLeft = 0
+                multiplier = 1
         return textSentiment
 
+    def analyseSentimentBatch(self, texts):
+        '''Analisa o sentimento de vários textos de uma vez
+
+        No modo "simples", para lotes com pelo menos vectorizedBatchSize
+        textos e com o NumPy instalado, usa um algoritmo vetorizado. Os
+        resultados são sempre os mesmos de analyseSentiment.
+
+        args:
+            texts: lista de textos em língua portuguesa
+        returns:
+            uma lista com o valor de sentimento de cada texto, na mesma ordem
+        '''
+        vectorized = (
+            numpy is not None and self.sentimentMode == "simples" and
+            len(texts) >= self.vectorizedBatchSize)
+        if vectorized:
+            return self._analyseSentimentVectorized(texts)
+        return [self.analyseSentiment(text) for text in texts]
+
+    def _vectorizedLexicon(self):
+        """Constrói o vocabulário que mapeia cada palavra do léxico base
+        para uma id inteira, e o array de polaridades indexado por essas
+        ids. A id 0 é reservada para palavras fora do léxico. São
+        construídos uma vez por arquivo de léxico e compartilhados"""
+        with _lexiconsLock:
+            if self.wordPolarityFile not in _vectorizedLexicons:
+                vocabulary = {
+                    word: wordID
+                    for wordID, word in enumerate(
+                        self.wordPolarities, start=1)}
+                polarityArray = numpy.zeros(
+                    len(self.wordPolarities) + 1, dtype=numpy.int8)
+                polarityArray[1:] = numpy.fromiter(
+                    self.wordPolarities.values(), dtype=numpy.int8,
+                    count=len(self.wordPolarities))
+                _vectorizedLexicons[self.wordPolarityFile] = (
+                    vocabulary, polarityArray)
+            return _vectorizedLexicons[self.wordPolarityFile]
+
+    def _vectorizedOverlay(self):
+        """Constrói o vocabulário e o array de polaridades das palavras do
+        overlay, da mesma forma que _vectorizedLexicon. São construídos uma
+        vez por MessageProcessor, pois o overlay é pequeno"""
+        if self._overlayArrays is None:
+            vocabulary = {
+                word: wordID
+                for wordID, word in enumerate(self.overlayPolarities, start=1)}
+            polarityArray = numpy.zeros(len(vocabulary) + 1, dtype=numpy.int64)
+            polarityArray[1:] = numpy.fromiter(
+                self.overlayPolarities.values(), dtype=numpy.int64,
+                count=len(vocabulary))
+            self._overlayArrays = (vocabulary, polarityArray)
+        return self._overlayArrays
+
+    def _analyseSentimentVectorized(self, texts):
+        """Versão vetorizada de analyseSentimentBatch
+
+        Mapeia todas as palavras do lote para ids do vocabulário, busca as
+        polaridades no array e soma as polaridades de cada texto com
+        numpy.add.reduceat. As palavras do overlay, quando houver, são
+        mapeadas para ids de um segundo vocabulário, e as suas polaridades
+        substituem as do léxico base com numpy.where. As palavras que não
+        estão em nenhum dos dois são buscadas de novo pela forma
+        normalizada, na mesma ordem de _findTerm.
+        """
+        if len(texts) == 0:
+            return []
+        vocabulary, polarityArray = self._vectorizedLexicon()
+        words = []
+        starts = numpy.empty(len(texts), dtype=numpy.int64)
+        for index, text in enumerate(texts):
+            starts[index] = len(words)
+            text = text.translate(self.punctuationTable).lower()
+            words.extend(text.split())
+        wordIDs = numpy.zeros(len(words) + 1, dtype=numpy.int32)
+        wordIDs[:-1] = numpy.fromiter(
+            map(vocabulary.get, words, repeat(0)), dtype=numpy.int32,
+            count=len(words))
+        overlayIDs = None
+        if self.overlayPolarities:
+            overlayVocabulary, overlayArray = self._vectorizedOverlay()
+            overlayIDs = numpy.zeros(len(words) + 1, dtype=numpy.int32)
+            overlayIDs[:-1] = numpy.fromiter(
+                map(overlayVocabulary.get, words, repeat(0)),
+                dtype=numpy.int32, count=len(words))
+        if self.foldTokens:
+            unknown = wordIDs[:-1] == 0
+            if overlayIDs is not None:
+                unknown &= overlayIDs[:-1] == 0
+            missing = numpy.flatnonzero(unknown)
+            folded = [foldToken(words[position])
+                      for position in missing.tolist()]
+            wordIDs[missing] = numpy.fromiter(
+                map(vocabulary.get, folded, repeat(0)),
+                dtype=numpy.int32, count=len(missing))
+            if overlayIDs is not None:
+                overlayIDs[missing] = numpy.fromiter(
+                    map(overlayVocabulary.get, folded, repeat(0)),
+                    dtype=numpy.int32, count=len(missing))
+        wordPolarities = polarityArray[wordIDs]
+        if overlayIDs is not None:
+            wordPolarities = numpy.where(
+                overlayIDs != 0, overlayArray[overlayIDs], wordPolarities)
+        # A última posição é uma palavra neutra sentinela, para que textos
+        # vazios no fim do lote tenham um índice válido em reduceat
+        scores = numpy.add.reduceat(
+            wordPolarities, starts, dtype=numpy.int64)
+        emptyTexts = numpy.diff(starts, append=len(words)) == 0
+        scores[emptyTexts] = 0
+        return scores.tolist()
+
+    def analyseMessages(self, messages, chunkSize=1000):
+        """Avalia o sentimento de mensagens em lotes
+
+        args:
+            messages: um iterável de Mensagens
+            chunkSize: quantas mensagens são avaliadas por lote
+        returns:
+            um gerador de dicionários com os dados de cada mensagem e sua
+            avaliação de sentimento, como em analyseMessage
+        """
+        chunk = []
+        for message in messages:
+            chunk.append(message)
+            if len(chunk) == chunkSize:
+                yield from self._analyseMessagesChunk(chunk)
+                chunk = []
+        yield from self._analyseMessagesChunk(chunk)
+
+    def _analyseMessagesChunk(self, messages):
+        scores = self.scoreMessages(messages)
+        for message, score in zip(messages, scores):
+            yield self.analyseMessage(message, score)
+
+    def storedScore(self, message):
+        """Retorna o valorSentimento gravado na mensagem, caso ele tenha sido
+        calculado com o mesmo léxico e o mesmo algoritmo deste processador,
+        ou None
+
+        O valor gravado é calculado no modo "simples" e sem overlay, então
+        só é reaproveitado nesse caso.
+        """
+        if self.sentimentMode != "simples" or self.overlayPolarities or \
+                message.versaoLexico != self.lexiconVersion:
+            return None
+        return message.valorSentimento
+
+    def scoreMessages(self, messages):
+        """Avalia o sentimento de mensagens, reaproveitando o valor gravado
+        nelas quando possível, como em storedScore
+
+        args:
+            messages: uma lista de Mensagens
+        returns:
+            a lista com o valor de sentimento de cada mensagem
+        """
+        scores = [self.storedScore(message) for message in messages]
+        stale = [index for index, score in enumerate(scores) if score is None]
+        freshScores = self.analyseSentimentBatch(
+            [messages[index].texto for index in stale])
+        for index, score in zip(stale, freshScores):
+            scores[index] = score
+        return scores
+
+    def analyseMessage(self, message, sentimentScore=None):
+        """Avalia o sentimento de uma mensagem
+
+        args:
+            message: uma Mensagem
+            sentimentScore: o valor de sentimento da mensagem, caso já tenha
+            sido calculado
+        returns:
+            um dicionário com os dados da mensagem e sua avaliação de
+            sentimento
+        """
+        if sentimentScore is None:
+            sentimentScore = self.analyseSentiment(message.texto)
+        sentiment = "neutro"
+        if sentimentScore > 0:
+            sentiment = "positivo"
+        elif sentimentScore < 0:
+            sentiment = "negativo"
+        return {
+            "id": message.id.int,
+            "status": message.status,
+            "data": str(message.data),
+            "texto": message.texto,
+            "valorSentimento": sentimentScore,
+            "sentimento": sentiment,
+        }
+
     def processMessagesSentiment(self, messages):
         """ Analisa o texto de mensagens e retorna uma avaliação se essas
         mensagens são positivas, negativas, ou neutras.
@@ -55,22 +403,7 @@ class MessageProcessor():
             formato JSON
         """
         try:
-            analysedMessages = []
-            for message in messages:
-                sentimentScore = self.analyseSentiment(message.texto)
-                sentiment = "neutro"
-                if sentimentScore > 0:
-                    sentiment = "positivo"
-                elif sentimentScore < 0:
-                    sentiment = "negativo"
-                analysedMessages.append({
-                    "id": message.id.int,
-                    "status": message.status,
-                    "data": str(message.data),
-                    "texto": message.texto,
-                    "valorSentimento": sentimentScore,
-                    "sentimento": sentiment,
-                })
+            analysedMessages = list(self.analyseMessages(messages))
             messagesJson = json.dumps(analysedMessages)
         except Exception as error:
             raise Exception("Ocorreu um erro enquanto processava mensagens." +
@@ -92,8 +425,8 @@ class MessageProcessor():
             countNegative = 0
             countPositive = 0
             countNeutro = 0
-            for message in messages:
-                sentimentScore = self.analyseSentiment(message.texto)
+            scores = self.scoreMessages(messages)
+            for sentimentScore in scores:
                 if sentimentScore > 0:
                     countPositive += 1
                 elif sentimentScore < 0:
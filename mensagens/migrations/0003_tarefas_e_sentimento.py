@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mensagens', '0002_auto_20230615_1322'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tarefa',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tipo', models.CharField(max_length=50)),
+                ('parametros', models.TextField(default='{}')),
+                ('status', models.CharField(db_index=True, default='pendente', max_length=20)),
+                ('progresso', models.IntegerField(default=0)),
+                ('total', models.IntegerField(default=0)),
+                ('cursor', models.CharField(blank=True, default='', max_length=64)),
+                ('bytesEscritos', models.BigIntegerField(default=0)),
+                ('resultado', models.TextField(blank=True, default='')),
+                ('erro', models.TextField(blank=True, default='')),
+                ('bloqueadoAte', models.DateTimeField(blank=True, null=True)),
+                ('criadoEm', models.DateTimeField(auto_now_add=True)),
+                ('atualizadoEm', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='mensagem',
+            name='valorSentimento',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mensagem',
+            name='versaoLexico',
+            field=models.CharField(blank=True, default='', max_length=50),
+        ),
+    ]
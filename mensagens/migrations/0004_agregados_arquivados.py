@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mensagens', '0003_tarefas_e_sentimento'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AgregadoArquivado',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mes', models.DateField(unique=True)),
+                ('arquivo', models.CharField(max_length=500)),
+                ('formato', models.CharField(max_length=10)),
+                ('total', models.IntegerField(default=0)),
+                ('positivas', models.IntegerField(default=0)),
+                ('negativas', models.IntegerField(default=0)),
+                ('neutras', models.IntegerField(default=0)),
+                ('versaoLexico', models.CharField(blank=True, default='', max_length=50)),
+            ],
+        ),
+    ]
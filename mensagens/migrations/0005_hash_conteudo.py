@@ -0,0 +1,34 @@
+import hashlib
+
+from django.db import migrations, models
+
+
+def fillContentHashes(apps, schema_editor):
+    Mensagem = apps.get_model('mensagens', 'Mensagem')
+    batch = []
+    for message in Mensagem.objects.only('id', 'data', 'texto').iterator(
+            chunk_size=1000):
+        content = "{}\n{}".format(message.data, message.texto)
+        message.hashConteudo = hashlib.sha256(
+            content.encode("utf-8")).hexdigest()
+        batch.append(message)
+        if len(batch) == 1000:
+            Mensagem.objects.bulk_update(batch, ['hashConteudo'])
+            batch = []
+    Mensagem.objects.bulk_update(batch, ['hashConteudo'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mensagens', '0004_agregados_arquivados'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mensagem',
+            name='hashConteudo',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+        migrations.RunPython(fillContentHashes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mensagens', '0005_hash_conteudo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Alteracao',
+            fields=[
+                ('seq', models.BigAutoField(primary_key=True, serialize=False)),
+                ('tipo', models.CharField(max_length=20)),
+                ('mensagem', models.UUIDField(db_index=True)),
+                ('data', models.DateField()),
+                ('status', models.CharField(max_length=200)),
+                ('texto', models.TextField()),
+                ('valorSentimento', models.IntegerField(blank=True, null=True)),
+                ('versaoLexico', models.CharField(blank=True, default='', max_length=50)),
+                ('criadoEm', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
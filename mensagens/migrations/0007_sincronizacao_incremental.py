@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mensagens', '0006_registro_alteracoes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mensagem',
+            name='atualizadoEm',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='mensagem',
+            name='removidoEm',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
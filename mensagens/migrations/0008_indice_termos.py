@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mensagens', '0007_sincronizacao_incremental'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FrequenciaTermo',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('termo', models.CharField(max_length=100)),
+                ('data', models.DateField(db_index=True)),
+                ('status', models.CharField(max_length=200)),
+                ('polaridade', models.IntegerField()),
+                ('ocorrencias', models.IntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('termo', 'data', 'status'), name='frequencia_termo_unica')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mensagens', '0008_indice_termos'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='agregadoarquivado',
+            name='confirmadoAte',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
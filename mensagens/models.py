@@ -1,4 +1,5 @@
 import uuid
+import hashlib
 import json
 import jsonschema
 from datetime import date
@@ -6,6 +7,13 @@ from jsonschema import Draft202012Validator
 from django.db import models
 
 
+class MensagemManager(models.Manager):
+    """Manager padrão das Mensagens, que omite as mensagens removidas"""
+
+    def get_queryset(self):
+        return super().get_queryset().filter(removidoEm__isnull=True)
+
+
 class Mensagem(models.Model):
     """ Modelo de uma Mensagem no banco de dados
 
@@ -14,12 +22,68 @@ class Mensagem(models.Model):
         data: data em formato YYYY-mm-dd
         status: o status da mensagem
         texto: o texto da mensagem
+        valorSentimento: a avaliação de sentimento pré-calculada por um job
+        de reprocessamento. Vazio caso a mensagem ainda não tenha sido
+        avaliada.
+        versaoLexico: a versão do léxico usada para calcular o
+        valorSentimento
+        hashConteudo: o hash SHA-256 da data e do texto da mensagem. Usado
+        para reconhecer mensagens repetidas na inserção
+        atualizadoEm: quando a mensagem foi criada ou alterada pela última
+        vez
+        removidoEm: quando a mensagem foi removida. As mensagens removidas
+        continuam na tabela para que a sincronização incremental informe a
+        remoção, mas são omitidas por Mensagem.objects. Mensagem.todas
+        inclui as mensagens removidas
 
     """
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     data = models.DateField()
     status = models.CharField(max_length=200)
     texto = models.TextField()
+    valorSentimento = models.IntegerField(null=True, blank=True)
+    versaoLexico = models.CharField(max_length=50, blank=True, default="")
+    hashConteudo = models.CharField(
+        max_length=64, blank=True, default="", db_index=True)
+    atualizadoEm = models.DateTimeField(auto_now=True, db_index=True)
+    removidoEm = models.DateTimeField(null=True, blank=True)
+
+    objects = MensagemManager()
+    todas = models.Manager()
+
+    def contentHash(messageDate, text):
+        """Calcula o hash de conteúdo de uma mensagem
+
+            Args:
+                messageDate: a data da mensagem, como date ou string
+                YYYY-mm-dd
+                text: o texto da mensagem
+            Returns:
+                O hash SHA-256 da data e do texto em hexadecimal
+        """
+        content = "{}\n{}".format(messageDate, text)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def contentHashFromDict(message):
+        """Calcula o hash de conteúdo de uma mensagem ainda não validada
+
+        Permite procurar por mensagens repetidas antes de validar o objeto
+        JSON. Uma data fora do formato YYYY-mm-dd gera um hash que nunca é
+        igual ao de uma mensagem gravada.
+
+            Args:
+                message: um dicionário com os campos da mensagem
+            Returns:
+                O hash de conteúdo, ou None caso o dicionário não tenha uma
+                data e um texto
+        """
+        if not isinstance(message, dict):
+            return None
+        messageDate = message.get("data")
+        text = message.get("texto")
+        if not isinstance(messageDate, str) or not isinstance(text, str):
+            return None
+        return Mensagem.contentHash(messageDate, text)
 
     def fromJSON(jsonData):
         """Deserializa uma string JSON em uma Mensagem
@@ -33,6 +97,25 @@ class Mensagem(models.Model):
                 válida.
                 Exception: caso ocorra um erro ao deserializar a string JSON.
         """
+        try:
+            message = json.loads(jsonData)
+        except Exception as error:
+            raise Exception(
+                "A tentativa de validar os dados JSON falhou: {}".format(
+                    error))
+        return Mensagem.fromDict(message)
+
+    def fromDict(message):
+        """Cria uma Mensagem a partir de um objeto JSON já deserializado
+
+            Args:
+                message: um dicionário com os campos da mensagem.
+            Returns:
+                Uma instância de Mensagem com os dados do dicionário.
+            Raises:
+                ValueError: caso o dicionário não seja uma mensagem válida.
+                Exception: caso ocorra um erro ao validar o dicionário.
+        """
         mensagemSchema = {
             "$schema": "https://json-schema.org/draft/2020-12/schema",
             "type": "object",
@@ -45,7 +128,6 @@ class Mensagem(models.Model):
             "required": ["data", "status", "texto"],
         }
         try:
-            message = json.loads(jsonData)
             jsonschema.validate(
                 message, mensagemSchema,
                 format_checker=Draft202012Validator.FORMAT_CHECKER)
@@ -61,20 +143,217 @@ class Mensagem(models.Model):
         newMessage = Mensagem(
             data=messageDate, status=message["status"],
             texto=message["texto"])
+        newMessage.hashConteudo = Mensagem.contentHash(
+            newMessage.data, newMessage.texto)
         if "id" in message:
             newMessage.id = uuid.UUID(int=message["id"])
         return newMessage
 
-    def toJSON(self):
-        """Serializa a mensagem para formato de string JSON"""
+    def toDict(self):
+        """Converte a mensagem em um dicionário serializável em JSON"""
 
-        mensagem = {
+        return {
             "id": self.id.int,
             "data": self.data.strftime("%Y-%m-%d"),
             "status": self.status,
             "texto": self.texto
         }
-        return json.dumps(mensagem)
+
+    def toJSON(self):
+        """Serializa a mensagem para formato de string JSON"""
+
+        return json.dumps(self.toDict())
+
+    def save(self, *args, **kwargs):
+        self.hashConteudo = Mensagem.contentHash(self.data, self.texto)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.toJSON()
+
+
+class Tarefa(models.Model):
+    """ Modelo de uma tarefa executada em segundo plano pelo worker
+
+    Attributes:
+        tipo: o tipo da tarefa, "rescore" ou "export"
+        parametros: os parâmetros da tarefa serializados como string JSON
+        status: "pendente", "executando", "concluido" ou "falhou"
+        progresso: quantas mensagens já foram processadas
+        total: quantas mensagens a tarefa vai processar
+        cursor: a id da última mensagem processada. Usada para retomar a
+        tarefa do ponto onde ela parou
+        bytesEscritos: quantos bytes do arquivo de exportação já foram
+        confirmados
+        resultado: o resultado da tarefa, por exemplo o caminho do arquivo
+        exportado
+        erro: a mensagem de erro caso a tarefa tenha falhado
+        bloqueadoAte: até quando o worker atual tem posse da tarefa. Depois
+        disso outro worker pode retomá-la
+    """
+    PENDENTE = "pendente"
+    EXECUTANDO = "executando"
+    CONCLUIDO = "concluido"
+    FALHOU = "falhou"
+
+    tipo = models.CharField(max_length=50)
+    parametros = models.TextField(default="{}")
+    status = models.CharField(max_length=20, default=PENDENTE, db_index=True)
+    progresso = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+    cursor = models.CharField(max_length=64, blank=True, default="")
+    bytesEscritos = models.BigIntegerField(default=0)
+    resultado = models.TextField(blank=True, default="")
+    erro = models.TextField(blank=True, default="")
+    bloqueadoAte = models.DateTimeField(null=True, blank=True)
+    criadoEm = models.DateTimeField(auto_now_add=True)
+    atualizadoEm = models.DateTimeField(auto_now=True)
+
+    def toJSON(self):
+        """Serializa a tarefa para formato de string JSON"""
+
+        tarefa = {
+            "id": self.id,
+            "tipo": self.tipo,
+            "parametros": json.loads(self.parametros),
+            "status": self.status,
+            "progresso": self.progresso,
+            "total": self.total,
+            "resultado": self.resultado,
+            "erro": self.erro,
+        }
+        return json.dumps(tarefa)
+
+    def __str__(self):
+        return self.toJSON()
+
+
+class AgregadoArquivado(models.Model):
+    """ Modelo dos agregados de um mês de mensagens arquivadas
+
+    Attributes:
+        mes: o primeiro dia do mês arquivado
+        arquivo: o caminho do arquivo com as mensagens do mês
+        formato: "ndjson" ou "sqlite"
+        total: quantas mensagens do mês foram arquivadas
+        positivas: quantas mensagens arquivadas são positivas
+        negativas: quantas mensagens arquivadas são negativas
+        neutras: quantas mensagens arquivadas são neutras
+        versaoLexico: a versão do léxico usada para calcular os agregados.
+        Vazia caso o mês tenha mensagens avaliadas com léxicos diferentes
+        confirmadoAte: até onde o arquivo tem lotes já removidos da tabela,
+        o tamanho em bytes no formato ndjson e a maior rowid no sqlite. O
+        que vem depois é de um lote interrompido. Nulo nos meses arquivados
+        antes desse campo existir
+    """
+    mes = models.DateField(unique=True)
+    arquivo = models.CharField(max_length=500)
+    formato = models.CharField(max_length=10)
+    total = models.IntegerField(default=0)
+    positivas = models.IntegerField(default=0)
+    negativas = models.IntegerField(default=0)
+    neutras = models.IntegerField(default=0)
+    versaoLexico = models.CharField(max_length=50, blank=True, default="")
+    confirmadoAte = models.BigIntegerField(null=True, blank=True)
+
+
+class Alteracao(models.Model):
+    """ Modelo de uma entrada do registro de alterações das mensagens
+
+    O registro só recebe novas entradas. A seq cresce a cada alteração, e é
+    usada pelos consumidores para retomar a leitura de onde pararam.
+
+    Attributes:
+        seq: o número sequencial da alteração
+        tipo: "criada", "atualizada" ou "removida"
+        mensagem: a id da mensagem alterada
+        data: a data da mensagem depois da alteração
+        status: o status da mensagem depois da alteração
+        texto: o texto da mensagem depois da alteração
+        valorSentimento: a avaliação de sentimento do texto
+        versaoLexico: a versão do léxico usada para calcular o
+        valorSentimento
+        criadoEm: quando a alteração foi feita
+    """
+    CRIADA = "criada"
+    ATUALIZADA = "atualizada"
+    REMOVIDA = "removida"
+
+    seq = models.BigAutoField(primary_key=True)
+    tipo = models.CharField(max_length=20)
+    mensagem = models.UUIDField(db_index=True)
+    data = models.DateField()
+    status = models.CharField(max_length=200)
+    texto = models.TextField()
+    valorSentimento = models.IntegerField(null=True, blank=True)
+    versaoLexico = models.CharField(max_length=50, blank=True, default="")
+    criadoEm = models.DateTimeField(auto_now_add=True)
+
+    def fromMessage(tipo, message):
+        """Cria a entrada do registro para uma alteração de uma Mensagem
+
+            Args:
+                tipo: o tipo da alteração
+                message: a Mensagem no estado depois da alteração
+            Returns:
+                Uma instância de Alteracao ainda não gravada
+        """
+        return Alteracao(
+            tipo=tipo, mensagem=message.id, data=message.data,
+            status=message.status, texto=message.texto,
+            valorSentimento=message.valorSentimento,
+            versaoLexico=message.versaoLexico)
+
+    def toJSON(self):
+        """Serializa a alteração para formato de string JSON"""
+
+        sentimento = None
+        if self.valorSentimento is not None:
+            sentimento = "neutro"
+            if self.valorSentimento > 0:
+                sentimento = "positivo"
+            elif self.valorSentimento < 0:
+                sentimento = "negativo"
+        alteracao = {
+            "seq": self.seq,
+            "tipo": self.tipo,
+            "id": self.mensagem.int,
+            "data": str(self.data),
+            "status": self.status,
+            "texto": self.texto,
+            "valorSentimento": self.valorSentimento,
+            "sentimento": sentimento,
+        }
+        return json.dumps(alteracao)
+
+    def __str__(self):
+        return self.toJSON()
+
+
+class FrequenciaTermo(models.Model):
+    """ Modelo do índice de termos que contribuem para o sentimento
+
+    Conta as ocorrências de cada termo do léxico nas mensagens de uma data
+    e status. É atualizado a cada mensagem criada, alterada ou removida. As
+    mensagens arquivadas continuam contadas.
+
+    Attributes:
+        termo: a palavra, na forma encontrada no léxico
+        data: a data das mensagens
+        status: o status das mensagens
+        polaridade: a polaridade do termo no léxico
+        ocorrencias: quantas vezes o termo aparece nas mensagens com essa
+        data e status
+    """
+    termo = models.CharField(max_length=100)
+    data = models.DateField(db_index=True)
+    status = models.CharField(max_length=200)
+    polaridade = models.IntegerField()
+    ocorrencias = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["termo", "data", "status"],
+                name="frequencia_termo_unica"),
+        ]
@@ -0,0 +1,174 @@
+import heapq
+from itertools import chain
+
+from django.db import IntegrityError, transaction
+from django.db.models import Sum
+
+from . import archive
+from .message_processor import MessageProcessor
+from .models import FrequenciaTermo, Mensagem
+
+
+def termCounts(messages, sign=1, counts=None):
+    """Conta os termos que contribuem para o sentimento de mensagens
+
+    Args:
+        messages: um iterável de Mensagens
+        sign: 1 para somar as ocorrências ao índice, -1 para subtraí-las
+        counts: se fornecido, as variações são somadas a esse dicionário
+    Returns:
+        um dicionário que atribui a cada (termo, data, status) uma tupla
+        com a polaridade do termo e a variação das ocorrências
+    """
+    messageProcessor = MessageProcessor()
+    if counts is None:
+        counts = {}
+    for message in messages:
+        terms = messageProcessor.termPolarities(message.texto)
+        for term, (polarity, occurrences) in terms.items():
+            key = (term, message.data, message.status)
+            current = counts.get(key, (polarity, 0))[1]
+            counts[key] = (polarity, current + sign * occurrences)
+    return counts
+
+
+def indexMessages(messages):
+    """Soma os termos de mensagens novas ao índice de termos"""
+    applyTermCounts(termCounts(messages))
+
+
+def unindexMessages(messages):
+    """Subtrai os termos de mensagens removidas do índice de termos"""
+    applyTermCounts(termCounts(messages, sign=-1))
+
+
+def reindexMessage(previous, message):
+    """Atualiza o índice de termos com a alteração de uma mensagem
+
+    Args:
+        previous: a Mensagem antes da alteração
+        message: a Mensagem depois da alteração
+    """
+    counts = termCounts([previous], sign=-1)
+    applyTermCounts(termCounts([message], counts=counts))
+
+
+def applyTermCounts(counts):
+    """Aplica ao índice de termos as variações calculadas por termCounts
+
+    As linhas afetadas são lidas com uma única consulta e gravadas em lote.
+    Caso uma transação concorrente crie a mesma linha, a atualização é
+    refeita uma vez.
+
+    Args:
+        counts: o dicionário retornado por termCounts
+    """
+    counts = {key: value for key, value in counts.items() if value[1]}
+    if not counts:
+        return
+    for attempt in range(2):
+        try:
+            with transaction.atomic():
+                _applyTermCounts(counts)
+            return
+        except IntegrityError:
+            if attempt:
+                raise
+
+
+def _applyTermCounts(counts):
+    rows = FrequenciaTermo.objects.select_for_update().filter(
+        termo__in={key[0] for key in counts},
+        data__in={key[1] for key in counts},
+        status__in={key[2] for key in counts})
+    existing = {(row.termo, row.data, row.status): row for row in rows}
+    changed = []
+    created = []
+    emptied = []
+    for key, (polarity, delta) in counts.items():
+        row = existing.get(key)
+        if row is None:
+            if delta > 0:
+                created.append(FrequenciaTermo(
+                    termo=key[0], data=key[1], status=key[2],
+                    polaridade=polarity, ocorrencias=delta))
+            continue
+        row.polaridade = polarity
+        row.ocorrencias += delta
+        if row.ocorrencias > 0:
+            changed.append(row)
+        else:
+            emptied.append(row.id)
+    FrequenciaTermo.objects.bulk_update(
+        changed, ["polaridade", "ocorrencias"])
+    FrequenciaTermo.objects.bulk_create(created)
+    FrequenciaTermo.objects.filter(id__in=emptied).delete()
+
+
+def rebuildTermIndex(chunkSize=1000):
+    """Recria o índice de termos a partir de todas as mensagens, inclusive
+    as arquivadas
+
+    Necessário depois de uma mudança no léxico, pois as polaridades e os
+    termos encontrados mudam.
+
+    Returns:
+        quantas linhas o índice tem
+    """
+    messages = Mensagem.objects.only("data", "status", "texto")
+    counts = termCounts(chain(
+        messages.iterator(chunk_size=chunkSize),
+        archive.iterArchivedMessages()))
+    with transaction.atomic():
+        FrequenciaTermo.objects.all().delete()
+        FrequenciaTermo.objects.bulk_create([
+            FrequenciaTermo(
+                termo=term, data=messageDate, status=status,
+                polaridade=polarity, ocorrencias=occurrences)
+            for (term, messageDate, status), (polarity, occurrences)
+            in counts.items()], batch_size=chunkSize)
+    return len(counts)
+
+
+def topTerms(limit, start=None, end=None, status=None):
+    """Retorna os termos que mais contribuem para o sentimento positivo e
+    negativo das mensagens
+
+    A contribuição de um termo é a sua polaridade multiplicada pelo número
+    de ocorrências. Só o índice de termos é lido, e os maiores termos são
+    escolhidos com um heap, sem ordenar todos.
+
+    Args:
+        limit: quantos termos de cada sentimento são retornados
+        start: se fornecida, só considera mensagens a partir dessa data
+        end: se fornecida, só considera mensagens até essa data
+        status: se fornecido, só considera mensagens com esse status
+    Returns:
+        um dicionário com as listas "positivos" e "negativos", ordenadas da
+        maior para a menor contribuição em valor absoluto
+    """
+    rows = FrequenciaTermo.objects.all()
+    if start is not None:
+        rows = rows.filter(data__gte=start)
+    if end is not None:
+        rows = rows.filter(data__lte=end)
+    if status is not None:
+        rows = rows.filter(status=status)
+    totals = rows.values("termo", "polaridade").annotate(
+        total=Sum("ocorrencias")).order_by("termo")
+    terms = [
+        {
+            "termo": row["termo"],
+            "polaridade": row["polaridade"],
+            "ocorrencias": row["total"],
+            "contribuicao": row["polaridade"] * row["total"],
+        }
+        for row in totals]
+    return {
+        "positivos": heapq.nlargest(
+            limit, (term for term in terms if term["contribuicao"] > 0),
+            key=lambda term: term["contribuicao"]),
+        "negativos": heapq.nsmallest(
+            limit, (term for term in terms if term["contribuicao"] < 0),
+            key=lambda term: term["contribuicao"]),
+    }
@@ -1,11 +1,44 @@
-from django.test import TestCase
+from django.test import RequestFactory, TestCase, override_settings
 from django.urls import reverse
+from django.db import connection, connections
+from django.db.backends.sqlite3.base import (
+    DatabaseWrapper as SQLiteDatabaseWrapper)
+from django.test.utils import CaptureQueriesContext
 import json
-from .models import Mensagem
-from datetime import date
+import os
+import tempfile
+from .models import (
+    AgregadoArquivado, Alteracao, FrequenciaTermo, Mensagem, Tarefa)
+from datetime import date, timedelta
+from itertools import islice
+from django.utils import timezone
 from jsonschema.exceptions import ValidationError
 import mensagens.database_handler as dbHandler
+import mensagens.job_queue as jobQueue
+import mensagens.archive as archive
+import mensagens.db_router as dbRouter
+import mensagens.change_feed as changeFeed
+import mensagens.compression as compression
+import mensagens.term_index as termIndex
+import gzip
+from django.core.cache import cache
+import asyncio
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.management import call_command
+import mensagens.ingestion_buffer as ingestionBuffer
+import mensagens.lexicon_registry as lexiconRegistry
+from mensagens.lexicon_index import buildIndex, foldToken
+from mensagens.exporters import EXPORT_FIELDS
+import mensagens.exporters as exporters
+import csv
+import io
+import sqlite3
+import time
+import unittest
 from mensagens.message_processor import MessageProcessor
+from mensagens import views
+import mensagens.message_processor as messageProcessorModule
+from unittest import mock
 
 
 class MensagemModelTests(TestCase):
@@ -190,6 +223,11 @@ class DatabaseHandlerTests(TestCase):
 
 
 class ListMessagesViewsTest(TestCase):
+    def setUp(self):
+        # As respostas em cache de outros testes podem ter a mesma versão,
+        # pois a seq do registro de alterações volta com o rollback
+        cache.clear()
+
     def test_list_mensagens_view_success(self):
         """Avalia se o enpoint /mensagens retorna uma lista de mensagens como
         esperado
@@ -261,6 +299,100 @@ class ListMessagesViewsTest(TestCase):
         self.assertTrue("mensagensNeutras" in responseCount)
 
 
+class SentimentExportViewsTest(TestCase):
+    def streamedContent(self, response):
+        return b"".join(response.streaming_content)
+
+    def test_export_sentiment_ndjson_by_query(self):
+        """Avalia se o endpoint /mensagens/sentiment exporta NDJSON sem a
+        coluna de texto quando format=ndjson"""
+        response = self.client.get(
+            reverse("mensagens:sentiment"), {"format": "ndjson"})
+        self.assertEquals(response.status_code, 200)
+        self.assertEqual(
+            response.headers["Content-Type"], "application/x-ndjson")
+        lines = self.streamedContent(response).decode().splitlines()
+        self.assertEqual(len(lines), Mensagem.objects.count())
+        row = json.loads(lines[0])
+        self.assertFalse("texto" in row)
+        self.assertTrue("valorSentimento" in row)
+
+    def test_export_sentiment_csv_by_accept_with_projection(self):
+        """Avalia se o endpoint /mensagens/sentiment exporta CSV com as
+        colunas pedidas quando o header Accept é text/csv"""
+        response = self.client.get(
+            reverse("mensagens:sentiment"),
+            {"fields": "id,data,valorSentimento"}, HTTP_ACCEPT="text/csv")
+        self.assertEquals(response.status_code, 200)
+        rows = list(csv.reader(
+            io.StringIO(self.streamedContent(response).decode())))
+        self.assertEqual(rows[0], ["id", "data", "valorSentimento"])
+        self.assertEqual(len(rows), Mensagem.objects.count() + 1)
+
+    def test_accept_quality_values(self):
+        """Verifica que o formato escolhido pelo Accept respeita a
+        prioridade de cada tipo, e que a resposta JSON padrão também varia
+        com o Accept"""
+        negotiate = exporters.negotiateFormat
+        self.assertEqual(
+            negotiate(None, "text/csv;q=0, application/json"), "json")
+        self.assertEqual(
+            negotiate(None, "text/csv;q=0.5, application/x-ndjson"),
+            "ndjson")
+        self.assertEqual(
+            negotiate(None, "application/json;q=0.2, text/csv;q=0.9"), "csv")
+        self.assertEqual(negotiate(None, "text/csv;q=x"), "json")
+        self.assertEqual(negotiate(None, "text/csv, application/json"), "csv")
+        response = self.client.get(
+            reverse("mensagens:sentiment"), HTTP_ACCEPT="text/csv;q=0")
+        self.assertEqual(response.headers["Content-Type"], "application/json")
+        self.assertTrue("Accept" in response.headers["Vary"])
+
+    def test_export_sentiment_json_projection(self):
+        """Avalia se o formato JSON também aceita projeção de colunas"""
+        response = self.client.get(
+            reverse("mensagens:sentiment"), {"fields": "id,texto"})
+        self.assertEquals(response.status_code, 200)
+        rows = json.loads(self.streamedContent(response))
+        self.assertEqual(len(rows), Mensagem.objects.count())
+        self.assertEqual(set(rows[0].keys()), {"id", "texto"})
+
+    def test_export_sentiment_rejects_unknown_field(self):
+        """Avalia se o endpoint /mensagens/sentiment rejeita colunas
+        desconhecidas"""
+        response = self.client.get(
+            reverse("mensagens:sentiment"),
+            {"format": "csv", "fields": "id,senha"})
+        self.assertEquals(response.status_code, 400)
+
+    def test_export_sentiment_rejects_unknown_format(self):
+        """Avalia se o endpoint /mensagens/sentiment rejeita formatos
+        desconhecidos"""
+        response = self.client.get(
+            reverse("mensagens:sentiment"), {"format": "xml"})
+        self.assertEquals(response.status_code, 406)
+
+    @unittest.skipIf(exporters.pyarrow is None, "pyarrow não instalado")
+    def test_export_sentiment_arrow_and_parquet(self):
+        """Avalia se os formatos arrow e parquet exportam todas as
+        mensagens com as colunas pedidas"""
+        import pyarrow
+        import pyarrow.parquet
+        fields = {"fields": "id,data,valorSentimento"}
+        response = self.client.get(
+            reverse("mensagens:sentiment"), dict(fields, format="arrow"))
+        table = pyarrow.ipc.open_stream(
+            self.streamedContent(response)).read_all()
+        self.assertEqual(table.column_names, ["id", "data", "valorSentimento"])
+        self.assertEqual(table.num_rows, Mensagem.objects.count())
+
+        response = self.client.get(
+            reverse("mensagens:sentiment"), dict(fields, format="parquet"))
+        table = pyarrow.parquet.read_table(
+            pyarrow.BufferReader(self.streamedContent(response)))
+        self.assertEqual(table.num_rows, Mensagem.objects.count())
+
+
 class MessageProcessorTest(TestCase):
     def test_positive_sentiment_test(self):
         """Testa se o algoritmo de análise de sentimento avalia uma frase
@@ -330,3 +462,1365 @@ class MessageProcessorTest(TestCase):
         self.assertEquals(count["mensagensPositivas"], 2)
         self.assertEquals(count["mensagensNegativas"], 0)
         self.assertEquals(count["mensagensNeutras"], 1)
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        Mensagem.objects.all().delete()
+        for texto in ["Sou uma frase feliz", "Sou uma frase triste",
+                      "Sou uma frase"]:
+            Mensagem(data="2022-01-24", status="Aberto", texto=texto).save()
+        self.exportDir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.exportDir.cleanup)
+
+    def test_rescore_job_stores_sentiment(self):
+        """Verifica que a tarefa de reprocessamento grava a avaliação de
+        sentimento de todas as mensagens"""
+        job = jobQueue.enqueueJob("rescore", {"versaoLexico": "v1"})
+        claimed = jobQueue.claimNextJob()
+        self.assertEqual(claimed.id, job.id)
+        jobQueue.runJob(claimed)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Tarefa.CONCLUIDO)
+        self.assertEqual(job.progresso, 3)
+        processor = MessageProcessor()
+        for message in Mensagem.objects.all():
+            self.assertEqual(message.versaoLexico, "v1")
+            self.assertEqual(
+                message.valorSentimento,
+                processor.analyseSentiment(message.texto))
+
+    def test_export_job_resumes_from_checkpoint(self):
+        """Verifica que uma exportação interrompida continua do último bloco
+        confirmado sem duplicar linhas"""
+        with override_settings(
+                JOBS_EXPORT_DIR=self.exportDir.name, JOBS_CHUNK_SIZE=2):
+            job = jobQueue.enqueueJob("export", {"formato": "ndjson"})
+            job = jobQueue.claimNextJob()
+            chunks = jobQueue._messageChunks(job)
+            path = os.path.join(
+                self.exportDir.name, "sentimento-{}.ndjson".format(job.id))
+            with open(path, "wb") as output:
+                firstChunk = next(chunks)
+                output.write(b"".join(
+                    jobQueue.toNDJSONLine(
+                        MessageProcessor().analyseMessage(m)).encode()
+                    for m in firstChunk))
+                job.bytesEscritos = output.tell()
+                output.write(b'{"linha": "incompleta"')
+            jobQueue._checkpoint(job, firstChunk)
+            jobQueue.runJob(job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Tarefa.CONCLUIDO)
+        self.assertEqual(job.resultado, path)
+        with open(path) as exported:
+            lines = [json.loads(line) for line in exported]
+        self.assertEqual(
+            sorted(line["id"] for line in lines),
+            sorted(m.id.int for m in Mensagem.objects.all()))
+
+    def test_export_job_csv(self):
+        """Verifica que a exportação em CSV gera um cabeçalho e uma linha
+        por mensagem"""
+        with override_settings(JOBS_EXPORT_DIR=self.exportDir.name):
+            jobQueue.enqueueJob("export", {"formato": "csv"})
+            job = jobQueue.claimNextJob()
+            jobQueue.runJob(job)
+        with open(job.resultado) as exported:
+            lines = exported.read().splitlines()
+        self.assertEqual(lines[0], ",".join(EXPORT_FIELDS))
+        self.assertEqual(len(lines), 4)
+
+    def test_export_job_includes_archived_messages(self):
+        """Verifica que a exportação inclui os meses arquivados e continua
+        do último bloco confirmado entre eles"""
+        for texto in ["Fui feliz", "Fui triste", "Fui"]:
+            Mensagem(data="2020-03-10", status="Aberto", texto=texto).save()
+        expected = sorted(m.id.int for m in Mensagem.objects.all())
+        archiveDir = tempfile.TemporaryDirectory()
+        self.addCleanup(archiveDir.cleanup)
+        with override_settings(
+                ARCHIVE_DIR=archiveDir.name,
+                JOBS_EXPORT_DIR=self.exportDir.name, JOBS_CHUNK_SIZE=2):
+            archive.archiveMessages(date(2021, 1, 1))
+            job = jobQueue.enqueueJob("export", {"formato": "ndjson"})
+            job = jobQueue.claimNextJob()
+            jobQueue._countTotal(job, includeArchived=True)
+            path = os.path.join(
+                self.exportDir.name, "sentimento-{}.ndjson".format(job.id))
+            with open(path, "wb") as output:
+                for chunk, cursor in islice(jobQueue._exportChunks(job), 3):
+                    output.write(b"".join(
+                        jobQueue.toNDJSONLine(
+                            MessageProcessor().analyseMessage(m)).encode()
+                        for m in chunk))
+                    job.bytesEscritos = output.tell()
+                    jobQueue._checkpoint(job, chunk, cursor)
+            self.assertEqual(job.cursor, jobQueue.ARCHIVED_CURSOR + "2")
+            jobQueue.runJob(job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Tarefa.CONCLUIDO)
+        self.assertEqual(job.total, 6)
+        self.assertEqual(job.progresso, 6)
+        with open(path) as exported:
+            lines = [json.loads(line) for line in exported]
+        self.assertEqual(sorted(line["id"] for line in lines), expected)
+
+    def test_claim_skips_jobs_with_active_lease(self):
+        """Verifica que uma tarefa em execução não é reservada por outro
+        worker enquanto a reserva estiver válida"""
+        jobQueue.enqueueJob("rescore")
+        self.assertIsNotNone(jobQueue.claimNextJob())
+        self.assertIsNone(jobQueue.claimNextJob())
+
+    def test_create_job_view_and_status(self):
+        """Avalia se os endpoints /mensagens/jobs criam uma tarefa e
+        retornam seu status"""
+        response = self.client.post(
+            reverse("mensagens:jobs"),
+            json.dumps({"tipo": "export", "parametros": {"formato": "csv"}}),
+            content_type="application/json")
+        self.assertEquals(response.status_code, 202)
+        job = json.loads(response.content)
+        self.assertEqual(job["status"], Tarefa.PENDENTE)
+
+        response = self.client.get(response.headers["Location"])
+        self.assertEquals(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)["id"], job["id"])
+
+    def test_create_job_view_rejects_unknown_type(self):
+        """Avalia se o endpoint /mensagens/jobs rejeita tarefas
+        desconhecidas"""
+        response = self.client.post(
+            reverse("mensagens:jobs"), json.dumps({"tipo": "desconhecido"}),
+            content_type="application/json")
+        self.assertEquals(response.status_code, 400)
+
+    def test_job_status_not_found(self):
+        """Avalia se o endpoint /mensagens/jobs/<id> retorna 404 para uma
+        tarefa que não existe"""
+        response = self.client.get(
+            reverse("mensagens:jobStatus", args=[14545]))
+        self.assertEquals(response.status_code, 404)
+
+
+class StoredSentimentTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        Mensagem.objects.all().delete()
+        dbHandler.insertMessage(json.dumps({
+            "data": "2022-01-24", "status": "Aberto",
+            "texto": "Sou uma frase feliz"}))
+        Mensagem.objects.update(valorSentimento=5)
+
+    def scores(self, **params):
+        response = self.client.get(reverse("mensagens:sentiment"), params)
+        return [row["valorSentimento"] for row in json.loads(
+            response.content)]
+
+    def test_stored_score_is_served(self):
+        """Verifica que a avaliação gravada com o léxico atual é servida sem
+        avaliar a mensagem de novo"""
+        with mock.patch.object(
+                MessageProcessor, "analyseSentimentBatch",
+                wraps=MessageProcessor().analyseSentimentBatch) as batch:
+            self.assertEqual(self.scores(), [5])
+            self.assertEqual(json.loads(self.client.get(
+                reverse("mensagens:sentimentCount")).content)[
+                    "mensagensPositivas"], 1)
+            for call in batch.call_args_list:
+                self.assertEqual(call.args[-1], [])
+
+    def test_stale_score_is_recalculated(self):
+        """Verifica que a avaliação é calculada de novo com outro léxico ou
+        outro modo"""
+        self.assertEqual(self.scores(modo="regras"), [1])
+        Mensagem.objects.update(versaoLexico="v1")
+        self.assertEqual(self.scores(), [1])
+
+
+class VectorizedSentimentTest(TestCase):
+    texts = [
+        "Sou uma frase feliz, feliz, feliz",
+        "",
+        "Sou uma frase triste!!!",
+        "ÓTIMA empresa. Olá, como vai?",
+        "!!! ... ???",
+        "Estou bem chateado. Gostaria de fazer um pedido.",
+        "",
+    ]
+
+    @unittest.skipIf(messageProcessorModule.numpy is None,
+                     "numpy não instalado")
+    def test_vectorized_batch_matches_scalar(self):
+        """Testa que o algoritmo vetorizado retorna os mesmos valores que o
+        algoritmo escalar, inclusive para textos vazios"""
+        messageProcessor = MessageProcessor()
+        expected = [messageProcessor.analyseSentiment(t) for t in self.texts]
+        messageProcessor.vectorizedBatchSize = 1
+        self.assertEqual(
+            messageProcessor.analyseSentimentBatch(self.texts), expected)
+        self.assertEqual(
+            messageProcessor.analyseSentimentBatch(self.texts[-2:]),
+            expected[-2:])
+        self.assertEqual(messageProcessor.analyseSentimentBatch([]), [])
+
+    def test_batch_without_numpy_uses_scalar(self):
+        """Testa que analyseSentimentBatch funciona sem o NumPy"""
+        messageProcessor = MessageProcessor()
+        messageProcessor.vectorizedBatchSize = 1
+        expected = [messageProcessor.analyseSentiment(t) for t in self.texts]
+        with mock.patch.object(messageProcessorModule, "numpy", None):
+            self.assertEqual(
+                messageProcessor.analyseSentimentBatch(self.texts), expected)
+
+
+class RuleBasedSentimentTest(TestCase):
+    def test_negation_flips_polarity(self):
+        """Testa que no modo "regras" uma negação inverte a polaridade das
+        palavras seguintes, e que o modo padrão continua somando"""
+        text = "Não estou feliz com o pedido"
+        self.assertTrue(MessageProcessor().analyseSentiment(text) > 0)
+        messageProcessor = MessageProcessor(sentimentMode="regras")
+        self.assertTrue(messageProcessor.analyseSentiment(text) < 0)
+
+    def test_negation_window_and_clause_break(self):
+        """Testa que a negação só afeta as palavras dentro da janela e da
+        mesma oração"""
+        messageProcessor = MessageProcessor(sentimentMode="regras")
+        self.assertEqual(
+            messageProcessor.analyseSentiment("Não. Estou feliz"), 1)
+        self.assertEqual(
+            messageProcessor.analyseSentiment(
+                "nunca fico assim tão feliz"), 1)
+
+    def test_intensifiers_scale_polarity(self):
+        """Testa que intensificadores e atenuadores multiplicam a polaridade
+        da palavra seguinte"""
+        messageProcessor = MessageProcessor(sentimentMode="regras")
+        self.assertEqual(messageProcessor.analyseSentiment("muito feliz"), 2)
+        self.assertEqual(
+            messageProcessor.analyseSentiment("pouco triste"), -0.5)
+        self.assertEqual(
+            messageProcessor.analyseSentiment("não muito feliz"), -2)
+
+    def test_unknown_mode_raises_error(self):
+        """Testa que um modo desconhecido levanta um erro"""
+        with self.assertRaises(ValueError):
+            MessageProcessor(sentimentMode="desconhecido")
+
+    def test_sentiment_views_accept_mode(self):
+        """Avalia se os endpoints de sentimento aceitam o parâmetro modo"""
+        cache.clear()
+        Mensagem.objects.all().delete()
+        Mensagem(data="2022-01-24", status="Aberto",
+                 texto="Não estou feliz").save()
+        response = self.client.get(reverse("mensagens:sentimentCount"))
+        self.assertEqual(json.loads(response.content)["mensagensPositivas"], 1)
+        response = self.client.get(
+            reverse("mensagens:sentimentCount"), {"modo": "regras"})
+        self.assertEquals(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)["mensagensNegativas"], 1)
+        response = self.client.get(
+            reverse("mensagens:sentiment"), {"modo": "desconhecido"})
+        self.assertEquals(response.status_code, 400)
+
+
+@override_settings(IDEMPOTENT_INSERT=False)
+class IngestionBufferTest(TestCase):
+    def setUp(self):
+        Mensagem.objects.all().delete()
+        self.buffer = ingestionBuffer.IngestionBuffer(
+            maxSize=3, batchSize=2, flushInterval=0.1, enqueueTimeout=0,
+            autoStart=False)
+
+    def newMessages(self, count):
+        return [Mensagem.fromDict({
+            "data": "2022-01-24", "status": "Aberto",
+            "texto": "Sou uma frase feliz"}) for _ in range(count)]
+
+    def test_flush_group_commits_and_scores(self):
+        """Verifica que as mensagens da fila são gravadas em lotes e com a
+        avaliação de sentimento"""
+        messages = self.newMessages(1) + self.newMessages(2)
+        ids = self.buffer.submit(messages[:1])
+        ids += self.buffer.submit(messages[1:])
+        self.assertEqual(Mensagem.objects.count(), 0)
+        self.assertEqual(self.buffer.flush(), 3)
+        self.assertEqual(
+            set(Mensagem.objects.values_list("id", flat=True)), set(ids))
+        for message in Mensagem.objects.all():
+            self.assertEqual(message.valorSentimento, 1)
+
+    def test_full_buffer_raises_error(self):
+        """Verifica que a fila recusa mensagens quando está cheia"""
+        self.buffer.submit(self.newMessages(2))
+        with self.assertRaises(ingestionBuffer.IngestionBufferFull):
+            self.buffer.submit(self.newMessages(2))
+        self.buffer.flush()
+        self.buffer.submit(self.newMessages(2))
+
+    def test_synchronous_submit_writes_before_returning(self):
+        """Verifica que no modo síncrono as mensagens já estão gravadas
+        quando submit retorna"""
+        self.buffer.submit(self.newMessages(1), synchronous=True)
+        self.assertEqual(Mensagem.objects.count(), 1)
+
+    def test_failed_batch_keeps_valid_entries(self):
+        """Verifica que uma mensagem que não pode ser gravada só causa erro
+        no seu próprio request, e não nos outros do mesmo lote"""
+        existing = self.newMessages(1)[0]
+        existing.save()
+        poisoned = self.newMessages(1)[0]
+        poisoned.id = existing.id
+        valid = self.newMessages(1)
+        self.buffer.submit(valid)
+        with self.assertRaises(Exception):
+            self.buffer.submit([poisoned], synchronous=True)
+        self.assertEqual(Mensagem.objects.count(), 2)
+        self.assertTrue(Mensagem.objects.filter(id=valid[0].id).exists())
+
+    def test_ingest_view_accepts_messages(self):
+        """Avalia se o endpoint /mensagens/ingest responde 202 com as ids
+        das mensagens colocadas na fila"""
+        body = [{"data": "2022-01-24", "status": "Aberto", "texto": "Olá"}]
+        with mock.patch.object(
+                views, "getIngestionBuffer", return_value=self.buffer):
+            response = self.client.post(
+                reverse("mensagens:ingest"), json.dumps(body),
+                content_type="application/json")
+            self.assertEquals(response.status_code, 202)
+            ids = json.loads(response.content)["ids"]
+            self.buffer.flush()
+            self.assertEqual(
+                Mensagem.objects.get().id.int, ids[0])
+
+            response = self.client.post(
+                reverse("mensagens:ingest") + "?sincrono=true",
+                json.dumps(body[0]), content_type="application/json")
+            self.assertEquals(response.status_code, 201)
+            self.assertEqual(Mensagem.objects.count(), 2)
+
+            response = self.client.post(
+                reverse("mensagens:ingest"), json.dumps(body * 4),
+                content_type="application/json")
+            self.assertEquals(response.status_code, 503)
+
+    def test_ingest_view_rejects_existing_ids(self):
+        """Avalia se o endpoint /mensagens/ingest recusa ids que já
+        pertencem a outra mensagem, gravada ou na fila, e ids fora do modo
+        síncrono"""
+        existing = self.newMessages(1)[0]
+        existing.save()
+        queued = self.newMessages(1)
+        self.buffer.submit(queued)
+        url = reverse("mensagens:ingest") + "?sincrono=true"
+        with mock.patch.object(
+                views, "getIngestionBuffer", return_value=self.buffer):
+            for messageID in [existing.id.int, queued[0].id.int]:
+                response = self.client.post(
+                    url, json.dumps({
+                        "id": messageID, "data": "2022-01-25",
+                        "status": "Aberto", "texto": "Outra"}),
+                    content_type="application/json")
+                self.assertEquals(response.status_code, 409)
+            response = self.client.post(
+                reverse("mensagens:ingest"), json.dumps({
+                    "id": 42, "data": "2022-01-25", "status": "Aberto",
+                    "texto": "Outra"}),
+                content_type="application/json")
+            self.assertEquals(response.status_code, 400)
+            response = self.client.post(
+                url, json.dumps({
+                    "id": 42, "data": "2022-01-25", "status": "Aberto",
+                    "texto": "Outra"}),
+                content_type="application/json")
+            self.assertEquals(response.status_code, 201)
+        self.assertEqual(Mensagem.objects.count(), 3)
+        self.assertEqual(
+            Mensagem.objects.get(id=existing.id).texto, existing.texto)
+
+    def test_ingest_view_rejects_invalid_message(self):
+        """Avalia se o endpoint /mensagens/ingest rejeita mensagens
+        inválidas"""
+        response = self.client.post(
+            reverse("mensagens:ingest"),
+            json.dumps({"data": "Não sou uma data", "status": "Aberto",
+                        "texto": "Olá"}),
+            content_type="application/json")
+        self.assertEquals(response.status_code, 400)
+
+
+class LexiconRegistryTest(TestCase):
+    def setUp(self):
+        self.overlayDir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.overlayDir.cleanup)
+        self.writeOverlay("loja", {"Pedido": -2, "feliz": 1, "triste": -1})
+        self.registry = lexiconRegistry.LexiconRegistry(
+            self.overlayDir.name, 1)
+        patcher = mock.patch.object(
+            lexiconRegistry, "_registry", self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def writeOverlay(self, name, entries):
+        with open(os.path.join(self.overlayDir.name, name + ".json"),
+                  "w") as overlay:
+            overlay.write(json.dumps(entries))
+
+    def test_overlay_keeps_only_changed_words(self):
+        """Testa que o overlay compilado só guarda as palavras, e as suas
+        variantes, que mudam a polaridade do léxico base, e compartilha o
+        léxico base"""
+        overlay = self.registry.getOverlay("loja")
+        self.assertEqual(overlay, {
+            "pedido": -2, "pedidos": -2, "pedida": -2, "pedidas": -2})
+        messageProcessor = lexiconRegistry.getMessageProcessor("loja")
+        self.assertIs(
+            messageProcessor.wordPolarities,
+            MessageProcessor().wordPolarities)
+        self.assertEqual(
+            messageProcessor.lexiconVersion,
+            MessageProcessor.lexiconVersion + "+loja")
+
+    def test_overlay_changes_scores_in_every_mode(self):
+        """Testa que o overlay é aplicado pelos algoritmos escalar,
+        vetorizado e por regras"""
+        text = "Fiz um pedido. Estou feliz"
+        self.assertEqual(MessageProcessor().analyseSentiment(text), 1)
+        messageProcessor = lexiconRegistry.getMessageProcessor("loja")
+        self.assertEqual(messageProcessor.analyseSentiment(text), -1)
+        messageProcessor.vectorizedBatchSize = 1
+        self.assertEqual(
+            messageProcessor.analyseSentimentBatch([text, "pedido"]),
+            [-1, -2])
+        messageProcessor = lexiconRegistry.getMessageProcessor(
+            "loja", sentimentMode="regras")
+        self.assertEqual(
+            messageProcessor.analyseSentiment("não gostei do pedido"), 2)
+
+    def test_overlay_applies_to_variants(self):
+        """Testa que o overlay também é aplicado às formas sem acento,
+        flexionadas e com letras repetidas das suas palavras, mas não a
+        palavras diferentes com a mesma grafia de uma variante"""
+        self.writeOverlay(
+            "variantes", {"ruim": 1, "péssimo": 1, "ameaço": 1})
+        texts = ["ruim", "pessimo", "péssimos", "ruiiim", "ruins", "PÉSSIMAS",
+                 "ameaço", "ameaça"]
+        expected = [1, 1, 1, 1, 1, 1, 1, -1]
+        messageProcessor = lexiconRegistry.getMessageProcessor("variantes")
+        self.assertEqual(
+            [messageProcessor.analyseSentiment(t) for t in texts], expected)
+        messageProcessor.vectorizedBatchSize = 1
+        self.assertEqual(
+            messageProcessor.analyseSentimentBatch(texts), expected)
+        self.assertEqual(
+            messageProcessor.termPolarities("ruiiim e pessimo"),
+            {"ruim": (1, 1), "pessimo": (1, 1)})
+        messageProcessor = lexiconRegistry.getMessageProcessor(
+            "variantes", sentimentMode="regras")
+        self.assertEqual(
+            messageProcessor.analyseSentiment("não foi ruiiim"), -1)
+
+    def test_vectorized_overlay_matches_scalar(self):
+        """Testa que o algoritmo vetorizado aplica o overlay com os mesmos
+        resultados do escalar, inclusive com textos vazios"""
+        texts = ["Fiz um pedido. Estou feliz", "", "pedido pedido triste",
+                 "Estou chateado", ""] * 3
+        messageProcessor = lexiconRegistry.getMessageProcessor("loja")
+        scores = [messageProcessor.analyseSentiment(t) for t in texts]
+        messageProcessor.vectorizedBatchSize = 1
+        self.assertEqual(
+            messageProcessor.analyseSentimentBatch(texts), scores)
+
+    def test_lru_evicts_and_reloads_overlays(self):
+        """Testa que o cache mantém no máximo maxSize overlays"""
+        self.writeOverlay("outra", {"pedido": 1})
+        first = self.registry.getOverlay("loja")
+        self.registry.getOverlay("outra")
+        self.assertEqual(list(self.registry._overlays), ["outra"])
+        self.assertEqual(self.registry.getOverlay("loja"), first)
+
+    def test_unknown_or_invalid_overlay_raises_error(self):
+        """Testa que overlays inexistentes ou com nomes inválidos levantam
+        um erro"""
+        with self.assertRaises(ValueError):
+            self.registry.getOverlay("inexistente")
+        with self.assertRaises(ValueError):
+            self.registry.getOverlay("../pt_word_sentiment_polarity")
+
+    def test_sentiment_view_selects_overlay(self):
+        """Avalia se o endpoint /mensagens/sentiment/count usa o léxico do
+        header X-Lexico"""
+        Mensagem.objects.all().delete()
+        Mensagem(data="2022-01-24", status="Aberto",
+                 texto="Fiz um pedido").save()
+        response = self.client.get(
+            reverse("mensagens:sentimentCount"), HTTP_X_LEXICO="loja")
+        self.assertEqual(json.loads(response.content)["mensagensNegativas"], 1)
+        response = self.client.get(
+            reverse("mensagens:sentimentCount"), {"lexico": "inexistente"})
+        self.assertEquals(response.status_code, 400)
+
+
+class LexiconIndexTest(TestCase):
+    def test_index_expands_folded_and_inflected_variants(self):
+        """Testa que o índice inclui as variantes sem acento e flexionadas
+        de cada palavra"""
+        index = buildIndex({"ótimo": 1, "feliz": 1, "horrível": -1})
+        self.assertEqual(index["ótimo"], 1)
+        self.assertEqual(index["otimo"], 1)
+        self.assertEqual(index["ótimas"], 1)
+        self.assertEqual(index["otimas"], 1)
+        self.assertEqual(index["felizes"], 1)
+        self.assertEqual(index["horríveis"], -1)
+        self.assertEqual(index["horriveis"], -1)
+
+    def test_index_conflict_resolution(self):
+        """Testa que palavras exatas vencem as variantes geradas, e que
+        variantes ambíguas são descartadas"""
+        index = buildIndex({"pôr": 1, "por": 0, "caro": 1, "cara": -1,
+                            "amargo": -1, "amarga": 1,
+                            "bom dia": 1})
+        self.assertEqual(index["por"], 0)
+        self.assertEqual(index["cara"], -1)
+        self.assertFalse("amargas" in index)
+        self.assertFalse("bom dia" in index)
+
+    def test_fold_token(self):
+        """Testa que foldToken remove acentos e letras repetidas"""
+        self.assertEqual(foldToken("ótimooo"), "otimo")
+        self.assertEqual(foldToken("não"), "nao")
+        self.assertEqual(foldToken("carro"), "carro")
+
+    def test_index_asset_is_up_to_date(self):
+        """Testa que o índice em assets foi gerado a partir do léxico
+        atual"""
+        with open("mensagens/assets/pt_word_sentiment_polarity.json") as f:
+            wordPolarities = json.loads(f.read())
+        self.assertEqual(
+            buildIndex(wordPolarities), MessageProcessor().wordPolarities)
+
+    def test_scorer_matches_variants(self):
+        """Testa que a análise de sentimento encontra variantes sem acento,
+        flexionadas e com letras repetidas, inclusive no modo vetorizado"""
+        texts = ["ÓTIMOOO!!", "otimas empresas", "Estou chateada",
+                 "nao estou feliz"]
+        messageProcessor = MessageProcessor()
+        scores = [messageProcessor.analyseSentiment(t) for t in texts]
+        self.assertEqual(scores, [1, 1, -1, 1])
+        messageProcessor.vectorizedBatchSize = 1
+        self.assertEqual(messageProcessor.analyseSentimentBatch(texts), scores)
+        messageProcessor = MessageProcessor(sentimentMode="regras")
+        self.assertEqual(messageProcessor.analyseSentiment(texts[3]), -1)
+
+
+class ArchiveTest(TestCase):
+    def setUp(self):
+        Mensagem.objects.all().delete()
+        self.archiveDir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.archiveDir.cleanup)
+        settingsOverride = override_settings(
+            ARCHIVE_DIR=self.archiveDir.name)
+        settingsOverride.enable()
+        self.addCleanup(settingsOverride.disable)
+        for data, texto in [("2020-01-10", "Sou uma frase feliz"),
+                            ("2020-01-20", "Sou uma frase triste"),
+                            ("2020-02-05", "Sou uma frase"),
+                            ("2022-03-01", "Sou uma frase feliz")]:
+            Mensagem(data=data, status="Aberto", texto=texto).save()
+
+    def test_archive_moves_old_messages_to_monthly_files(self):
+        """Verifica que o comando archive_mensagens move as mensagens
+        antigas para arquivos mensais com seus agregados"""
+        allMessages = json.loads(self.client.get(
+            reverse("mensagens:list")).content)
+        count = json.loads(self.client.get(
+            reverse("mensagens:sentimentCount")).content)
+
+        call_command("archive_mensagens", "--before", "2021-01-01",
+                     stdout=io.StringIO())
+
+        self.assertEqual(Mensagem.objects.count(), 1)
+        january = AgregadoArquivado.objects.get(mes="2020-01-01")
+        self.assertEqual(
+            (january.total, january.positivas, january.negativas), (2, 1, 1))
+        self.assertTrue(os.path.exists(january.arquivo))
+
+        response = self.client.get(reverse("mensagens:list"))
+        self.assertEqual(
+            sorted(m["id"] for m in json.loads(response.content)),
+            sorted(m["id"] for m in allMessages))
+        response = self.client.get(reverse("mensagens:sentimentCount"))
+        self.assertEqual(json.loads(response.content), count)
+
+    def test_archived_range_queries(self):
+        """Verifica que consultas por intervalo de datas só retornam as
+        mensagens arquivadas do intervalo"""
+        archive.archiveMessages(date(2021, 1, 1), formato="sqlite")
+        response = self.client.get(
+            reverse("mensagens:list"),
+            {"desde": "2020-01-15", "ate": "2020-02-28"})
+        self.assertEqual(
+            sorted(m["texto"] for m in json.loads(response.content)),
+            ["Sou uma frase", "Sou uma frase triste"])
+        response = self.client.get(
+            reverse("mensagens:sentimentCount"),
+            {"desde": "2020-01-15", "modo": "regras"})
+        self.assertEqual(json.loads(response.content), {
+            "mensagensPositivas": 1,
+            "mensagensNegativas": 1,
+            "mensagensNeutras": 1,
+        })
+
+    def test_rearchived_messages_are_not_duplicated(self):
+        """Verifica que mensagens gravadas duas vezes no arquivo, após uma
+        interrupção, só são lidas uma vez"""
+        messages = list(Mensagem.objects.filter(data__lt="2021-01-01"))
+        archive._appendNDJSON(
+            os.path.join(self.archiveDir.name, "mensagens-2020-01.ndjson.gz"),
+            [m for m in messages if m.data.month == 1], None)
+        archive.archiveMessages(date(2021, 1, 1), batchSize=2)
+        self.assertEqual(len(list(archive.iterArchivedMessages())), 3)
+
+    def assertInterruptedBatchIsDiscarded(self, formato):
+        kept = Mensagem.objects.get(data="2020-01-10")
+        interrupted = Mensagem.objects.get(data="2020-01-20")
+        archive.archiveMessages(date(2020, 1, 15), formato=formato)
+        january = AgregadoArquivado.objects.get(mes="2020-01-01")
+        append = {"ndjson": archive._appendNDJSON,
+                  "sqlite": archive._appendSQLite}[formato]
+        append(january.arquivo, [interrupted], None)
+        dbHandler.deleteMessage(interrupted.id)
+        self.assertEqual(
+            [m.id for m in archive.iterArchivedMessages()], [kept.id])
+
+        archive.archiveMessages(date(2021, 1, 1), formato=formato)
+        Mensagem.todas.filter(id=interrupted.id).delete()
+        self.assertEqual(
+            sorted(m.texto for m in archive.iterArchivedMessages()),
+            ["Sou uma frase", "Sou uma frase feliz"])
+        self.assertFalse(str(interrupted.id.int) in json.dumps(json.loads(
+            self.client.get(reverse("mensagens:list")).content)))
+
+    def test_interrupted_ndjson_batch_is_discarded(self):
+        """Verifica que as cópias de um lote interrompido não são lidas e
+        são descartadas na próxima execução, mesmo que a mensagem seja
+        removida antes disso"""
+        self.assertInterruptedBatchIsDiscarded("ndjson")
+
+    def test_interrupted_sqlite_batch_is_discarded(self):
+        """Verifica o mesmo que o teste anterior no formato sqlite"""
+        self.assertInterruptedBatchIsDiscarded("sqlite")
+
+    def test_invalid_date_range(self):
+        """Avalia se os endpoints rejeitam datas inválidas"""
+        response = self.client.get(
+            reverse("mensagens:list"), {"desde": "ontem"})
+        self.assertEquals(response.status_code, 400)
+
+
+class ReadReplicaRouterTest(TestCase):
+    def setUp(self):
+        self.router = dbRouter.ReadReplicaRouter()
+        settingsOverride = override_settings(
+            DATABASE_READ_REPLICAS=["replica1", "replica2"])
+        settingsOverride.enable()
+        self.addCleanup(settingsOverride.disable)
+        self.unhealthy = set()
+        patcher = mock.patch.object(
+            self.router, "_isHealthy",
+            side_effect=lambda alias: alias not in self.unhealthy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reads_round_robin_between_replicas(self):
+        """Verifica que as leituras são distribuídas entre as réplicas e as
+        escritas vão para o banco de dados principal"""
+        reads = [self.router.db_for_read(Mensagem) for _ in range(4)]
+        self.assertEqual(reads, ["replica1", "replica2"] * 2)
+        self.assertEqual(self.router.db_for_write(Mensagem), "default")
+
+    def test_unhealthy_replicas_are_skipped(self):
+        """Verifica que réplicas com problemas não recebem leituras"""
+        self.unhealthy = {"replica1"}
+        reads = {self.router.db_for_read(Mensagem) for _ in range(4)}
+        self.assertEqual(reads, {"replica2"})
+        self.unhealthy = {"replica1", "replica2"}
+        self.assertEqual(self.router.db_for_read(Mensagem), "default")
+
+    def test_pinned_reads_go_to_primary(self):
+        """Verifica que as leituras dentro de pinToPrimary vão para o banco
+        de dados principal"""
+        with dbRouter.pinToPrimary():
+            self.assertEqual(self.router.db_for_read(Mensagem), "default")
+        self.assertEqual(self.router.db_for_read(Mensagem), "replica1")
+
+    def test_missing_replica_is_unhealthy(self):
+        """Verifica que uma réplica que não está configurada é considerada
+        com problemas"""
+        self.assertFalse(
+            dbRouter.ReadReplicaRouter()._isHealthy("replica1"))
+
+    def test_replica_file_that_does_not_exist_is_unhealthy(self):
+        """Verifica que uma réplica SQLite cujo arquivo não existe, ou não
+        tem as tabelas, é considerada com problemas e que o arquivo não é
+        criado"""
+        replicaDir = tempfile.TemporaryDirectory()
+        self.addCleanup(replicaDir.cleanup)
+        path = os.path.join(replicaDir.name, "replica.sqlite3")
+        replica = SQLiteDatabaseWrapper(dict(
+            connections.settings["default"],
+            NAME="file:{}?mode=ro".format(path), OPTIONS={"uri": True}),
+            "replicaAusente")
+        connections["replicaAusente"] = replica
+        self.addCleanup(connections.__delitem__, "replicaAusente")
+        self.addCleanup(replica.close)
+        self.assertFalse(
+            dbRouter.ReadReplicaRouter()._isHealthy("replicaAusente"))
+        self.assertFalse(os.path.exists(path))
+        sqlite3.connect(path).close()
+        self.assertFalse(
+            dbRouter.ReadReplicaRouter()._isHealthy("replicaAusente"))
+
+    def test_writes_pin_client_to_primary(self):
+        """Verifica que depois de uma escrita o cliente recebe um cookie que
+        fixa as suas leituras no banco de dados principal"""
+        seen = []
+
+        def view(request):
+            seen.append(dbRouter._pinnedToPrimary.get())
+            return views.HttpResponse()
+
+        middleware = dbRouter.ReadYourWritesMiddleware(view)
+        factory = RequestFactory()
+        middleware(factory.get("/"))
+        response = middleware(factory.post("/"))
+        self.assertTrue(dbRouter.PIN_COOKIE in response.cookies)
+        request = factory.get("/")
+        request.COOKIES[dbRouter.PIN_COOKIE] = \
+            response.cookies[dbRouter.PIN_COOKIE].value
+        middleware(request)
+        self.assertEqual(seen, [False, True, True])
+
+
+@override_settings(IDEMPOTENT_INSERT=True)
+class ContentDeduplicationTest(TestCase):
+    def setUp(self):
+        Mensagem.objects.all().delete()
+        self.original = Mensagem(
+            data="2022-01-24", status="Aberto", texto="Sou uma frase feliz")
+        self.original.save()
+
+    def test_save_computes_content_hash(self):
+        """Verifica que o hash de conteúdo é calculado a partir da data e do
+        texto da mensagem"""
+        self.assertEqual(
+            self.original.hashConteudo,
+            Mensagem.contentHash(date(2022, 1, 24), "Sou uma frase feliz"))
+        self.assertEqual(
+            Mensagem.contentHashFromDict(
+                {"data": "2022-01-24", "texto": "Sou uma frase feliz"}),
+            self.original.hashConteudo)
+        self.assertIsNone(Mensagem.contentHashFromDict({"data": 1}))
+
+    def test_duplicate_insert_returns_existing_id(self):
+        """Verifica que inserir uma mensagem repetida retorna a id da
+        mensagem existente sem validá-la nem gravá-la"""
+        duplicate = json.dumps({
+            "data": "2022-01-24", "status": 3,
+            "texto": "Sou uma frase feliz"})
+        self.assertEqual(
+            dbHandler.insertMessage(duplicate), self.original.id)
+        self.assertEqual(Mensagem.objects.count(), 1)
+        with override_settings(IDEMPOTENT_INSERT=False):
+            with self.assertRaises(Exception):
+                dbHandler.insertMessage(duplicate)
+
+    def test_bulk_insert_deduplicates(self):
+        """Verifica que a inserção em lote descarta as mensagens repetidas no
+        lote e as já gravadas, com uma única consulta"""
+        messages = [Mensagem.fromDict({
+            "data": "2022-01-24", "status": "Aberto", "texto": texto})
+            for texto in ["Sou uma frase feliz", "Outra", "Outra"]]
+        with CaptureQueriesContext(connection) as queries:
+            ids = dbHandler.insertMessages(messages)
+        self.assertEqual(
+            [query["sql"] for query in queries.captured_queries
+             if query["sql"].startswith("SELECT")],
+            [queries.captured_queries[0]["sql"]])
+        self.assertEqual(ids[0], self.original.id)
+        self.assertEqual(ids[1], ids[2])
+        self.assertEqual(Mensagem.objects.count(), 2)
+
+    def test_ingest_view_returns_existing_ids(self):
+        """Avalia se o endpoint /mensagens/ingest responde com as ids das
+        mensagens já gravadas e só coloca as novas na fila"""
+        buffer = ingestionBuffer.IngestionBuffer(
+            maxSize=10, batchSize=10, flushInterval=0.1, enqueueTimeout=0,
+            autoStart=False)
+        body = [
+            {"data": "2022-01-24", "status": "Aberto",
+             "texto": "Sou uma frase feliz"},
+            {"data": "2022-01-25", "status": "Aberto", "texto": "Nova"},
+            {"data": "2022-01-25", "status": "Fechado", "texto": "Nova"},
+        ]
+        with mock.patch.object(
+                views, "getIngestionBuffer", return_value=buffer):
+            response = self.client.post(
+                reverse("mensagens:ingest") + "?sincrono=true",
+                json.dumps(body), content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        ids = json.loads(response.content)["ids"]
+        self.assertEqual(ids[0], self.original.id.int)
+        self.assertEqual(ids[1], ids[2])
+        self.assertEqual(Mensagem.objects.count(), 2)
+
+    def test_submit_finds_committed_duplicates(self):
+        """Verifica que a fila de ingestão procura as mensagens já gravadas
+        enquanto está travada, inclusive as que acabaram de deixar a
+        fila"""
+        buffer = ingestionBuffer.IngestionBuffer(
+            maxSize=10, batchSize=10, flushInterval=0.1, enqueueTimeout=0,
+            autoStart=False)
+        first = Mensagem.fromDict(
+            {"data": "2022-01-25", "status": "Aberto", "texto": "Nova"})
+        buffer.submit([first])
+        self.assertEqual(buffer.flush(), 1)
+        duplicates = [Mensagem.fromDict(
+            {"data": date, "status": "Aberto", "texto": texto})
+            for date, texto in [("2022-01-25", "Nova"),
+                                ("2022-01-24", "Sou uma frase feliz")]]
+        ids = buffer.submit(duplicates)
+        self.assertEqual(ids, [first.id, self.original.id])
+        self.assertEqual(buffer.flush(), 0)
+
+    def test_ingest_view_returns_queued_ids(self):
+        """Avalia se uma mensagem repetida de outra que ainda está na fila
+        de ingestão recebe a id já atribuída"""
+        buffer = ingestionBuffer.IngestionBuffer(
+            maxSize=10, batchSize=10, flushInterval=0.1, enqueueTimeout=0,
+            autoStart=False)
+        body = {"data": "2022-01-25", "status": "Aberto", "texto": "Nova"}
+        with mock.patch.object(
+                views, "getIngestionBuffer", return_value=buffer):
+            ids = [
+                json.loads(self.client.post(
+                    reverse("mensagens:ingest"), json.dumps(body),
+                    content_type="application/json").content)["ids"][0]
+                for _ in range(2)]
+        self.assertEqual(ids[0], ids[1])
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(
+            Mensagem.objects.get(texto="Nova").id.int, ids[0])
+
+
+@override_settings(
+    CHANGE_FEED_POLL_INTERVAL=0.01, CHANGE_FEED_HEARTBEAT_SECONDS=0.05)
+class ChangeFeedTest(TestCase):
+    def setUp(self):
+        Mensagem.objects.all().delete()
+        self.first = dbHandler.insertMessage(json.dumps({
+            "data": "2022-01-24", "status": "Aberto",
+            "texto": "Sou uma frase feliz"}))
+
+    def runFeed(self, headers, until, action=None, status=200):
+        """Conecta ao feed e retorna o corpo da resposta quando until(corpo)
+        for verdadeiro. action é executada depois da conexão"""
+        sent = []
+
+        async def scenario():
+            done = asyncio.Event()
+            app = changeFeed.ChangeFeedApp(None, "/mensagens/changes/")
+
+            async def receive():
+                await done.wait()
+                return {"type": "http.disconnect"}
+
+            async def send(message):
+                sent.append(message)
+                body = b"".join(m.get("body", b"") for m in sent)
+                if action is not None and body.startswith(b"retry:") and \
+                        len(sent) == 2:
+                    asyncio.ensure_future(sync_to_async(action)())
+                if until(body):
+                    done.set()
+
+            await asyncio.wait_for(app({
+                "type": "http", "path": "/mensagens/changes/",
+                "method": "GET", "headers": headers, "query_string": b"",
+            }, receive, send), 5)
+
+        async_to_sync(scenario)()
+        self.assertEqual(sent[0]["status"], status)
+        return b"".join(m.get("body", b"") for m in sent).decode("utf-8")
+
+    def test_writes_are_logged(self):
+        """Verifica que inserções, atualizações e remoções são gravadas no
+        registro com a avaliação de sentimento"""
+        dbHandler.updateMessage(self.first, json.dumps({
+            "data": "2022-01-24", "status": "Aberto",
+            "texto": "Estou chateado"}))
+        dbHandler.deleteMessage(self.first)
+        changes = list(Alteracao.objects.order_by("seq"))
+        self.assertEqual(
+            [change.tipo for change in changes],
+            ["criada", "atualizada", "removida"])
+        self.assertEqual(changes[0].valorSentimento, 1)
+        self.assertEqual(changes[1].valorSentimento, -1)
+        self.assertEqual(
+            json.loads(changes[1].toJSON())["sentimento"], "negativo")
+
+    def test_feed_resumes_from_last_event_id(self):
+        """Verifica que o feed envia as alterações posteriores ao
+        Last-Event-ID e depois as novas alterações"""
+        firstSeq = Alteracao.objects.get().seq
+        dbHandler.insertMessage(json.dumps({
+            "data": "2022-01-25", "status": "Aberto", "texto": "Ruim"}))
+
+        def insert():
+            dbHandler.insertMessage(json.dumps({
+                "data": "2022-01-26", "status": "Aberto", "texto": "Nova"}))
+
+        body = self.runFeed(
+            [(b"last-event-id", str(firstSeq).encode())],
+            lambda body: body.count(b"event: criada") == 2, insert)
+        events = [
+            json.loads(line[len("data: "):])
+            for line in body.splitlines() if line.startswith("data: ")]
+        self.assertEqual(
+            [event["texto"] for event in events], ["Ruim", "Nova"])
+        self.assertEqual(events[0]["sentimento"], "negativo")
+        self.assertTrue("id: {}".format(firstSeq + 1) in body)
+
+    @override_settings(CHANGE_FEED_RETENTION_DAYS=1)
+    def test_old_changes_are_purged(self):
+        """Verifica que o archive_mensagens apaga as alterações antigas do
+        registro, menos a mais recente, e que um Last-Event-ID anterior a
+        elas pede uma nova sincronização completa"""
+        firstSeq = Alteracao.objects.get().seq
+        for texto in ["Ruim", "Bom"]:
+            dbHandler.insertMessage(json.dumps({
+                "data": "2022-01-25", "status": "Aberto", "texto": texto}))
+        Alteracao.objects.update(
+            criadoEm=timezone.now() - timedelta(days=2))
+        archiveDir = tempfile.TemporaryDirectory()
+        self.addCleanup(archiveDir.cleanup)
+        with override_settings(ARCHIVE_DIR=archiveDir.name):
+            call_command(
+                "archive_mensagens", "--before", "2000-01-01",
+                stdout=io.StringIO())
+        self.assertEqual(
+            list(Alteracao.objects.values_list("seq", flat=True)),
+            [firstSeq + 2])
+        self.assertEqual(changeFeed.latestSeq(), firstSeq + 2)
+
+        body = self.runFeed(
+            [(b"last-event-id", str(firstSeq).encode())],
+            lambda body: True, status=410)
+        self.assertTrue("since=0" in body)
+        body = self.runFeed(
+            [(b"last-event-id", str(firstSeq + 1).encode())],
+            lambda body: b"event:" in body)
+        self.assertTrue("id: {}".format(firstSeq + 2) in body)
+
+    def test_idle_feed_sends_heartbeats(self):
+        """Verifica que o feed envia comentários para manter a conexão
+        aberta, e nenhuma alteração antiga sem o Last-Event-ID"""
+        body = self.runFeed([], lambda body: b": heartbeat" in body)
+        self.assertFalse("event:" in body)
+
+    def test_late_commits_are_not_skipped(self):
+        """Verifica que uma seq gravada depois de uma seq maior já lida é
+        distribuída uma única vez, e que as lacunas expiram"""
+        async def scenario():
+            hub = changeFeed.ChangeFeedHub(
+                pollInterval=1, batchSize=10, queueSize=10, gapTimeout=5)
+            hub._task = object()
+            subscriber = await hub.subscribe()
+            hub._receive([(1, b"a"), (3, b"c"), (6, b"f")], 0)
+            self.assertEqual(set(hub._gaps), {2, 4, 5})
+            hub._receive([(2, b"b"), (3, b"c")], 1)
+            hub._receive([(2, b"b")], 2)
+            hub._receive([], 6)
+            self.assertEqual(hub._gaps, {})
+            events = []
+            while not subscriber.queue.empty():
+                events.append(subscriber.queue.get_nowait())
+            self.assertEqual(
+                events, [(1, b"a"), (3, b"c"), (6, b"f"), (2, b"b")])
+
+        async_to_sync(scenario)()
+        firstSeq = Alteracao.objects.get().seq
+        dbHandler.insertMessage(json.dumps({
+            "data": "2022-01-25", "status": "Aberto", "texto": "Ruim"}))
+        self.assertEqual(
+            [seq for seq, _ in changeFeed.fetchChanges(
+                firstSeq + 1, 10, [firstSeq, firstSeq - 1])],
+            [firstSeq])
+
+    def test_slow_subscriber_is_disconnected(self):
+        """Verifica que um cliente com a fila cheia é desconectado"""
+        async def scenario():
+            hub = changeFeed.ChangeFeedHub(
+                pollInterval=1, batchSize=10, queueSize=1)
+            hub._task = object()
+            subscriber = await hub.subscribe()
+            hub._broadcast(1, b"a")
+            hub._broadcast(2, b"b")
+            self.assertIsNone(subscriber.queue.get_nowait())
+            self.assertFalse(subscriber in hub._subscribers)
+
+        async_to_sync(scenario)()
+
+
+@override_settings(DELTA_SYNC_SAFETY_SECONDS=0)
+class DeltaSyncTest(TestCase):
+    def setUp(self):
+        Mensagem.todas.all().delete()
+        self.kept = Mensagem(
+            data="2022-01-24", status="Aberto", texto="Sou uma frase feliz")
+        self.kept.save()
+        self.removed = Mensagem(
+            data="2022-01-25", status="Aberto", texto="Estou chateado")
+        self.removed.save()
+
+    def sync(self, name, since, **params):
+        response = self.client.get(
+            reverse(name), dict(params, since=since))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_sync_returns_only_changes(self):
+        """Verifica que a sincronização incremental retorna só as mensagens
+        alteradas, as removidas e uma nova marca d'água"""
+        first = self.sync("mensagens:list", "0")
+        self.assertEqual(len(first["mensagens"]), 2)
+        self.assertEqual(first["removidas"], [])
+
+        dbHandler.updateMessage(self.kept.id, json.dumps({
+            "data": "2022-01-24", "status": "Fechado",
+            "texto": "Sou uma frase feliz"}))
+        dbHandler.deleteMessage(self.removed.id)
+        second = self.sync("mensagens:list", first["watermark"])
+        self.assertEqual(
+            [message["status"] for message in second["mensagens"]],
+            ["Fechado"])
+        self.assertEqual(second["removidas"], [self.removed.id.int])
+        self.assertEqual(
+            self.sync("mensagens:list", second["watermark"])["mensagens"],
+            [])
+
+    def test_deleted_messages_are_tombstones(self):
+        """Verifica que as mensagens removidas continuam na tabela, mas não
+        são retornadas pelos outros endpoints"""
+        dbHandler.deleteMessage(self.removed.id)
+        self.assertEqual(Mensagem.todas.count(), 2)
+        self.assertEqual(
+            list(Mensagem.objects.all()), [self.kept])
+        with self.assertRaises(Exception):
+            dbHandler.fetchMessage(self.removed.id)
+
+    def test_sentiment_sync_includes_sentiment(self):
+        """Verifica que a sincronização incremental do endpoint de
+        sentimento retorna a avaliação das mensagens alteradas"""
+        body = self.sync("mensagens:sentiment", "0", desde="2022-01-25")
+        self.assertEqual(
+            [message["sentimento"] for message in body["mensagens"]],
+            ["negativo"])
+        response = self.client.get(
+            reverse("mensagens:sentiment"), {"since": "0", "format": "csv"})
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(DELTA_SYNC_RETENTION_DAYS=1)
+    def test_old_removed_messages_are_purged(self):
+        """Verifica que as mensagens removidas antes do horizonte de
+        retenção são apagadas pelo archive_mensagens, e que uma marca
+        d'água mais antiga pede uma nova sincronização completa"""
+        oldWatermark = self.sync("mensagens:list", "0")["watermark"]
+        dbHandler.deleteMessage(self.removed.id)
+        dbHandler.deleteMessage(self.kept.id)
+        Mensagem.todas.filter(id=self.removed.id).update(
+            removidoEm=dbHandler.syncHorizon() - timedelta(hours=1))
+        archiveDir = tempfile.TemporaryDirectory()
+        self.addCleanup(archiveDir.cleanup)
+        with override_settings(ARCHIVE_DIR=archiveDir.name):
+            call_command(
+                "archive_mensagens", "--before", "2000-01-01",
+                stdout=io.StringIO())
+        self.assertEqual(
+            list(Mensagem.todas.values_list("id", flat=True)), [self.kept.id])
+
+        with mock.patch.object(
+                dbHandler.timezone, "now",
+                return_value=timezone.now() + timedelta(days=2)):
+            response = self.client.get(
+                reverse("mensagens:list"), {"since": oldWatermark})
+            self.assertEqual(response.status_code, 410)
+            self.assertEqual(len(self.sync("mensagens:list", "0")[
+                "mensagens"]), 0)
+
+    def test_full_sync_includes_archived_messages(self):
+        """Verifica que a sincronização completa retorna as mensagens
+        arquivadas, como a listagem"""
+        archiveDir = tempfile.TemporaryDirectory()
+        self.addCleanup(archiveDir.cleanup)
+        with override_settings(ARCHIVE_DIR=archiveDir.name):
+            archive.archiveMessages(date(2022, 1, 25))
+            listed = json.loads(
+                self.client.get(reverse("mensagens:list")).content)
+            synced = self.sync("mensagens:list", "0")["mensagens"]
+        self.assertEqual(Mensagem.objects.count(), 1)
+        self.assertEqual(
+            sorted(message["id"] for message in synced),
+            sorted(message["id"] for message in listed))
+        self.assertEqual(len(synced), 2)
+
+    def test_invalid_watermark(self):
+        """Verifica que uma marca d'água inválida é respondida com 400"""
+        for since in ["ontem", "-1"]:
+            response = self.client.get(
+                reverse("mensagens:list"), {"since": since})
+            self.assertEqual(response.status_code, 400)
+
+    def test_rescore_marks_messages_changed(self):
+        """Verifica que o reprocessamento de sentimento só atualiza o
+        atualizadoEm das mensagens cuja avaliação servida mudou"""
+        watermark = self.sync("mensagens:list", "0")["watermark"]
+        jobQueue.runJob(jobQueue.enqueueJob("rescore", {"versaoLexico": "v1"}))
+        jobQueue.runJob(jobQueue.enqueueJob("rescore", {"versaoLexico": "v2"}))
+        messages, removedIDs, _ = dbHandler.listChanges(
+            dbHandler.parseWatermark(watermark))
+        self.assertEqual(messages, [])
+
+        Mensagem.objects.filter(id=self.kept.id).update(valorSentimento=7)
+        jobQueue.runJob(jobQueue.enqueueJob("rescore", {"versaoLexico": "v2"}))
+        messages, removedIDs, _ = dbHandler.listChanges(
+            dbHandler.parseWatermark(watermark))
+        self.assertEqual(messages, [self.kept])
+
+
+class CompressionTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        Mensagem.objects.all().delete()
+        for index in range(30):
+            dbHandler.insertMessage(json.dumps({
+                "data": "2022-01-24", "status": "Aberto",
+                "texto": "Sou uma frase feliz número {}".format(index)}))
+
+    def test_negotiate_encoding(self):
+        """Verifica a escolha do algoritmo pelo header Accept-Encoding"""
+        self.assertEqual(
+            compression.negotiateEncoding("gzip;q=0.5, identity"), "gzip")
+        self.assertIsNone(compression.negotiateEncoding("identity"))
+        self.assertIsNone(compression.negotiateEncoding("gzip;q=0"))
+        self.assertIsNone(compression.negotiateEncoding(None))
+        self.assertEqual(
+            compression.negotiateEncoding("*"),
+            compression.availableEncodings()[0])
+
+    def test_list_is_compressed(self):
+        """Avalia se a lista de mensagens é comprimida com gzip quando o
+        cliente aceita"""
+        plain = self.client.get(reverse("mensagens:list"))
+        response = self.client.get(
+            reverse("mensagens:list"), HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertTrue("Accept-Encoding" in response.headers["Vary"])
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        self.assertLess(len(response.content), len(plain.content))
+
+    def test_small_responses_are_not_compressed(self):
+        """Verifica que respostas menores que o tamanho mínimo não são
+        comprimidas"""
+        response = self.client.get(
+            reverse("mensagens:sentimentCount"), HTTP_ACCEPT_ENCODING="gzip")
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(
+            json.loads(response.content)["mensagensPositivas"], 30)
+
+    def test_streaming_response_is_compressed(self):
+        """Avalia se as respostas em streaming são comprimidas bloco a
+        bloco"""
+        response = self.client.get(
+            reverse("mensagens:sentiment"), {"format": "ndjson"},
+            HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        lines = gzip.decompress(
+            b"".join(response.streaming_content)).splitlines()
+        self.assertEqual(len(lines), 30)
+
+    @unittest.skipIf(
+        compression.zstandard is None or compression.brotli is None,
+        "zstandard ou brotli não instalados")
+    def test_brotli_and_zstd(self):
+        """Verifica que br e zstd são usados quando disponíveis"""
+        plain = self.client.get(reverse("mensagens:list")).content
+        response = self.client.get(
+            reverse("mensagens:list"), HTTP_ACCEPT_ENCODING="gzip, br")
+        self.assertEqual(response.headers["Content-Encoding"], "br")
+        self.assertEqual(
+            compression.brotli.decompress(response.content), plain)
+        response = self.client.get(
+            reverse("mensagens:list"), HTTP_ACCEPT_ENCODING="zstd")
+        self.assertEqual(
+            compression.zstandard.ZstdDecompressor().decompressobj()
+            .decompress(response.content), plain)
+
+    def test_cached_response_until_data_changes(self):
+        """Verifica que uma resposta em cache é reaproveitada até que as
+        mensagens sejam alteradas"""
+        with mock.patch.object(
+                views.dbHandler, "listMessages",
+                wraps=dbHandler.listMessages) as listMessages:
+            first = self.client.get(
+                reverse("mensagens:list"), HTTP_ACCEPT_ENCODING="gzip")
+            second = self.client.get(
+                reverse("mensagens:list"), HTTP_ACCEPT_ENCODING="gzip")
+            self.assertEqual(listMessages.call_count, 1)
+            self.assertEqual(second.content, first.content)
+            self.assertEqual(second.headers["Content-Encoding"], "gzip")
+
+            dbHandler.insertMessage(json.dumps({
+                "data": "2022-01-25", "status": "Aberto",
+                "texto": "Estou chateado"}))
+            third = self.client.get(
+                reverse("mensagens:list"), HTTP_ACCEPT_ENCODING="gzip")
+            self.assertEqual(listMessages.call_count, 2)
+            self.assertEqual(
+                len(json.loads(gzip.decompress(third.content))), 31)
+
+    def test_replica_and_pinned_reads_skip_cache(self):
+        """Verifica que uma resposta lida em uma réplica não é guardada em
+        cache e que um cliente fixado no banco de dados principal não usa o
+        cache"""
+        listMessagesFromPrimary = dbHandler.listMessages
+
+        def readFromReplica(*args, **kwargs):
+            dbRouter._readAliases.get().add("replica1")
+            return listMessagesFromPrimary(*args, **kwargs)
+
+        with mock.patch.object(
+                views.dbHandler, "listMessages",
+                side_effect=readFromReplica) as listMessages:
+            self.client.get(reverse("mensagens:list"))
+            self.client.get(reverse("mensagens:list"))
+            self.assertEqual(listMessages.call_count, 2)
+
+        with mock.patch.object(
+                views.dbHandler, "listMessages",
+                wraps=dbHandler.listMessages) as listMessages:
+            self.client.get(reverse("mensagens:list"))
+            self.client.cookies[dbRouter.PIN_COOKIE] = str(time.time() + 60)
+            self.client.get(reverse("mensagens:list"))
+            self.assertEqual(listMessages.call_count, 2)
+            del self.client.cookies[dbRouter.PIN_COOKIE]
+            self.client.get(reverse("mensagens:list"))
+            self.assertEqual(listMessages.call_count, 2)
+
+    def test_data_version_is_cheap(self):
+        """Verifica que a versão dos dados é lida com uma única consulta e
+        que muda com as alterações que não passam pelo registro"""
+        with CaptureQueriesContext(connection) as queries:
+            version = compression.dataVersion()
+        self.assertEqual(len(queries.captured_queries), 1)
+        jobQueue.runJob(jobQueue.enqueueJob("rescore", {"versaoLexico": "v1"}))
+        self.assertNotEqual(compression.dataVersion(), version)
+
+
+class SentimentTermsTest(TestCase):
+    def setUp(self):
+        Mensagem.objects.all().delete()
+        FrequenciaTermo.objects.all().delete()
+        messages = [
+            {"data": "2022-01-24", "status": "Aberto",
+             "texto": "Estou chateado, muito chateado. Ótima empresa"},
+            {"data": "2022-01-25", "status": "Fechado",
+             "texto": "Estou chateado"},
+        ]
+        self.ids = [
+            dbHandler.insertMessage(json.dumps(message))
+            for message in messages]
+
+    def terms(self, **params):
+        response = self.client.get(
+            reverse("mensagens:sentimentTerms"), params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_top_terms(self):
+        """Avalia se o endpoint /mensagens/sentiment/terms retorna os termos
+        que mais contribuem para cada sentimento"""
+        terms = self.terms()
+        self.assertEqual(terms["negativos"][0], {
+            "termo": "chateado", "polaridade": -1, "ocorrencias": 3,
+            "contribuicao": -3})
+        self.assertEqual(terms["positivos"][0]["termo"], "ótima")
+        self.assertEqual(
+            self.terms(status="Fechado")["negativos"][0]["ocorrencias"], 1)
+        self.assertEqual(
+            self.terms(ate="2022-01-24")["negativos"][0]["ocorrencias"], 2)
+        self.assertEqual(
+            len(self.terms(limite=1)["negativos"]), 1)
+
+    def test_index_follows_updates_and_deletes(self):
+        """Verifica que o índice de termos é atualizado quando mensagens são
+        alteradas e removidas"""
+        dbHandler.updateMessage(self.ids[1], json.dumps({
+            "data": "2022-01-25", "status": "Fechado",
+            "texto": "Ótima empresa"}))
+        terms = self.terms()
+        self.assertEqual(terms["negativos"][0]["ocorrencias"], 2)
+        self.assertEqual(terms["positivos"][0]["ocorrencias"], 2)
+        dbHandler.deleteMessage(self.ids[0])
+        terms = self.terms()
+        self.assertEqual(terms["negativos"], [])
+        self.assertEqual(FrequenciaTermo.objects.count(), 1)
+
+    def test_concurrent_delete_unindexes_once(self):
+        """Verifica que uma remoção concorrente da mesma mensagem falha sem
+        subtrair os termos do índice de novo nem registrar outra remoção"""
+        unindexMessages = termIndex.unindexMessages
+        concurrent = []
+
+        def deleteConcurrently(messages):
+            if not concurrent:
+                concurrent.append(True)
+                with self.assertRaises(Exception):
+                    dbHandler.deleteMessage(self.ids[1])
+            unindexMessages(messages)
+
+        with mock.patch.object(
+                dbHandler.term_index, "unindexMessages",
+                side_effect=deleteConcurrently):
+            dbHandler.deleteMessage(self.ids[1])
+        self.assertEqual(concurrent, [True])
+        self.assertEqual(
+            Alteracao.objects.filter(tipo=Alteracao.REMOVIDA).count(), 1)
+        incremental = self.terms()
+        self.assertEqual(incremental["negativos"][0]["ocorrencias"], 2)
+        termIndex.rebuildTermIndex()
+        self.assertEqual(self.terms(), incremental)
+
+    def test_rebuild_matches_incremental_index(self):
+        """Verifica que recriar o índice gera as mesmas contagens que as
+        atualizações incrementais"""
+        dbHandler.insertMessages([Mensagem.fromDict({
+            "data": "2022-01-24", "status": "Aberto",
+            "texto": "Chateado e feliz"})])
+        incremental = self.terms()
+        termIndex.rebuildTermIndex()
+        self.assertEqual(self.terms(), incremental)
+
+    def test_invalid_limit(self):
+        """Verifica que um limite inválido é respondido com 400"""
+        for limit in ["zero", "0", "1000"]:
+            response = self.client.get(
+                reverse("mensagens:sentimentTerms"), {"limite": limit})
+            self.assertEqual(response.status_code, 400)
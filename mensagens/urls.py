@@ -15,4 +15,20 @@ urlpatterns = [
     path(
         "sentiment/count/",
         views.countMessagesSentiment,
-        name="sentimentCount")]
+        name="sentimentCount"),
+    path(
+        "sentiment/terms/",
+        views.sentimentTerms,
+        name="sentimentTerms"),
+    path(
+        "ingest/",
+        views.ingestMessages,
+        name="ingest"),
+    path(
+        "jobs/",
+        views.createJob,
+        name="jobs"),
+    path(
+        "jobs/<int:jobID>/",
+        views.jobStatus,
+        name="jobStatus")]
@@ -1,21 +1,74 @@
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from . import archive
 from . import database_handler as dbHandler
+from . import exporters
+from . import job_queue
+from . import lexicon_registry
+from . import term_index
+from .ingestion_buffer import (
+    DuplicateMessageID, IngestionBufferFull, getIngestionBuffer)
+from .models import Mensagem, Tarefa
+from django.conf import settings
 import json
-from .message_processor import MessageProcessor
 import logging
+from datetime import date
+
+
+def _errorResponse(code, message):
+    """Cria uma resposta HTTP de erro no formato padrão da API"""
+    response = HttpResponse(status=code)
+    response.headers["Content-Type"] = "application/json"
+    response.write(json.dumps({
+        "error": {
+            "code": code,
+            "message": message
+        }
+    }))
+    return response
+
+
+def _dateRange(request):
+    """Lê o intervalo de datas dos parâmetros "desde" e "ate" da query
+
+    Returns:
+        uma tupla (início, fim). Os limites não informados são None
+    Raises:
+        ValueError: alguma das datas não está no formato YYYY-mm-dd
+    """
+    start = request.GET.get("desde")
+    end = request.GET.get("ate")
+    return (
+        date.fromisoformat(start) if start else None,
+        date.fromisoformat(end) if end else None)
 
 
 def listMessages(request):
     """Lida com requests para o path "/"
+
+    Os parâmetros "desde" e "ate" da query limitam as mensagens a um
+    intervalo de datas. Mensagens arquivadas no intervalo também são
+    retornadas. Com o parâmetro "since", só as alterações posteriores a essa
+    marca d'água são retornadas, como em _syncMessages.
         args:
             request: o request em HTTP
         returns:
             Responde em HTTP com uma lista de mensagens em formato JSON
     """
+    try:
+        start, end = _dateRange(request)
+    except ValueError as error:
+        return _errorResponse(400, "Data inválida: {}".format(error))
+    if "since" in request.GET:
+        return _syncMessages(
+            request, start, end,
+            lambda messages: [message.toDict() for message in messages])
     response = HttpResponse()
     response.headers["Content-Type"] = "application/json"
     try:
-        messages = dbHandler.listMessages()
+        messages = dbHandler.listMessages(start=start, end=end)
         response.write(messages)
     except Exception as error:
         logging.error(error)
@@ -32,19 +85,156 @@ def listMessages(request):
     return response
 
 
+def _syncMessages(request, start, end, serialize):
+    """Responde a uma sincronização incremental, pedida com o parâmetro
+    "since" da query
+
+    A resposta é um objeto JSON com as mensagens alteradas depois da marca
+    d'água em "mensagens", as ids das mensagens removidas em "removidas" e a
+    marca d'água da próxima sincronização em "watermark". "since=0" retorna
+    todas as mensagens, inclusive as arquivadas. Uma marca d'água anterior
+    ao horizonte de retenção das mensagens removidas é respondida com 410,
+    e o cliente precisa sincronizar de novo com "since=0".
+        args:
+            request: o request em HTTP
+            start: se fornecida, só retorna mensagens a partir dessa data
+            end: se fornecida, só retorna mensagens até essa data
+            serialize: função que converte a lista de Mensagens alteradas
+        em uma lista serializável em JSON
+        returns:
+            Responde em HTTP com as alterações em formato JSON
+    """
+    try:
+        since = dbHandler.parseWatermark(request.GET["since"])
+    except ValueError as error:
+        return _errorResponse(400, str(error))
+    try:
+        messages, removedIDs, watermark = dbHandler.listChanges(
+            since, start=start, end=end)
+        body = json.dumps({
+            "mensagens": serialize(messages),
+            "removidas": [messageID.int for messageID in removedIDs],
+            "watermark": watermark,
+        })
+    except dbHandler.WatermarkExpired as error:
+        return _errorResponse(410, str(error))
+    except Exception as error:
+        logging.error(error)
+        return _errorResponse(
+            500, "Um erro interno ao sistema aconteceu." +
+            " Tente novamente mais tarde")
+    response = HttpResponse(body)
+    response.headers["Content-Type"] = "application/json"
+    return response
+
+
+def _sentimentRows(messages, messageProcessor, fields):
+    """Gera as linhas exportadas pelo endpoint "/sentiment", só avaliando o
+    sentimento das mensagens se essas colunas forem pedidas"""
+    if "valorSentimento" in fields or "sentimento" in fields:
+        yield from messageProcessor.analyseMessages(messages)
+        return
+    for message in messages:
+        yield {
+            "id": message.id.int,
+            "status": message.status,
+            "data": str(message.data),
+            "texto": message.texto if "texto" in fields else None,
+        }
+
+
+def _messageProcessor(request):
+    """Cria o processador de mensagens com o modo de análise de sentimento
+    pedido no parâmetro "modo" da query, e com o léxico do cliente pedido no
+    header X-Lexico ou no parâmetro "lexico" da query
+
+    Raises:
+        ValueError: o modo ou o léxico pedidos não existem
+    """
+    return lexicon_registry.getMessageProcessor(
+        overlayName=(
+            request.headers.get("X-Lexico") or request.GET.get("lexico")),
+        sentimentMode=request.GET.get("modo"))
+
+
+def _exportMessagesSentiment(request, exportFormat, fields,
+                             messageProcessor):
+    """Transmite as mensagens e suas avaliações de sentimento em streaming no
+    formato e com as colunas pedidas
+        args:
+            request: o request em HTTP
+            exportFormat: um dos formatos de exporters.availableFormats()
+            fields: as colunas pedidas
+            messageProcessor: o MessageProcessor que avalia as mensagens
+        returns:
+            Responde em HTTP com as mensagens serializadas em streaming
+    """
+    start, end = _dateRange(request)
+    loadText = bool({"texto", "valorSentimento", "sentimento"} & set(fields))
+    messages = dbHandler.iterMessages(
+        loadText=loadText, start=start, end=end)
+    rows = _sentimentRows(messages, messageProcessor, fields)
+    response = StreamingHttpResponse(exporters.streamExport(
+        rows, exportFormat, fields,
+        fractionalScores=messageProcessor.sentimentMode == "regras"))
+    response.headers["Content-Type"] = exporters.CONTENT_TYPES[exportFormat]
+    response.headers["Vary"] = "Accept"
+    return response
+
+
 def analyseMessagesSentiment(request):
     """Lida com requests para o path "/sentiment"
+
+    O formato da resposta é escolhido pelo parâmetro "format" da query ou
+    pelo header Accept: json (padrão), ndjson, csv e, caso o pyarrow esteja
+    instalado, arrow e parquet. O parâmetro "fields" escolhe as colunas
+    exportadas, por exemplo "fields=id,data,valorSentimento". O parâmetro
+    "modo" escolhe o algoritmo de análise de sentimento, "simples" (padrão)
+    ou "regras". Os parâmetros "desde" e "ate" limitam as mensagens a um
+    intervalo de datas. Com o parâmetro "since", só as alterações posteriores
+    a essa marca d'água são retornadas, como em _syncMessages.
         args:
             request: o request em HTTP
         returns:
             Responde em HTTP com uma lista de mensagens e a avaliação de
-     seus sentimentos em formato JSON
+     seus sentimentos no formato pedido
     """
+    try:
+        exportFormat = exporters.negotiateFormat(
+            request.GET.get("format"), request.headers.get("Accept"))
+    except ValueError as error:
+        return _errorResponse(406, str(error))
+    try:
+        fields = exporters.parseFields(
+            request.GET.get("fields"), exportFormat)
+    except ValueError as error:
+        return _errorResponse(400, str(error))
+    try:
+        messageProcessor = _messageProcessor(request)
+        start, end = _dateRange(request)
+    except ValueError as error:
+        return _errorResponse(400, str(error))
+    if "since" in request.GET:
+        if exportFormat != "json" or "fields" in request.GET:
+            return _errorResponse(
+                400, "A sincronização incremental só está disponível no "
+                "formato json e com todas as colunas")
+        response = _syncMessages(
+            request, start, end,
+            lambda messages: list(messageProcessor.analyseMessages(messages)))
+        response.headers["Vary"] = "Accept"
+        return response
+    if exportFormat != "json" or "fields" in request.GET:
+        return _exportMessagesSentiment(
+            request, exportFormat, fields, messageProcessor)
+
     response = HttpResponse()
     response.headers["Content-Type"] = "application/json"
+    # O formato também pode ter sido escolhido pelo Accept
+    response.headers["Vary"] = "Accept"
     try:
-        messageProcessor = MessageProcessor()
-        messages = dbHandler.listMessages(jsonFormat=False)
+        messages = dbHandler.listMessages(
+            jsonFormat=False, start=start, end=end)
         analysedMessages = messageProcessor.processMessagesSentiment(messages)
         response.write(analysedMessages)
     except Exception as error:
@@ -68,15 +258,27 @@ def countMessagesSentiment(request):
             request: o request em HTTP
         returns:
             Responde em HTTP com uma conta de quantas mensagens
-        negativas, positivas e neutras tem no banco
+        negativas, positivas e neutras tem no banco. O parâmetro "modo"
+        escolhe o algoritmo de análise de sentimento, e os parâmetros
+        "desde" e "ate" limitam a conta a um intervalo de datas. As
+        mensagens arquivadas são contadas pelos agregados de cada mês
     """
+    try:
+        messageProcessor = _messageProcessor(request)
+        start, end = _dateRange(request)
+    except ValueError as error:
+        return _errorResponse(400, str(error))
     response = HttpResponse()
     response.headers["Content-Type"] = "application/json"
     try:
-        messageProcessor = MessageProcessor()
-        messages = dbHandler.listMessages(jsonFormat=False)
-        analysedMessages = messageProcessor.countSentiment(messages)
-        response.write(analysedMessages)
+        messages = dbHandler.listMessages(
+            jsonFormat=False, start=start, end=end, includeArchived=False)
+        counts = json.loads(messageProcessor.countSentiment(messages))
+        archivedCounts = archive.countArchivedSentiment(
+            messageProcessor, start, end)
+        for key in counts:
+            counts[key] += archivedCounts[key]
+        response.write(json.dumps(counts))
     except Exception as error:
         logging.error(error)
         errorMessage = json.dumps({
@@ -90,3 +292,156 @@ def countMessagesSentiment(request):
         response.status_code = 500
         return response
     return response
+
+
+def sentimentTerms(request):
+    """Lida com requests para o path "/sentiment/terms"
+
+    Os parâmetros "desde" e "ate" limitam os termos a um intervalo de
+    datas, "status" aos termos das mensagens com esse status e "limite"
+    escolhe quantos termos de cada sentimento são retornados (padrão 10).
+        args:
+            request: o request em HTTP
+        returns:
+            Responde em HTTP com os termos do léxico que mais contribuem
+        para o sentimento positivo e negativo das mensagens, em
+        "positivos" e "negativos"
+    """
+    try:
+        start, end = _dateRange(request)
+        limit = int(request.GET.get("limite", 10))
+        if not 1 <= limit <= settings.SENTIMENT_TERMS_MAX_LIMIT:
+            raise ValueError("o limite deve estar entre 1 e {}".format(
+                settings.SENTIMENT_TERMS_MAX_LIMIT))
+    except ValueError as error:
+        return _errorResponse(400, "Parâmetro inválido: {}".format(error))
+    try:
+        terms = term_index.topTerms(
+            limit, start=start, end=end, status=request.GET.get("status"))
+    except Exception as error:
+        logging.error(error)
+        return _errorResponse(
+            500, "Um erro interno ao sistema aconteceu." +
+            " Tente novamente mais tarde")
+    response = HttpResponse(json.dumps(terms))
+    response.headers["Content-Type"] = "application/json"
+    return response
+
+
+@csrf_exempt
+@require_POST
+def createJob(request):
+    """Lida com requests para o path "/jobs"
+        args:
+            request: o request em HTTP com o tipo e os parâmetros da tarefa
+        em formato JSON
+        returns:
+            Responde em HTTP 202 com a tarefa criada em formato JSON. O
+        header Location aponta para o endpoint de status da tarefa
+    """
+    try:
+        body = json.loads(request.body)
+        job = job_queue.enqueueJob(body.get("tipo"), body.get("parametros"))
+    except (ValueError, AttributeError) as error:
+        return _errorResponse(400, "Tarefa inválida: {}".format(error))
+    except Exception as error:
+        logging.error(error)
+        return _errorResponse(
+            500, "Um erro interno ao sistema aconteceu." +
+            " Tente novamente mais tarde")
+    response = HttpResponse(status=202)
+    response.headers["Content-Type"] = "application/json"
+    response.headers["Location"] = reverse(
+        "mensagens:jobStatus", args=[job.id])
+    response.write(job.toJSON())
+    return response
+
+
+@require_GET
+def jobStatus(request, jobID):
+    """Lida com requests para o path "/jobs/<id>"
+        args:
+            request: o request em HTTP
+            jobID: a id da tarefa
+        returns:
+            Responde em HTTP com o status e o progresso da tarefa em formato
+        JSON
+    """
+    try:
+        job = job_queue.fetchJob(jobID)
+    except Tarefa.DoesNotExist:
+        return _errorResponse(
+            404, "Tarefa com id {} não existe".format(jobID))
+    except Exception as error:
+        logging.error(error)
+        return _errorResponse(
+            500, "Um erro interno ao sistema aconteceu." +
+            " Tente novamente mais tarde")
+    response = HttpResponse()
+    response.headers["Content-Type"] = "application/json"
+    response.write(job)
+    return response
+
+
+@csrf_exempt
+@require_POST
+def ingestMessages(request):
+    """Lida com requests para o path "/ingest"
+
+    As mensagens são validadas e colocadas na fila de ingestão, que as
+    grava no banco de dados em lotes. Com o parâmetro "sincrono=true" na
+    query, ou com settings.INGESTION_SYNCHRONOUS, a resposta só é enviada
+    depois que as mensagens forem gravadas. Com settings.IDEMPOTENT_INSERT,
+    mensagens com a mesma data e o mesmo texto de uma mensagem já gravada,
+    ou ainda na fila, recebem a id da mensagem existente e não são gravadas
+    de novo. Mensagens com a id escolhida pelo cliente só são aceitas no
+    modo síncrono, que informa se a gravação falhou, e são recusadas caso a
+    id já pertença a outra mensagem.
+        args:
+            request: o request em HTTP com uma mensagem ou uma lista de
+        mensagens em formato JSON
+        returns:
+            Responde em HTTP 202 com as ids atribuídas às mensagens, ou
+        201 no modo síncrono. Responde 409 caso alguma id já exista e 503
+        caso a fila esteja cheia
+    """
+    synchronous = settings.INGESTION_SYNCHRONOUS or (
+        request.GET.get("sincrono") == "true")
+    try:
+        body = json.loads(request.body)
+        if not isinstance(body, list):
+            body = [body]
+    except Exception as error:
+        return _errorResponse(
+            400, "Falha ao criar mensagem. Verifique o formato do input: {}"
+            .format(error))
+    checkIDs = any(isinstance(data, dict) and "id" in data for data in body)
+    if checkIDs and not synchronous:
+        return _errorResponse(
+            400, "Mensagens com id só podem ser enviadas com sincrono=true")
+    try:
+        messages = [Mensagem.fromDict(data) for data in body]
+    except Exception as error:
+        return _errorResponse(
+            400, "Falha ao criar mensagem. Verifique o formato do input: {}"
+            .format(error))
+    try:
+        if messages:
+            getIngestionBuffer().submit(
+                messages, synchronous=synchronous, checkIDs=checkIDs)
+    except DuplicateMessageID as error:
+        return _errorResponse(409, str(error))
+    except IngestionBufferFull as error:
+        response = _errorResponse(503, str(error))
+        response.headers["Retry-After"] = "1"
+        return response
+    except Exception as error:
+        logging.error(error)
+        return _errorResponse(
+            500, "Um erro interno ao sistema aconteceu." +
+            " Tente novamente mais tarde")
+    response = HttpResponse(status=201 if synchronous else 202)
+    response.headers["Content-Type"] = "application/json"
+    response.write(json.dumps(
+        {"ids": [message.id.int for message in messages]}))
+    return response